@@ -35,6 +35,7 @@ binaries += [('C:/tmp/libsecp256k1.dll', '.')]
 
 datas = [
     (home+'vialectrum/*.json', 'vialectrum'),
+    (home+'vialectrum/*.bin', 'vialectrum'),
     (home+'vialectrum/wordlist/english.txt', 'vialectrum/wordlist'),
     (home+'vialectrum/locale', 'vialectrum/locale'),
     (home+'vialectrum/plugins', 'vialectrum/plugins'),
@@ -84,7 +84,7 @@ setup(
         'vialectrum': 'vialectrum'
     },
     package_data={
-        '': ['*.txt', '*.json', '*.ttf', '*.otf'],
+        '': ['*.txt', '*.json', '*.bin', '*.ttf', '*.otf'],
         'vialectrum': [
             'wordlist/*.txt',
             'locale/*/LC_MESSAGES/electrum.mo',
@@ -24,21 +24,35 @@
 import threading
 import asyncio
 import itertools
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from typing import NamedTuple
+from collections.abc import MutableMapping
+from types import MappingProxyType
 
 from . import bitcoin
 from .bitcoin import COINBASE_MATURITY, TYPE_ADDRESS, TYPE_PUBKEY
 from .util import PrintError, profiler, bfh, VerifiedTxInfo, TxMinedStatus, aiosafe, CustomTaskGroup
 from .transaction import Transaction, TxOutput
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
-from .blockchain import hash_header
+from .blockchain import MissingHeader
+from .txindex import Interner, TxInputIndex, TxOutputIndex, HistoryIndex
 from .i18n import _
 
 TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
 
+# parsed transactions kept by LazyTransactions
+TX_CACHE_SIZE = 1000
+
+# unspent coins and (confirmed, unconfirmed, unmatured) balance of an
+# address. Balances with coinbase coins depend on the local height.
+AddrCoins = NamedTuple("AddrCoins", [("utxos", dict),
+                                     ("balance", tuple),
+                                     ("local_height", int),
+                                     ("has_coinbase", bool)])
+
 class AddTransactionException(Exception):
     pass
 
@@ -48,6 +62,64 @@ class UnrelatedTransactionException(AddTransactionException):
         return _("Transaction is unrelated to this wallet.")
 
 
+class LazyTransactions(MutableMapping):
+    """txid -> Transaction, that keeps the raw transactions and only
+    parses them when they are accessed. The most recently used parsed
+    transactions are kept, up to max_size.
+    Membership, len, iteration and raw do not parse anything.
+    Transactions can be read without a lock: a parsed transaction that
+    another thread drops from the cache meanwhile is still returned."""
+
+    def __init__(self, raw_txs=None, max_size=TX_CACHE_SIZE):
+        self.max_size = max_size
+        self._raw = dict(raw_txs or {})  # txid -> raw tx, for all txs
+        self._parsed = OrderedDict()  # txid -> Transaction, least recently used first
+        # read-only view of the raw transactions
+        self.raw = MappingProxyType(self._raw)
+
+    def __getitem__(self, txid):
+        tx = self._parsed.get(txid)
+        if tx is not None:
+            try:
+                self._parsed.move_to_end(txid)
+            except KeyError:
+                pass
+            return tx
+        tx = Transaction(self._raw[txid])
+        # deserialized before it is shared, as deserialize is not thread safe
+        tx.deserialize()
+        self._cache(txid, tx)
+        return tx
+
+    def __setitem__(self, txid, tx):
+        self._raw[txid] = str(tx)
+        self._parsed.pop(txid, None)
+        self._cache(txid, tx)
+
+    def __delitem__(self, txid):
+        del self._raw[txid]
+        self._parsed.pop(txid, None)
+
+    def __contains__(self, txid):
+        return txid in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def _cache(self, txid, tx):
+        if self.max_size <= 0:
+            return
+        self._parsed[txid] = tx
+        while len(self._parsed) > self.max_size:
+            try:
+                self._parsed.popitem(last=False)
+            except KeyError:
+                break
+
+
 class AddressSynchronizer(PrintError):
     """
     inherited by wallet
@@ -64,8 +136,17 @@ class AddressSynchronizer(PrintError):
         # locks: if you need to take multiple ones, acquire them in the order they are defined here!
         self.lock = threading.RLock()
         self.transaction_lock = threading.RLock()
+        # storage key -> keys of the entries of that index changed since
+        # the last save_transactions, see _set_unsaved
+        self._unsaved = defaultdict(set)
+        # txids and addresses of the compact indexes txi, txo and history
+        self._txids = Interner()
+        self._address_ids = Interner()
         # address -> list(txid, height)
-        self.history = storage.get('addr_history',{})
+        self.history = HistoryIndex(self._txids)
+        self.history.update(storage.get('addr_history', {}, frozen=True))
+        # address -> status of its history, see get_history_status. Access with self.lock.
+        self.history_status = dict(storage.get('addr_history_status', {}, frozen=True))
         # Verified transactions.  txid -> VerifiedTxInfo.  Access with self.lock.
         verified_tx = storage.get('verified_tx3', {})
         self.verified_tx = {}
@@ -73,6 +154,9 @@ class AddressSynchronizer(PrintError):
             self.verified_tx[txid] = VerifiedTxInfo(height, timestamp, txpos, header_hash)
         # Transactions pending verification.  txid -> tx_height. Access with self.lock.
         self.unverified_tx = defaultdict(int)
+        # address -> AddrCoins, dropped when a transaction of the address,
+        # or its height, changes. Access with self.lock and self.transaction_lock.
+        self._addr_coins = {}
         # true when synchronized
         self.up_to_date = False
         # thread local storage for caching stuff
@@ -184,6 +268,10 @@ class AddressSynchronizer(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+            self.history_status.pop(address, None)
+            self._set_unsaved('addr_history', address)
+            self._set_unsaved('addr_history_status', address)
+            self._addr_coins.pop(address, None)
             self.set_up_to_date(False)
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -277,7 +365,7 @@ class AddressSynchronizer(PrintError):
                                     d[addr] = set()
                                 d[addr].add((ser, v))
                             return
-            self.txi[tx_hash] = d = {}
+            d = {}
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
                     continue
@@ -285,9 +373,11 @@ class AddressSynchronizer(PrintError):
                 prevout_n = txi['prevout_n']
                 ser = prevout_hash + ':%d' % prevout_n
                 self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
+                self._set_unsaved('spent_outpoints', prevout_hash)
                 add_value_from_prev_output()
+            self.txi[tx_hash] = d
             # add outputs
-            self.txo[tx_hash] = d = {}
+            d = {}
             for n, txo in enumerate(tx.outputs()):
                 v = txo[2]
                 ser = tx_hash + ':%d'%n
@@ -299,16 +389,17 @@ class AddressSynchronizer(PrintError):
                     # give v to txi that spends me
                     next_tx = self.spent_outpoints[tx_hash].get(n)
                     if next_tx is not None:
-                        dd = self.txi.get(next_tx, {})
-                        if dd.get(addr) is None:
-                            dd[addr] = set()
-                        if (ser, v) not in dd[addr]:
-                            dd[addr].add((ser, v))
+                        if self.txi.add(next_tx, addr, ser, v):
+                            self._set_unsaved('txi', next_tx)
                         self._add_tx_to_local_history(next_tx)
+            self.txo[tx_hash] = d
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
             self.transactions[tx_hash] = tx
+            self._set_unsaved('transactions', tx_hash)
+            self._set_unsaved('txi', tx_hash)
+            self._set_unsaved('txo', tx_hash)
             return True
 
     def remove_transaction(self, tx_hash):
@@ -321,6 +412,7 @@ class AddressSynchronizer(PrintError):
                     prevout_hash = txin['prevout_hash']
                     prevout_n = txin['prevout_n']
                     self.spent_outpoints[prevout_hash].pop(prevout_n, None)
+                    self._set_unsaved('spent_outpoints', prevout_hash)
                     if not self.spent_outpoints[prevout_hash]:
                         self.spent_outpoints.pop(prevout_hash)
             else:  # expensive but always works
@@ -328,6 +420,7 @@ class AddressSynchronizer(PrintError):
                     for prevout_n, spending_txid in d.items():
                         if spending_txid == tx_hash:
                             self.spent_outpoints[prevout_hash].pop(prevout_n, None)
+                            self._set_unsaved('spent_outpoints', prevout_hash)
                             if not self.spent_outpoints[prevout_hash]:
                                 self.spent_outpoints.pop(prevout_hash)
             # Remove this tx itself; if nothing spends from it.
@@ -335,6 +428,7 @@ class AddressSynchronizer(PrintError):
             # removed when those other txns are removed.
             if not self.spent_outpoints[tx_hash]:
                 self.spent_outpoints.pop(tx_hash)
+                self._set_unsaved('spent_outpoints', tx_hash)
 
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
@@ -343,6 +437,9 @@ class AddressSynchronizer(PrintError):
             self._remove_tx_from_local_history(tx_hash)
             self.txi.pop(tx_hash, None)
             self.txo.pop(tx_hash, None)
+            self._set_unsaved('transactions', tx_hash)
+            self._set_unsaved('txi', tx_hash)
+            self._set_unsaved('txo', tx_hash)
 
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
@@ -356,7 +453,8 @@ class AddressSynchronizer(PrintError):
         self.add_unverified_tx(tx_hash, tx_height)
         self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
+        """status: of hist, if already computed by the caller"""
         with self.lock:
             old_hist = self.get_address_history(addr)
             for tx_hash, height in old_hist:
@@ -364,9 +462,13 @@ class AddressSynchronizer(PrintError):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.verified_tx.pop(tx_hash, None)
+                    self._invalidate_coins(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
+            self.history_status[addr] = status if status is not None else history_status(hist)
+            self._set_unsaved('addr_history', addr)
+            self._set_unsaved('addr_history_status', addr)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -379,40 +481,41 @@ class AddressSynchronizer(PrintError):
 
         # Store fees
         self.tx_fees.update(tx_fees)
+        self._set_unsaved('tx_fees', *tx_fees)
 
     @profiler
     def load_transactions(self):
         # load txi, txo, tx_fees
-        self.txi = self.storage.get('txi', {})
-        for txid, d in list(self.txi.items()):
-            for addr, lst in d.items():
-                self.txi[txid][addr] = set([tuple(x) for x in lst])
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        tx_list = self.storage.get('transactions', {})
-        # load transactions
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
+        self.txi = TxInputIndex(self._txids, self._address_ids)
+        self.txi.update(self.storage.get('txi', {}, frozen=True))
+        self.txo = TxOutputIndex(self._txids, self._address_ids)
+        self.txo.update(self.storage.get('txo', {}, frozen=True))
+        self.tx_fees = dict(self.storage.get('tx_fees', {}, frozen=True))
+        tx_list = self.storage.get('transactions', {}, frozen=True)
+        # load transactions, they are parsed when accessed
+        self.transactions = LazyTransactions(tx_list)
+        for tx_hash in list(self.transactions):
             if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None:
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                self._set_unsaved('transactions', tx_hash)
+                del self.transactions[tx_hash]
         # load spent_outpoints
-        _spent_outpoints = self.storage.get('spent_outpoints', {})
+        _spent_outpoints = self.storage.get('spent_outpoints', {}, frozen=True)
         self.spent_outpoints = defaultdict(dict)
         for prevout_hash, d in _spent_outpoints.items():
             for prevout_n_str, spending_txid in d.items():
                 prevout_n = int(prevout_n_str)
                 if spending_txid not in self.transactions:
+                    self._set_unsaved('spent_outpoints', prevout_hash)
                     continue  # only care about txns we have
                 self.spent_outpoints[prevout_hash][prevout_n] = spending_txid
 
     @profiler
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
-        for txid in itertools.chain(self.txi, self.txo):
-            self._add_tx_to_local_history(txid)
+        for txid, addrs in itertools.chain(self.txi.iter_addresses(), self.txo.iter_addresses()):
+            for addr in addrs:
+                self._history_local.setdefault(addr, set()).add(txid)
 
     @profiler
     def check_history(self):
@@ -421,6 +524,9 @@ class AddressSynchronizer(PrintError):
         hist_addrs_not_mine = list(filter(lambda k: not self.is_mine(k), self.history.keys()))
         for addr in hist_addrs_not_mine:
             self.history.pop(addr)
+            self.history_status.pop(addr, None)
+            self._set_unsaved('addr_history', addr)
+            self._set_unsaved('addr_history_status', addr)
             save = True
         for addr in hist_addrs_mine:
             hist = self.history[addr]
@@ -441,18 +547,34 @@ class AddressSynchronizer(PrintError):
             if tx_height == TX_HEIGHT_LOCAL and txid not in self.transactions:
                 self.remove_transaction(txid)
 
+    def _set_unsaved(self, name, *keys):
+        """Mark entries of the index stored under name as changed,
+        or removed, for the next save_transactions."""
+        self._unsaved[name].update(keys)
+
+    def _get_saved_indexes(self):
+        """storage key -> (index, function encoding one of its entries)"""
+        return {
+            'transactions': (self.transactions.raw, lambda raw: raw),
+            'txi': (self.txi, lambda d: {addr: list(s) for addr, s in d.items()}),
+            'txo': (self.txo, lambda d: {addr: list(l) for addr, l in d.items()}),
+            'tx_fees': (self.tx_fees, lambda fee: fee),
+            'addr_history': (self.history, list),
+            'addr_history_status': (self.history_status, lambda status: status),
+            'spent_outpoints': (self.spent_outpoints, dict),
+        }
+
     @profiler
     def save_transactions(self, write=False):
+        """Put the entries changed since the last call into storage."""
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('addr_history', self.history)
-            self.storage.put('spent_outpoints', self.spent_outpoints)
+            unsaved, self._unsaved = self._unsaved, defaultdict(set)
+            for name, (index, encode) in self._get_saved_indexes().items():
+                keys = unsaved.get(name)
+                if not keys:
+                    continue
+                entries = {k: encode(index[k]) for k in keys if k in index}
+                self.storage.put_entries(name, entries, [k for k in keys if k not in index])
             if write:
                 self.storage.write()
 
@@ -465,14 +587,21 @@ class AddressSynchronizer(PrintError):
     def clear_history(self):
         with self.lock:
             with self.transaction_lock:
-                self.txi = {}
-                self.txo = {}
+                # new interners, so that the ids of the old entries are freed
+                self._txids = Interner()
+                self._address_ids = Interner()
+                self.txi = TxInputIndex(self._txids, self._address_ids)
+                self.txo = TxOutputIndex(self._txids, self._address_ids)
                 self.tx_fees = {}
                 self.spent_outpoints = defaultdict(dict)
-                self.history = {}
+                self.history = HistoryIndex(self._txids)
+                self.history_status = {}
                 self.verified_tx = {}
-                self.transactions = {}
-                self.save_transactions()
+                self.transactions = LazyTransactions()
+                self._addr_coins = {}
+                self._unsaved.clear()
+                for name in self._get_saved_indexes():
+                    self.storage.put(name, {})
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -547,10 +676,12 @@ class AddressSynchronizer(PrintError):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
+                self._addr_coins.pop(addr, None)
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
             for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
+                self._addr_coins.pop(addr, None)
                 cur_hist = self._history_local.get(addr, set())
                 try:
                     cur_hist.remove(txid)
@@ -559,16 +690,24 @@ class AddressSynchronizer(PrintError):
                 else:
                     self._history_local[addr] = cur_hist
 
+    def _invalidate_coins(self, tx_hash):
+        """Drop the coins of the addresses of a tx whose height changed."""
+        for addr in itertools.chain(self.txi.get(tx_hash, []), self.txo.get(tx_hash, [])):
+            self._addr_coins.pop(addr, None)
+
     def add_unverified_tx(self, tx_hash, tx_height):
         if tx_hash in self.verified_tx:
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.verified_tx.pop(tx_hash)
+                    self._invalidate_coins(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self._invalidate_coins(tx_hash)
                 self.unverified_tx[tx_hash] = tx_height
             # to remove pending proof requests:
             if self.verifier:
@@ -579,9 +718,19 @@ class AddressSynchronizer(PrintError):
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info
+            self._invalidate_coins(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, tx_mined_status)
 
+    def get_history_status(self, addr):
+        """Status of the history of addr, as announced by the server.
+        Cached, as histories of busy addresses can be long."""
+        with self.lock:
+            if addr not in self.history_status:
+                self.history_status[addr] = history_status(self.history.get(addr, []))
+                self._set_unsaved('addr_history_status', addr)
+            return self.history_status[addr]
+
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
         with self.lock:
@@ -594,8 +743,11 @@ class AddressSynchronizer(PrintError):
             for tx_hash, info in list(self.verified_tx.items()):
                 tx_height = info.height
                 if tx_height >= height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
+                    try:
+                        header_hash = blockchain.get_hash(tx_height)
+                    except MissingHeader:
+                        header_hash = None
+                    if header_hash != info.header_hash:
                         self.verified_tx.pop(tx_hash, None)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
@@ -607,6 +759,7 @@ class AddressSynchronizer(PrintError):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self._invalidate_coins(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -734,15 +887,42 @@ class AddressSynchronizer(PrintError):
                 sent[txi] = height
         return received, sent
 
-    def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = {}
-        for txo, v in coins.items():
+    @with_local_height_cached
+    def _get_addr_coins(self, address):
+        """AddrCoins of address. They are computed from get_addr_io when
+        they were dropped, see _invalidate_coins, or when they have
+        coinbase coins and the local height changed."""
+        local_height = self.get_local_height()
+        with self.lock, self.transaction_lock:
+            coins = self._addr_coins.get(address)
+            if coins is None or (coins.has_coinbase and coins.local_height != local_height):
+                coins = self._compute_addr_coins(address, local_height)
+                self._addr_coins[address] = coins
+            return coins
+
+    def _compute_addr_coins(self, address, local_height):
+        received, sent = self.get_addr_io(address)
+        c = u = x = 0
+        for txo, (tx_height, v, is_cb) in received.items():
+            if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                x += v
+            elif tx_height > 0:
+                c += v
+            else:
+                u += v
+            if txo in sent:
+                if sent[txo] > 0:
+                    c -= v
+                else:
+                    u -= v
+        has_coinbase = any(is_cb for tx_height, v, is_cb in received.values())
+        for txi in sent:
+            received.pop(txi)
+        utxos = {}
+        for txo, v in received.items():
             tx_height, value, is_cb = v
             prevout_hash, prevout_n = txo.split(':')
-            x = {
+            utxos[txo] = {
                 'address':address,
                 'value':value,
                 'prevout_n':int(prevout_n),
@@ -750,8 +930,11 @@ class AddressSynchronizer(PrintError):
                 'height':tx_height,
                 'coinbase':is_cb
             }
-            out[txo] = x
-        return out
+        return AddrCoins(utxos, (c, u, x), local_height, has_coinbase)
+
+    def get_addr_utxo(self, address):
+        # copies, as callers add fields to coins
+        return {txo: dict(x) for txo, x in self._get_addr_coins(address).utxos.items()}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
@@ -763,22 +946,7 @@ class AddressSynchronizer(PrintError):
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        local_height = self.get_local_height()
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > local_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        return c, u, x
+        return self._get_addr_coins(address).balance
 
     @with_local_height_cached
     def get_utxos(self, domain=None, excluded=None, mature=False, confirmed_only=False):
@@ -789,14 +957,13 @@ class AddressSynchronizer(PrintError):
         if excluded:
             domain = set(domain) - excluded
         for addr in domain:
-            utxos = self.get_addr_utxo(addr)
+            utxos = self._get_addr_coins(addr).utxos
             for x in utxos.values():
                 if confirmed_only and x['height'] <= 0:
                     continue
                 if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
                     continue
-                coins.append(x)
-                continue
+                coins.append(dict(x))
         return coins
 
     def get_balance(self, domain=None):
@@ -21,20 +21,23 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import json
+import mmap
+import time
+import struct
 import threading
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence, List
 
 from . import util
 from .bitcoin import Hash, hash_encode, int_to_hex, rev_hex
 from . import constants
-from .util import bfh, bh2u
+from .util import bfh
+from .scrypt import BACKEND_NAME as POW_BACKEND, getPoWHash, getPoWHashes
 
-try:
-    import scrypt
-    getPoWHash = lambda x: scrypt.hash(x, x, N=1024, r=1, p=1, buflen=32)
-except ImportError:
+if POW_BACKEND == 'python':
     util.print_msg("Warning: package scrypt not available; synchronization could be very slow")
-    from .scrypt import scrypt_1024_1_1_80 as getPoWHash
 
 
 MAX_TARGET = 0x000001FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
@@ -60,11 +63,11 @@ def deserialize_header(s: bytes, height: int) -> dict:
         raise InvalidHeader('Invalid header: {}'.format(s))
     if len(s) != 80:
         raise InvalidHeader('Invalid header length: {}'.format(len(s)))
-    hex_to_int = lambda s: int('0x' + bh2u(s[::-1]), 16)
+    hex_to_int = lambda s: int.from_bytes(s, byteorder='little')
     h = {}
     h['version'] = hex_to_int(s[0:4])
-    h['prev_block_hash'] = hash_encode(s[4:36])
-    h['merkle_root'] = hash_encode(s[36:68])
+    h['prev_block_hash'] = hash_encode(bytes(s[4:36]))
+    h['merkle_root'] = hash_encode(bytes(s[36:68]))
     h['timestamp'] = hex_to_int(s[68:72])
     h['bits'] = hex_to_int(s[72:76])
     h['nonce'] = hex_to_int(s[76:80])
@@ -81,10 +84,345 @@ def hash_header(header: dict) -> str:
 def pow_hash_header(header):
     return hash_encode(getPoWHash(bfh(serialize_header(header))))
 
+def _pow_hashes_worker(raw_headers: List[bytes]) -> List[str]:
+    # runs in a worker process
+    return [hash_encode(h) for h in getPoWHashes(raw_headers)]
+
+_pow_executor = None
+POW_HASH_SLICE = 128  # headers per task submitted to the process pool
+
+def get_pow_executor(config) -> Optional[ProcessPoolExecutor]:
+    """Process pool for PoW hashing, if the 'parallel_verification'
+    config option is set and there is more than one core."""
+    global _pow_executor
+    if not config.get('parallel_verification', False):
+        return None
+    if _pow_executor is None:
+        workers = os.cpu_count() or 1
+        if workers < 2:
+            return None
+        _pow_executor = ProcessPoolExecutor(max_workers=workers)
+    return _pow_executor
+
+def shutdown_pow_executor() -> None:
+    global _pow_executor
+    if _pow_executor is not None:
+        _pow_executor.shutdown(wait=False)
+        _pow_executor = None
+
+def pow_hash_chunks(chunks: Sequence[bytes], executor: ProcessPoolExecutor=None) -> List[List[Optional[str]]]:
+    """Return the PoW hash of every header in each chunk (None for headers
+    that are not PoW checked). With an executor, the hashing of all chunks
+    is spread over its worker processes."""
+    raw_headers = []
+    for data in chunks:
+        for i in range(len(data) // 80):
+            raw_header = data[i*80:(i+1)*80]
+            if Blockchain.needs_pow_check(deserialize_header(raw_header, 0)):
+                raw_headers.append(raw_header)
+    if executor is None or len(raw_headers) <= POW_HASH_SLICE:
+        hashes = _pow_hashes_worker(raw_headers)
+    else:
+        n = POW_HASH_SLICE
+        slices = [raw_headers[i:i+n] for i in range(0, len(raw_headers), n)]
+        hashes = [h for result in executor.map(_pow_hashes_worker, slices) for h in result]
+    hashes = iter(hashes)
+    out = []
+    for data in chunks:
+        out.append([next(hashes) if Blockchain.needs_pow_check(deserialize_header(data[i*80:(i+1)*80], 0)) else None
+                    for i in range(len(data) // 80)])
+    return out
+
+
+class HeaderCache:
+    """Bounded LRU cache of deserialized headers and their hashes, by height.
+    Callers must hold the lock of the Blockchain owning the cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # height -> [header, header_hash or None]
+
+    def get(self, height: int) -> Optional[list]:
+        item = self._items.get(height)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(height)
+        return item
+
+    def put(self, height: int, header: dict) -> list:
+        item = [header, None]
+        if self.max_size <= 0:
+            return item
+        self._items[height] = item
+        self._items.move_to_end(height)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return item
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def get_stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._items), 'max_size': self.max_size}
+
+
+class ChunkStore:
+    """Headers of the checkpointed chunks that were actually fetched.
+
+    In sparse mode (config 'sparse_headers'), the headers file of the main
+    chain only holds the headers after the last checkpoint. Chunks before
+    it are fetched on demand (see SPV) and appended here, so that disk use
+    scales with the chunks a wallet needs rather than with chain length.
+
+    The file starts with a magic and the first height kept in the headers
+    file, followed by records of a chunk index (uint32) and 2016 headers.
+    """
+
+    MAGIC = b'VIACHNKS'
+    _HEADER = struct.Struct('<8sI')
+    _INDEX = struct.Struct('<I')
+    CHUNK_SIZE = 2016 * 80
+    RECORD_SIZE = _INDEX.size + CHUNK_SIZE
+
+    def __init__(self, path: str, file_start: int):
+        self.path = path
+        self.file_start = file_start
+        self.lock = threading.RLock()
+        self.offsets = {}  # chunk index -> file offset of its headers
+        self._mmap = None
+        if os.path.exists(path):
+            self._load()
+        else:
+            self.reset(file_start)
+
+    def _load(self) -> None:
+        with open(self.path, 'rb+') as f:
+            header = f.read(self._HEADER.size)
+            if len(header) < self._HEADER.size:
+                raise Exception('truncated chunk store: {}'.format(self.path))
+            magic, self.file_start = self._HEADER.unpack(header)
+            if magic != self.MAGIC:
+                raise Exception('not a chunk store: {}'.format(self.path))
+            size = os.fstat(f.fileno()).st_size
+            num_records = (size - self._HEADER.size) // self.RECORD_SIZE
+            for i in range(num_records):
+                pos = self._HEADER.size + i * self.RECORD_SIZE
+                f.seek(pos)
+                index, = self._INDEX.unpack(f.read(self._INDEX.size))
+                self.offsets[index] = pos + self._INDEX.size
+            end = self._HEADER.size + num_records * self.RECORD_SIZE
+            if size != end:
+                # partial record from an interrupted append
+                f.truncate(end)
+
+    def reset(self, file_start: int) -> None:
+        """Drop all chunks, and record the first height of the headers file."""
+        with self.lock:
+            self.close_mmap()
+            with open(self.path, 'wb') as f:
+                f.write(self._HEADER.pack(self.MAGIC, file_start))
+                f.flush()
+                os.fsync(f.fileno())
+            self.file_start = file_start
+            self.offsets = {}
+
+    def has_chunk(self, index: int) -> bool:
+        return index in self.offsets
+
+    def get_chunks(self) -> List[int]:
+        return sorted(self.offsets)
+
+    def read_chunk(self, index: int) -> Optional[bytes]:
+        with self.lock:
+            offset = self.offsets.get(index)
+            if offset is None:
+                return None
+            return self._get_mmap()[offset:offset + self.CHUNK_SIZE]
+
+    def read_header(self, height: int) -> memoryview:
+        """Header at height, or 80 zero bytes if its chunk is missing."""
+        with self.lock:
+            offset = self.offsets.get(height // 2016)
+            if offset is None:
+                return memoryview(bytes(80))
+            offset += (height % 2016) * 80
+            return memoryview(self._get_mmap())[offset:offset + 80]
+
+    def write_chunk(self, index: int, data: bytes) -> None:
+        if len(data) != self.CHUNK_SIZE:
+            # only complete chunks are stored; a partial one is fetched again
+            return
+        with self.lock:
+            # windows cannot extend a mapped file
+            self.close_mmap()
+            with open(self.path, 'rb+') as f:
+                offset = self.offsets.get(index)
+                if offset is None:
+                    f.seek(0, os.SEEK_END)
+                    f.write(self._INDEX.pack(index))
+                    offset = f.tell()
+                f.seek(offset)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.offsets[index] = offset
+
+    def close_mmap(self) -> None:
+        with self.lock:
+            if self._mmap is None:
+                return
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # still exported by a memoryview; unmapped once that is released
+            self._mmap = None
+
+    def _get_mmap(self) -> mmap.mmap:
+        if self._mmap is None:
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+
+HEADER_CACHE_SIZE = 4096
+
+# durability policies for header appends, see Blockchain.should_flush
+HEADERS_SYNC_ALWAYS = 'always'      # write and fsync every header
+HEADERS_SYNC_CHUNK = 'chunk'        # at chunk boundaries
+HEADERS_SYNC_COUNT = 'count'        # every 'headers_sync_count' headers
+HEADERS_SYNC_INTERVAL = 'interval'  # every 'headers_sync_interval' seconds
+HEADERS_SYNC_POLICIES = (HEADERS_SYNC_ALWAYS, HEADERS_SYNC_CHUNK, HEADERS_SYNC_COUNT, HEADERS_SYNC_INTERVAL)
+
 
 blockchains = {}
 
+def flush_all(only_due: bool=False) -> None:
+    """Write and fsync the buffered headers of every branch,
+    or only of those whose durability policy requires it.
+    New targets are saved in any case."""
+    for b in list(blockchains.values()):
+        with b.lock:
+            if not only_due or b.should_flush():
+                b.flush()
+            b.flush_targets()
+
+def get_header_cache_stats() -> dict:
+    """Header cache counters for every branch, keyed by forkpoint."""
+    return {forkpoint: b.header_cache.get_stats() for forkpoint, b in list(blockchains.items())}
+
+_targets_lock = threading.Lock()
+
+def _targets_path(config) -> str:
+    return os.path.join(util.get_headers_dir(config), 'targets.json')
+
+def _load_targets(config, name: str) -> dict:
+    """Persisted retargets of the branch stored in file 'name', by chunk index."""
+    with _targets_lock:
+        try:
+            with open(_targets_path(config), 'r') as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            return {}
+    return {int(index): (last_hash, int(target, 16))
+            for index, (last_hash, target) in table.get(name, {}).items()}
+
+def _save_targets(config, name: str, targets: dict) -> None:
+    path = _targets_path(config)
+    with _targets_lock:
+        try:
+            with open(path, 'r') as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            table = {}
+        table[name] = {str(index): [last_hash, '%064x' % target]
+                       for index, (last_hash, target) in targets.items()}
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(table))
+        os.replace(temp_path, path)
+
+
+chunk_store = None  # type: Optional[ChunkStore]
+
+def init_chunk_store(config) -> Optional[ChunkStore]:
+    """Set up the sparse header store if enabled in config, converting
+    an existing headers file between the full and the sparse layout."""
+    global chunk_store
+    if chunk_store is not None:
+        chunk_store.close_mmap()
+    headers_dir = util.get_headers_dir(config)
+    store_path = os.path.join(headers_dir, 'checkpoint_chunks')
+    headers_path = os.path.join(headers_dir, 'blockchain_headers')
+    file_start = len(constants.net.CHECKPOINTS) * 2016
+    if not config.get('sparse_headers', False):
+        chunk_store = None
+        if os.path.exists(store_path):
+            _expand_headers_file(headers_path, ChunkStore(store_path, file_start))
+            os.remove(store_path)
+        return None
+    if os.path.exists(store_path):
+        store = ChunkStore(store_path, file_start)
+        if store.file_start != file_start:
+            # checkpoints changed: like init_headers_file, sync again from the last one
+            store.reset(file_start)
+            open(headers_path, 'wb').close()
+    else:
+        store = ChunkStore(store_path, file_start)
+        if os.path.exists(headers_path):
+            _collapse_headers_file(headers_path, store)
+    chunk_store = store
+    return store
+
+def _collapse_headers_file(headers_path: str, store: ChunkStore) -> None:
+    """Move the checkpointed chunks of a full headers file to the store."""
+    region = store.file_start * 80
+    empty_chunk = bytes(ChunkStore.CHUNK_SIZE)
+    with open(headers_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        for index in range(min(size, region) // ChunkStore.CHUNK_SIZE):
+            data = f.read(ChunkStore.CHUNK_SIZE)
+            if data != empty_chunk:
+                store.write_chunk(index, data)
+        f.seek(region)
+        tail = f.read() if size > region else b''
+    _replace_file(headers_path, tail)
+
+def _expand_headers_file(headers_path: str, store: ChunkStore) -> None:
+    """Inverse of _collapse_headers_file. Missing chunks are left as holes."""
+    region = store.file_start * 80
+    tail = b''
+    if os.path.exists(headers_path):
+        with open(headers_path, 'rb') as f:
+            tail = f.read()
+    temp_path = headers_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        for index in store.get_chunks():
+            f.seek(index * ChunkStore.CHUNK_SIZE)
+            f.write(store.read_chunk(index))
+        f.truncate(region)
+        f.seek(region)
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+    store.close_mmap()
+    os.replace(temp_path, headers_path)
+
+def _replace_file(path: str, data: bytes) -> None:
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
 def read_blockchains(config):
+    init_chunk_store(config)
     blockchains[0] = Blockchain(config, 0, None)
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
@@ -114,6 +452,22 @@ class Blockchain(util.PrintError):
         self.parent_id = parent_id
         assert parent_id != forkpoint
         self.lock = threading.RLock()
+        self._mmap = None  # read-only mapping of the headers file, see read_raw_header
+        self.header_cache = HeaderCache(config.get('header_cache_size', HEADER_CACHE_SIZE))
+        # write-behind buffer of appended headers, not yet on disk
+        self._buffer = bytearray()
+        self._last_flush = time.time()
+        self.sync_policy = config.get('headers_sync_policy', HEADERS_SYNC_ALWAYS)
+        if self.sync_policy not in HEADERS_SYNC_POLICIES:
+            raise Exception('unknown headers_sync_policy: {}'.format(self.sync_policy))
+        self.sync_count = config.get('headers_sync_count', 100)
+        self.sync_interval = config.get('headers_sync_interval', 5)
+        # retargets by chunk index, as (hash of last header of chunk, target);
+        # entries loaded from disk are only trusted once that hash is checked
+        self._targets = {}
+        self._unverified_targets = _load_targets(config, os.path.basename(self.path()))
+        # new targets are saved together, see flush_all
+        self._targets_changed = False
         with self.lock:
             self.update_size()
 
@@ -152,7 +506,9 @@ class Blockchain(util.PrintError):
         forkpoint = header.get('block_height')
         self = Blockchain(parent.config, forkpoint, parent.forkpoint)
         open(self.path(), 'w+').close()
+        self.clear_targets()
         self.save_header(header)
+        self.flush()
         return self
 
     def height(self) -> int:
@@ -164,31 +520,72 @@ class Blockchain(util.PrintError):
 
     def update_size(self) -> None:
         p = self.path()
-        self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        self._size = self._file_start()
+        self._size += os.path.getsize(p)//80 if os.path.exists(p) else 0
+        self._size += len(self._buffer) // 80
+        # file was appended to or truncated; remap on next read
+        self.close_mmap()
+        self.header_cache.clear()
+
+    def _file_start(self) -> int:
+        """Number of headers of the branch that are not in its file.
+        Non-zero for the main chain in sparse mode, see ChunkStore."""
+        if chunk_store is None or self.parent_id is not None:
+            return 0
+        return chunk_store.file_start
 
-    def verify_header(self, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
+    def close_mmap(self) -> None:
+        with self.lock:
+            if self._mmap is None:
+                return
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # still exported by a memoryview; unmapped once that is released
+            self._mmap = None
+
+    def _get_mmap(self) -> Optional[mmap.mmap]:
+        if self._mmap is None:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @classmethod
+    def needs_pow_check(cls, header: dict) -> bool:
+        if constants.net.TESTNET:
+            return False
+        return header.get('version') & 0x100 == 0  # Viacoin auxpow
+
+    def verify_header(self, header: dict, prev_hash: str, target: int, expected_header_hash: str=None,
+                      pow_hash: str=None) -> None:
         #_hash = hash_header(header)
         #_powhash = pow_hash_header(header
         #if expected_header_hash and expected_header_hash != _hash:
         #    raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
             raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
-        if constants.net.TESTNET:
-            return
-        if header.get('version') & 0x100 != 0: # Viacoin auxpow
+        if not self.needs_pow_check(header):
             return
-        _powhash = pow_hash_header(header)
+        _powhash = pow_hash_header(header) if pow_hash is None else pow_hash
         bits = self.target_to_bits(target)
         if bits != header.get('bits'):
             raise Exception("bits mismatch: %s vs %s" % (bits, header.get('bits')))
         if int('0x' + _powhash, 16) > target:
             raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _powhash, 16), target))
 
-    def verify_chunk(self, index: int, data: bytes) -> None:
+    def verify_chunk(self, index: int, data: bytes, pow_hashes: Sequence[Optional[str]]=None) -> None:
         num = len(data) // 80
         start_height = index * 2016
         prev_hash = self.get_hash(start_height - 1)
         target = self.get_target(index-1)
+        # the PoW checks are independent of each other, so hash the whole
+        # chunk at once; only the prev_hash linkage below is sequential
+        if pow_hashes is None:
+            pow_hashes = pow_hash_chunks([data], get_pow_executor(self.config))[0]
         for i in range(num):
             height = start_height + i
             try:
@@ -197,7 +594,7 @@ class Blockchain(util.PrintError):
                 expected_header_hash = None
             raw_header = data[i*80:(i+1) * 80]
             header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
+            self.verify_header(header, prev_hash, target, expected_header_hash, pow_hashes[i])
             prev_hash = hash_header(header)
 
     def path(self):
@@ -213,6 +610,11 @@ class Blockchain(util.PrintError):
             main_chain = blockchains[0]
             main_chain.save_chunk(index, chunk)
             return
+        if chunk_within_checkpoint_region and self._file_start():
+            with self.lock:
+                chunk_store.write_chunk(index, chunk)
+                self.header_cache.clear()
+            return
 
         delta_height = (index * 2016 - self.forkpoint)
         delta_bytes = delta_height * 80
@@ -224,6 +626,8 @@ class Blockchain(util.PrintError):
         truncate = not chunk_within_checkpoint_region
         self.write(chunk, delta_bytes, truncate)
         self.swap_with_parent()
+        if self.height() >= index * 2016 + 2015:
+            self.update_target(index)
 
     @with_lock
     def swap_with_parent(self) -> None:
@@ -236,12 +640,14 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         forkpoint = self.forkpoint
         parent = self.parent()
+        self.flush()
+        parent.flush()
         self.assert_headers_file_available(self.path())
         with open(self.path(), 'rb') as f:
             my_data = f.read()
         self.assert_headers_file_available(parent.path())
         with open(parent.path(), 'rb') as f:
-            f.seek((forkpoint - parent.forkpoint)*80)
+            f.seek((forkpoint - parent.forkpoint - parent._file_start())*80)
             parent_data = f.read(parent_branch_size*80)
         self.write(parent_data, 0)
         parent.write(my_data, (forkpoint - parent.forkpoint)*80)
@@ -252,11 +658,19 @@ class Blockchain(util.PrintError):
         self.parent_id = parent.parent_id; parent.parent_id = parent_id
         self.forkpoint = parent.forkpoint; parent.forkpoint = forkpoint
         self._size = parent._size; parent._size = parent_branch_size
+        self.close_mmap()
+        parent.close_mmap()
+        self.header_cache.clear()
+        parent.header_cache.clear()
+        # branches were renamed, and parents changed
+        for b in blockchains.values():
+            b.clear_targets()
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
                 self.print_error("renaming", b.old_path, b.path())
+                b.close_mmap()
                 os.rename(b.old_path, b.path())
         # update pointers
         blockchains[self.forkpoint] = self
@@ -273,16 +687,22 @@ class Blockchain(util.PrintError):
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         with self.lock:
+            self.flush()
             self.assert_headers_file_available(filename)
+            # windows cannot truncate a mapped file
+            self.close_mmap()
             with open(filename, 'rb+') as f:
+                file_offset = offset - self._file_start() * 80
+                assert file_offset >= 0
                 if truncate and offset != self._size*80:
-                    f.seek(offset)
+                    f.seek(file_offset)
                     f.truncate()
-                f.seek(offset)
+                f.seek(file_offset)
                 f.write(data)
                 f.flush()
                 os.fsync(f.fileno())
             self.update_size()
+            self.invalidate_targets(self.forkpoint + offset // 80)
 
     @with_lock
     def save_header(self, header: dict) -> None:
@@ -291,8 +711,42 @@ class Blockchain(util.PrintError):
         # headers are only _appended_ to the end:
         assert delta == self.size()
         assert len(data) == 80
-        self.write(data, delta*80)
+        self._buffer += data
+        self._size += 1
+        if self.should_flush():
+            self.flush()
         self.swap_with_parent()
+        if (header.get('block_height') + 1) % 2016 == 0:
+            # the next header will need the target from this chunk
+            self.update_target(header.get('block_height') // 2016)
+
+    def should_flush(self) -> bool:
+        if not self._buffer:
+            return False
+        if self.sync_policy == HEADERS_SYNC_CHUNK:
+            return (self.height() + 1) % 2016 == 0 or len(self._buffer) >= 2016 * 80
+        elif self.sync_policy == HEADERS_SYNC_COUNT:
+            return len(self._buffer) >= self.sync_count * 80
+        elif self.sync_policy == HEADERS_SYNC_INTERVAL:
+            return time.time() - self._last_flush >= self.sync_interval
+        return True
+
+    def flush(self) -> None:
+        """Write buffered headers to disk, and fsync."""
+        with self.lock:
+            if not self._buffer:
+                return
+            filename = self.path()
+            self.assert_headers_file_available(filename)
+            with open(filename, 'rb+') as f:
+                f.seek((self._size - self._file_start() - len(self._buffer) // 80) * 80)
+                f.write(self._buffer)
+                f.flush()
+                os.fsync(f.fileno())
+            self._buffer = bytearray()
+            self._last_flush = time.time()
+            # the data has not changed, only where it lives: keep header_cache
+            self.close_mmap()
 
     def read_header(self, height: int) -> Optional[dict]:
         assert self.parent_id != self.forkpoint
@@ -302,17 +756,48 @@ class Blockchain(util.PrintError):
             return self.parent().read_header(height)
         if height > self.height():
             return
+        with self.lock:
+            item = self._read_cached_header(height)
+            return dict(item[0]) if item else None
+
+    def _read_cached_header(self, height: int) -> Optional[list]:
+        item = self.header_cache.get(height)
+        if item is None:
+            h = self._read_raw_header(height)
+            if h == bytes([0])*80:
+                return None
+            item = self.header_cache.put(height, deserialize_header(h, height))
+        return item
+
+    def read_raw_header(self, height: int) -> Optional[memoryview]:
+        """Zero-copy view of the 80 bytes of the header at height.
+        The view is only valid until the next write to the branch.
+        Headers still in the write-behind buffer are returned as a copy.
+        """
+        if height < 0:
+            return
+        if height < self.forkpoint:
+            return self.parent().read_raw_header(height)
+        if height > self.height():
+            return
+        with self.lock:
+            return self._read_raw_header(height)
+
+    def _read_raw_header(self, height: int) -> memoryview:
         delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * 80)
-            h = f.read(80)
-            if len(h) < 80:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*80:
-            return None
-        return deserialize_header(h, height)
+        buffered = delta - (self._size - len(self._buffer) // 80)
+        if buffered >= 0:
+            # copy, as exporting the buffer would prevent appending to it
+            return memoryview(bytes(self._buffer[buffered*80:(buffered+1)*80]))
+        file_start = self._file_start()
+        if delta < file_start:
+            return chunk_store.read_header(height)
+        delta -= file_start
+        m = self._get_mmap()
+        h = memoryview(m)[delta*80:(delta+1)*80] if m is not None else b''
+        if len(h) < 80:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        return h
 
     def get_hash(self, height: int) -> str:
         def is_height_checkpoint():
@@ -328,11 +813,16 @@ class Blockchain(util.PrintError):
             index = height // 2016
             h, t, _ = self.checkpoints[index]
             return h
+        elif 0 < height < self.forkpoint:
+            return self.parent().get_hash(height)
         else:
-            header = self.read_header(height)
-            if header is None:
-                raise MissingHeader(height)
-            return hash_header(header)
+            with self.lock:
+                item = self._read_cached_header(height) if 0 < height <= self.height() else None
+                if item is None:
+                    raise MissingHeader(height)
+                if item[1] is None:
+                    item[1] = hash_header(item[0])
+                return item[1]
 
     def get_timestamp(self, height):
         if height < len(self.checkpoints) * 2016 and (height+1) % 2016 == 0:
@@ -350,6 +840,63 @@ class Blockchain(util.PrintError):
         if index < len(self.checkpoints):
             h, t, _ = self.checkpoints[index]
             return t
+        with self.lock:
+            item = self._targets.get(index)
+            if item is not None:
+                return item[1]
+            item = self._unverified_targets.pop(index, None)
+            if item is not None and item[0] == self.get_hash(index * 2016 + 2015):
+                self._targets[index] = item
+                return item[1]
+            target = self.compute_target(index)
+            self._targets[index] = (self.get_hash(index * 2016 + 2015), target)
+            self._targets_changed = True
+            return target
+
+    def update_target(self, index: int) -> None:
+        """Compute the target of a chunk that was just completed, so that
+        can_connect does not have to while following the tip."""
+        if constants.net.TESTNET or index < len(self.checkpoints):
+            return
+        with self.lock:
+            self._targets.pop(index, None)
+            try:
+                self.get_target(index)
+            except MissingHeader:
+                pass
+
+    def invalidate_targets(self, height: int) -> None:
+        """Forget the targets of chunks that end at or above height."""
+        with self.lock:
+            stale = [index for index in list(self._targets) + list(self._unverified_targets)
+                     if index * 2016 + 2015 >= height]
+            if not stale:
+                return
+            for index in stale:
+                self._targets.pop(index, None)
+                self._unverified_targets.pop(index, None)
+            self.save_targets()
+
+    def clear_targets(self) -> None:
+        with self.lock:
+            if not self._targets and not self._unverified_targets:
+                return
+            self._targets = {}
+            self._unverified_targets = {}
+            self.save_targets()
+
+    def flush_targets(self) -> None:
+        with self.lock:
+            if self._targets_changed:
+                self.save_targets()
+
+    def save_targets(self) -> None:
+        targets = dict(self._unverified_targets)
+        targets.update(self._targets)
+        _save_targets(self.config, os.path.basename(self.path()), targets)
+        self._targets_changed = False
+
+    def compute_target(self, index: int) -> int:
         # new target
         # Viacoin: go back the full period unless it's the first retarget
         first_timestamp = self.get_timestamp(index * 2016 - 1 if index > 0 else 0)
@@ -409,10 +956,10 @@ class Blockchain(util.PrintError):
             return False
         return True
 
-    def connect_chunk(self, idx: int, hexdata: str) -> bool:
+    def connect_chunk(self, idx: int, hexdata: str, pow_hashes: Sequence[Optional[str]]=None) -> bool:
         try:
             data = bfh(hexdata)
-            self.verify_chunk(idx, data)
+            self.verify_chunk(idx, data, pow_hashes)
             #self.print_error("validated chunk %d" % idx)
             self.save_chunk(idx, data)
             return True
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Binary checkpoint files.
+#
+# A checkpoint is stored for every chunk of 2016 headers: the hash of the
+# last block of the chunk, the target used in the next chunk, and the
+# timestamp of the last block. The file is a fixed-size header followed
+# by fixed-width records, so that it can be memory-mapped and records
+# decoded only when accessed:
+#
+#   header: magic (8 bytes), version (uint16), record size (uint16),
+#           number of records (uint32), all little-endian
+#   record: block hash (32 bytes, as displayed), target (32 bytes,
+#           big-endian), timestamp (uint32, little-endian)
+
+import os
+import mmap
+import json
+import struct
+import threading
+from collections.abc import Sequence
+
+
+MAGIC = b'VIACHKPT'
+VERSION = 1
+_HEADER = struct.Struct('<8sHHI')
+_RECORD = struct.Struct('<32s32sI')
+
+
+class CheckpointFileError(Exception): pass
+
+
+class Checkpoints(Sequence):
+    """Read-only sequence of (block_hash, target, timestamp) tuples,
+    backed by a memory-mapped checkpoint file. The file is only opened
+    on first access; a missing file behaves as an empty sequence.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._map = None
+        self._count = None
+
+    def _load(self):
+        with self._lock:
+            if self._count is not None:
+                return
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                self._count = 0
+                return
+            with open(self.path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(m) < _HEADER.size:
+                raise CheckpointFileError('truncated checkpoint file: {}'.format(self.path))
+            magic, version, record_size, count = _HEADER.unpack_from(m, 0)
+            if magic != MAGIC:
+                raise CheckpointFileError('not a checkpoint file: {}'.format(self.path))
+            if version != VERSION or record_size != _RECORD.size:
+                raise CheckpointFileError('unsupported checkpoint file version {}: {}'.format(version, self.path))
+            if len(m) < _HEADER.size + count * record_size:
+                raise CheckpointFileError('truncated checkpoint file: {}'.format(self.path))
+            self._map = m
+            self._count = count
+
+    def __len__(self):
+        if self._count is None:
+            self._load()
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('checkpoint index out of range')
+        block_hash, target, timestamp = _RECORD.unpack_from(self._map, _HEADER.size + index * _RECORD.size)
+        return block_hash.hex(), int.from_bytes(target, 'big'), timestamp
+
+
+def serialize_checkpoints(checkpoints) -> bytes:
+    checkpoints = list(checkpoints)
+    out = [_HEADER.pack(MAGIC, VERSION, _RECORD.size, len(checkpoints))]
+    for block_hash, target, timestamp in checkpoints:
+        out.append(_RECORD.pack(bytes.fromhex(block_hash), int(target).to_bytes(32, 'big'), int(timestamp)))
+    return b''.join(out)
+
+
+def write_checkpoints(path, checkpoints) -> None:
+    """Write (block_hash, target, timestamp) triples to a binary checkpoint file."""
+    data = serialize_checkpoints(checkpoints)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_checkpoints(filename) -> Checkpoints:
+    """Checkpoints for a file shipped next to this module."""
+    return Checkpoints(os.path.join(os.path.dirname(__file__), filename))
+
+
+if __name__ == '__main__':
+    # convert between the json and the binary format, e.g.
+    # python3 -m vialectrum.checkpoints checkpoints.json checkpoints.bin
+    import sys
+    src, dst = sys.argv[1:3]
+    if src.endswith('.json'):
+        with open(src, 'r') as f:
+            write_checkpoints(dst, json.load(f))
+    else:
+        with open(dst, 'w') as f:
+            f.write(json.dumps([list(cp) for cp in Checkpoints(os.path.abspath(src))], indent=4))
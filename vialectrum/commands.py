@@ -258,6 +258,17 @@ class Commands:
         tx = Transaction(tx)
         return self.network.broadcast_transaction_from_non_network_thread(tx)
 
+    @command('n')
+    def broadcast_many(self, txs, timeout=10):
+        """Broadcast several transactions to the network, e.g. a payout run.
+        Transactions that cannot be sent because we are offline are queued,
+        and broadcast once we are connected again."""
+        txs = [Transaction(tx_from_str(tx) if isinstance(tx, str) else tx['hex']) for tx in txs]
+        results = self.network.broadcast_transactions_from_non_network_thread(txs, timeout=timeout)
+        return [{'txid': tx.txid(), 'success': r.success, 'msg': r.msg,
+                 'servers': r.outcomes, 'queued': r.queued}
+                for tx, r in zip(txs, results)]
+
     @command('')
     def createmultisig(self, num, pubkeys):
         """Create multisig address"""
@@ -391,7 +402,11 @@ class Commands:
         privkeys = privkey.split()
         self.nocheck = nocheck
         #dest = self._resolver(destination)
-        tx = sweep(privkeys, self.network, self.config, destination, tx_fee, imax)
+        found = []
+        def on_inputs(inputs):
+            found.extend(inputs)
+            print_error("sweep: found {} inputs, {} satoshis".format(len(found), sum(i['value'] for i in found)))
+        tx = sweep(privkeys, self.network, self.config, destination, tx_fee, imax, on_inputs)
         return tx.as_dict() if tx else None
 
     @command('wp')
@@ -690,6 +705,7 @@ param_descriptions = {
     'pos': 'Position',
     'height': 'Block height',
     'tx': 'Serialized transaction (hexadecimal)',
+    'txs': 'List of serialized transactions (hexadecimal)',
     'key': 'Variable name',
     'pubkey': 'Public key',
     'message': 'Clear text message. Use quotes if it contains spaces.',
@@ -748,12 +764,14 @@ arg_types = {
     'year': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
+    'txs': json_loads,
     'jsontx': json_loads,
     'inputs': json_loads,
     'outputs': json_loads,
     'fee': lambda x: str(Decimal(x)) if x is not None else None,
     'amount': lambda x: str(Decimal(x)) if x != '!' else '!',
     'locktime': int,
+    'timeout': float,
     'fee_method': str,
     'fee_level': json_loads,
 }
@@ -26,6 +26,8 @@
 import os
 import json
 
+from .checkpoints import read_checkpoints
+
 
 def read_json(filename, default):
     path = os.path.join(os.path.dirname(__file__), filename)
@@ -54,7 +56,7 @@ class BitcoinMainnet(AbstractNet):
     GENESIS = "4e9b54001f9976049830128ec0331515eaabe35a70970d79971da1539a400ba1"
     DEFAULT_PORTS = {'t': '50001', 's': '50002'}
     DEFAULT_SERVERS = read_json('servers.json', {})
-    CHECKPOINTS = read_json('checkpoints.json', [])
+    CHECKPOINTS = read_checkpoints('checkpoints.bin')
 
     XPRV_HEADERS = {
         'standard':    0x0488ade4,  # xprv
@@ -83,7 +85,7 @@ class BitcoinTestnet(AbstractNet):
     GENESIS = "770aa712aa08fdcbdecc1c8df1b3e2d4e17a7cf6e63a28b785b32e74c96cb27d"
     DEFAULT_PORTS = {'t': '51001', 's': '51002'}
     DEFAULT_SERVERS = read_json('servers_testnet.json', {})
-    CHECKPOINTS = read_json('checkpoints_testnet.json', [])
+    CHECKPOINTS = read_checkpoints('checkpoints_testnet.bin')
 
     XPRV_HEADERS = {
         'standard':    0x04358394,  # tprv
@@ -34,6 +34,7 @@ import jsonrpclib
 from .jsonrpc import VerifyingJSONRPCServer
 
 from .version import ELECTRUM_VERSION
+from . import blockchain
 from .network import Network
 from .util import json_decode, DaemonThread
 from .util import print_error, to_string
@@ -204,6 +205,9 @@ class Daemon(DaemonThread):
                                 for k, w in self.wallets.items()},
                     'current_wallet': current_wallet_path,
                     'fee_per_kb': self.config.fee_per_kb(),
+                    'shared_requests': self.network.multiplexer.get_stats(),
+                    'header_cache': blockchain.get_header_cache_stats(),
+                    'loop_wakeups': self.get_loop_wakeups(),
                 }
             else:
                 response = "Daemon offline"
@@ -212,6 +216,14 @@ class Daemon(DaemonThread):
             response = "Daemon stopped"
         return response
 
+    def get_loop_wakeups(self):
+        # how often the event loops of the network and wallets ran, to check their idle cost
+        wallets = {}
+        for k, w in self.wallets.items():
+            wallets[k] = {'synchronizer': w.synchronizer.wakeups if w.synchronizer else 0,
+                          'verifier': w.verifier.wakeups if w.verifier else 0}
+        return {'network': self.network.maintain_wakeups, 'wallets': wallets}
+
     def run_gui(self, config_options):
         config = SimpleConfig(config_options)
         if self.gui:
@@ -231,7 +243,8 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
-        storage = WalletStorage(path, manual_upgrades=True)
+        storage = WalletStorage(path, manual_upgrades=True,
+                                journal=self.config.get('wallet_journal', False))
         if not storage.file_exists():
             return
         if storage.is_encrypted():
@@ -990,6 +990,8 @@ class ElectrumWindow(App):
                 return
         self.stop_wallet()
         os.unlink(wallet_path)
+        if os.path.exists(wallet_path + '.journal'):
+            os.unlink(wallet_path + '.journal')
         self.show_error(_("Wallet removed: {}").format(basename))
         new_path = self.electrum_config.get_wallet_path()
         self.load_wallet_by_name(new_path)
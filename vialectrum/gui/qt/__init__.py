@@ -215,7 +215,8 @@ class ElectrumGui:
             else:
                 return
         if not wallet:
-            storage = WalletStorage(path, manual_upgrades=True)
+            storage = WalletStorage(path, manual_upgrades=True,
+                                    journal=self.config.get('wallet_journal', False))
             wizard = InstallWizard(self.config, self.app, self.plugins, storage)
             try:
                 wallet = wizard.run_and_get_wallet(self.daemon.get_wallet)
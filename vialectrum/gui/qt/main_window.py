@@ -429,6 +429,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
+                # the copy must not depend on the journal of the wallet
+                self.wallet.storage.write(compact=True)
                 shutil.copy2(path, new_path)
                 self.show_message(_("A copy of your wallet file was created in")+" '%s'" % str(new_path), title=_("Wallet backup created"))
             except BaseException as reason:
@@ -2108,6 +2110,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         self.gui_object.daemon.stop_wallet(wallet_path)
         self.close()
         os.unlink(wallet_path)
+        if os.path.exists(wallet_path + '.journal'):
+            os.unlink(wallet_path + '.journal')
         self.show_error(_("Wallet removed: {}").format(basename))
 
     @protected
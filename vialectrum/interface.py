@@ -26,8 +26,10 @@ import os
 import re
 import ssl
 import sys
+import time
 import traceback
 import asyncio
+from collections import deque
 from typing import Tuple, Union
 
 import aiorpcx
@@ -42,12 +44,28 @@ from . import blockchain
 from . import constants
 
 
+# JSON-RPC batching of requests, see NotificationSession.send_request
+RPC_BATCH_SIZE = 50
+RPC_BATCH_WINDOW = 0.005  # seconds
+
+
 class NotificationSession(ClientSession):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, max_batch_size=1, batch_window=RPC_BATCH_WINDOW, **kwargs):
         super(NotificationSession, self).__init__(*args, **kwargs)
         self.subscriptions = {}
         self.cache = {}
+        # requests issued within batch_window of each other are sent
+        # together, as one JSON-RPC batch of at most max_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self._pending_requests = []  # (method, params, future)
+        self._flush_handle = None
+        self._batch_tasks = set()
+        self.requests_sent = 0
+        self.frames_sent = 0
+        # called with (seconds, failed) when a request gets a response or times out
+        self.response_callback = None
 
     async def handle_request(self, request):
         # note: if server sends malformed request and we raise, the superclass
@@ -65,9 +83,76 @@ class NotificationSession(ClientSession):
     async def send_request(self, *args, timeout=-1, **kwargs):
         if timeout == -1:
             timeout = 20 if not self.proxy else 30
-        return await asyncio.wait_for(
-            super().send_request(*args, **kwargs),
-            timeout)
+        t0 = time.monotonic()
+        try:
+            result = await asyncio.wait_for(
+                self._send_request(*args, **kwargs),
+                timeout)
+        except asyncio.TimeoutError:
+            if self.response_callback:
+                self.response_callback(time.monotonic() - t0, True)
+            raise
+        if self.response_callback:
+            self.response_callback(time.monotonic() - t0, False)
+        return result
+
+    async def _send_request(self, method, args=()):
+        self.requests_sent += 1
+        if self.max_batch_size <= 1:
+            self.frames_sent += 1
+            return await super().send_request(method, args)
+        fut = asyncio.get_event_loop().create_future()
+        self._pending_requests.append((method, args, fut))
+        if len(self._pending_requests) >= self.max_batch_size:
+            self.flush_requests()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.batch_window, self.flush_requests)
+        return await fut
+
+    def flush_requests(self):
+        """Send the requests waiting to be batched."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # requests that timed out while waiting are dropped
+        requests = [r for r in self._pending_requests if not r[2].done()]
+        self._pending_requests = []
+        if not requests:
+            return
+        self.frames_sent += 1
+        task = asyncio.ensure_future(self._send_batch(requests))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_batch(self, requests):
+        try:
+            if len(requests) == 1:
+                method, args, _ = requests[0]
+                try:
+                    results = [await super().send_request(method, args)]
+                except aiorpcx.jsonrpc.RPCError as e:
+                    results = [e]
+            else:
+                async with self.send_batch() as batch:
+                    for method, args, _ in requests:
+                        batch.add_request(method, args)
+                results = batch.results
+        except asyncio.CancelledError:
+            for _, _, fut in requests:
+                fut.cancel()
+            raise
+        except Exception as e:
+            for _, _, fut in requests:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, _, fut), result in zip(requests, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
 
     async def subscribe(self, method, params, queue):
         key = self.get_index(method, params)
@@ -120,6 +205,10 @@ def serialize_server(host: str, port: Union[str, int], protocol: str) -> str:
     return str(':'.join([host, str(port), protocol]))
 
 
+# number of chunk requests kept in flight during catch-up, see Interface.request_chunks
+CHUNK_REQUEST_WINDOW = 4
+
+
 class Interface(PrintError):
 
     def __init__(self, network, server, config_path, proxy):
@@ -293,12 +382,109 @@ class Interface(PrintError):
         self.print_error("requesting chunk from height {}".format(start_height))
         return await self.network.request_chunk(start_height, tip, self.session)
 
+    async def fetch_chunk(self, session, index, tip):
+        """Download a chunk and compute its PoW hashes, without connecting it."""
+        size = 2016
+        if tip is not None:
+            size = max(0, min(size, tip - index * 2016))
+        # like Network.request_chunk, so that the chunk is not requested again
+        self.network.requested_chunks.add(index)
+        try:
+            res = await session.send_request('blockchain.block.headers', [index * 2016, size])
+        finally:
+            self.network.requested_chunks.discard(index)
+        data = bfh(res['hex'])
+        # hashing does not depend on the chain, so it can overlap with other requests
+        loop = asyncio.get_event_loop()
+        executor = blockchain.get_pow_executor(self.network.config)
+        pow_hashes = await loop.run_in_executor(None, blockchain.pow_hash_chunks, [data], executor)
+        return res['hex'], pow_hashes[0], res['count']
+
+    def get_chunk_sessions(self, tip):
+        """Sessions of the interfaces that can serve headers up to tip, own first."""
+        sessions = [self.session]
+        with self.network.interface_lock:
+            interfaces = list(self.network.interfaces.values())
+        for interface in interfaces:
+            if interface is self or interface.tip < tip:
+                continue
+            session = interface.session
+            if session is not None and not session.is_closing() and interface.ready.done():
+                sessions.append(session)
+        return sessions
+
+    async def request_chunks(self, start_height, tip):
+        """Like request_chunk, for all chunks from start_height up to tip.
+        Up to 'chunk_request_window' requests are kept in flight, spread over
+        the connected interfaces, and PoW hashes are computed as responses
+        arrive. Chunks are still connected one at a time, in order; a chunk
+        from another server that does not connect is requested again from
+        ours, as it might be on a different branch.
+        Returns whether the first chunk connected, and the number of headers
+        connected from the start of that chunk.
+        """
+        window = max(1, self.network.config.get('chunk_request_window', CHUNK_REQUEST_WINDOW))
+        first_index = start_height // 2016
+        indexes = iter(range(first_index, (tip - 1) // 2016 + 1))
+        sessions = self.get_chunk_sessions(tip)
+        pending = deque()
+
+        def schedule():
+            while len(pending) < window:
+                index = next(indexes, None)
+                if index is None:
+                    return
+                session = sessions[(index - first_index) % len(sessions)]
+                fut = asyncio.ensure_future(self.fetch_chunk(session, index, tip))
+                pending.append((index, session, fut))
+
+        num_headers = 0
+        try:
+            schedule()
+            while pending:
+                index, session, fut = pending.popleft()
+                self.print_error("requesting chunk from height {}".format(index * 2016))
+                # waiting does not raise, so that the cancellation of a request
+                # to another server (e.g. its session closed) is told apart from ours
+                await asyncio.wait([fut])
+                try:
+                    hexdata, pow_hashes, count = fut.result()
+                except (Exception, asyncio.CancelledError) as e:
+                    if session is self.session:
+                        raise
+                    self.print_error("chunk {} from other server failed: {!r}".format(index, e))
+                    hexdata = None
+                conn = hexdata is not None and self.network.blockchain().connect_chunk(index, hexdata, pow_hashes)
+                if not conn and session is not self.session:
+                    hexdata, pow_hashes, count = await self.fetch_chunk(self.session, index, tip)
+                    conn = self.network.blockchain().connect_chunk(index, hexdata, pow_hashes)
+                if not conn:
+                    return num_headers > 0, num_headers
+                num_headers += count
+                self.network.notify('updated')
+                if count < 2016:
+                    break
+                schedule()
+        finally:
+            for _, _, fut in pending:
+                if fut.done() and not fut.cancelled():
+                    fut.exception()  # retrieved, so that it is not logged
+                fut.cancel()
+        return True, num_headers
+
     async def open_session(self, sslc, exit_early):
         header_queue = asyncio.Queue()
-        self.session = NotificationSession(self.host, self.port, ssl=sslc, proxy=self.proxy)
+        config = self.network.config
+        self.session = NotificationSession(self.host, self.port, ssl=sslc, proxy=self.proxy,
+                                           max_batch_size=config.get('rpc_batch_size', RPC_BATCH_SIZE),
+                                           batch_window=config.get('rpc_batch_window', RPC_BATCH_WINDOW))
+        scores = self.network.server_scores
+        self.session.response_callback = lambda seconds, failed: scores.record_response(self.server, seconds, failed)
         async with self.session as session:
             try:
+                t0 = time.monotonic()
                 ver = await session.send_request('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])
+                scores.record_rtt(self.server, time.monotonic() - t0)
             except aiorpcx.jsonrpc.RPCError as e:
                 raise GracefulDisconnect(e)  # probably 'unsupported protocol version'
             if exit_early:
@@ -321,7 +507,9 @@ class Interface(PrintError):
     async def ping(self):
         while True:
             await asyncio.sleep(300)
+            t0 = time.monotonic()
             await self.session.send_request('server.ping')
+            self.network.server_scores.record_rtt(self.server, time.monotonic() - t0)
 
     def close(self):
         self.fut.cancel()
@@ -336,6 +524,7 @@ class Interface(PrintError):
             header = blockchain.deserialize_header(bfh(raw_header['hex']), height)
             self.tip_header = header
             self.tip = height
+            self.network.server_scores.record_lag(self.server, self.network.get_local_height() - height)
             if self.tip < constants.net.max_checkpoint():
                 raise GracefulDisconnect('server tip below max checkpoint')
             if not self.ready.done():
@@ -357,7 +546,10 @@ class Interface(PrintError):
         last = None
         while last is None or height < next_height:
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                if next_height - height > 2016:
+                    could_connect, num_headers = await self.request_chunks(height, next_height)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
                         raise Exception('server chain conflicts with checkpoints or genesis')
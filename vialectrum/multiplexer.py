@@ -0,0 +1,102 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+from collections import OrderedDict
+
+from .util import PrintError
+from .transaction import Transaction
+
+
+def _is_requested_tx(params, result):
+    try:
+        return Transaction(result).txid() == params[0]
+    except Exception:
+        return False
+
+
+# results that never change, and can be kept for other wallets,
+# once checked: method -> function(params, result) -> bool
+IMMUTABLE_METHODS = {'blockchain.transaction.get': _is_requested_tx}
+
+RESULT_CACHE_SIZE = 1000
+
+
+class RequestMultiplexer(PrintError):
+    """Shares requests between the wallets of a network (e.g. in a daemon).
+
+    Scripthash subscriptions are already shared by the session, which fans
+    notifications out to the queue of every subscribed wallet. When
+    wallets overlap, they then ask for the same histories, transactions
+    and proofs at about the same time: identical requests in flight are
+    sent only once, and their result is given to every caller. Results of
+    IMMUTABLE_METHODS are also kept in a small LRU cache.
+    """
+
+    def __init__(self, cache_size=RESULT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._in_flight = {}  # (id of session, key) -> task
+        self._results = OrderedDict()  # key -> result, for IMMUTABLE_METHODS
+        self.requests = 0
+        self.sent = 0
+
+    async def send_request(self, session, method, params, tag=None):
+        """Like session.send_request. Requests with a different tag are not
+        shared, e.g. a history request is only shared between wallets
+        expecting the same status. Requests are only shared on the same
+        session, so that a caller never gets the answer of a server we
+        switched away from; cached results do not depend on the server.
+        """
+        self.requests += 1
+        key = session.get_index(method, params) + ('' if tag is None else repr(tag))
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+        flight_key = (id(session), key)
+        task = self._in_flight.get(flight_key)
+        if task is None:
+            self.sent += 1
+            task = asyncio.ensure_future(session.send_request(method, params))
+            self._in_flight[flight_key] = task
+            task.add_done_callback(lambda t: self._on_done(flight_key, method, params, t))
+        # a caller being cancelled must not cancel the request of the others
+        return await asyncio.shield(task)
+
+    def _on_done(self, flight_key, method, params, task):
+        self._in_flight.pop(flight_key, None)
+        key = flight_key[1]
+        if task.cancelled() or task.exception() is not None:
+            return
+        check = IMMUTABLE_METHODS.get(method)
+        if check and self.cache_size > 0:
+            if not check(params, task.result()):
+                # a wrong reply of one server must not be served to every wallet
+                self.print_error("not caching invalid result of", method, params)
+                return
+            self._results[key] = task.result()
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+
+    def get_stats(self):
+        return {'requests': self.requests, 'sent': self.sent,
+                'in_flight': len(self._in_flight), 'cached': len(self._results)}
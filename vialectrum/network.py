@@ -36,19 +36,43 @@ from typing import NamedTuple, Optional
 
 import dns
 import dns.resolver
+import aiorpcx
 from aiorpcx import TaskGroup
 
 from . import util
-from .util import PrintError, print_error, aiosafe, bfh
+from .util import PrintError, print_error, aiosafe, bfh, TimeoutException
 from .bitcoin import COIN
 from . import constants
 from . import blockchain
 from .interface import Interface, serialize_server, deserialize_server
+from .multiplexer import RequestMultiplexer, RESULT_CACHE_SIZE
+from .txstore import TxStore, TX_STORE_MAX_SIZE
+from .server_scores import ServerScores
+from .transaction import Transaction
+from .checkpoints import write_checkpoints
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# with auto_connect, switch away from the main server at most this often,
+# and only if another connected server scores this many times better
+SERVER_SWITCH_INTERVAL = 120
+SERVER_SWITCH_RATIO = 3
+# maintain_sessions runs when woken up, see Network.wakeup, and at least
+# this often for its timed work (retries, fee estimates, header flushes)
+MAINTAIN_INTERVAL = 5
+# transactions are broadcast to the main server and to this many other
+# connected servers, see Network.broadcast_transaction_to_servers. Sending
+# them to more servers ('broadcast_servers' in the config) may propagate
+# them faster, but reveals them to more servers
+BROADCAST_EXTRA_SERVERS = 0
+# how often queued broadcasts are retried while connected
+BROADCAST_RETRY_INTERVAL = 30
+# maximum number of transactions requested at once by get_transactions
+TX_PREFETCH_CONCURRENCY = 20
+# maximum number of listunspent requests in flight, see listunspent_for_scripthashes
+LISTUNSPENT_CONCURRENCY = 50
 
 
 def parse_servers(result):
@@ -114,6 +138,12 @@ NetworkParameters = NamedTuple("NetworkParameters", [("host", str),
                                                      ("proxy", Optional[dict]),
                                                      ("auto_connect", bool)])
 
+# outcomes: server -> response, or error message
+BroadcastResult = NamedTuple("BroadcastResult", [("success", bool),
+                                                 ("msg", str),
+                                                 ("outcomes", dict),
+                                                 ("queued", bool)])
+
 
 proxy_modes = ['socks4', 'socks5']
 
@@ -182,6 +212,9 @@ class Network(PrintError):
         self.blockchain_index = config.get('blockchain_index', 0)
         if self.blockchain_index not in blockchain.blockchains.keys():
             self.blockchain_index = 0
+        # latency and reliability of the servers we have used
+        self.server_scores = ServerScores(os.path.join(self.config.path, 'server_scores')
+                                          if self.config.path else None)
         # Server for addresses and transactions
         self.default_server = self.config.get('server', None)
         # Sanitize default server
@@ -192,7 +225,7 @@ class Network(PrintError):
                 self.print_error('Warning: failed to parse server-string; falling back to random.')
                 self.default_server = None
         if not self.default_server:
-            self.default_server = pick_random_server()
+            self.default_server = self.server_scores.pick(filter_protocol(constants.net.DEFAULT_SERVERS))
 
         # locks: if you need to take multiple ones, acquire them in the order they are defined here!
         self.bhi_lock = asyncio.Lock()
@@ -203,6 +236,10 @@ class Network(PrintError):
 
         self.irc_servers = {}  # returned by interface (list from irc)
         self.recent_servers = self.read_recent_servers()  # note: needs self.recent_servers_lock
+        # txid -> raw tx, broadcasts to retry once we are back online
+        self.broadcast_queue_lock = threading.Lock()
+        self.broadcast_queue = self.read_broadcast_queue()  # note: needs self.broadcast_queue_lock
+        self.broadcast_retry_time = 0
 
         self.banner = ''
         self.donation_address = ''
@@ -216,6 +253,7 @@ class Network(PrintError):
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
+        self.server_switch_time = time.time()
         # kick off the network.  interface is the main server we are currently
         # communicating with.  interfaces is the set of servers we are connecting
         # to or have an ongoing connection with
@@ -224,6 +262,14 @@ class Network(PrintError):
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
         self.requested_chunks = set()
+        self._maintain_event = None
+        self.maintain_wakeups = 0
+        self.multiplexer = RequestMultiplexer(self.config.get('shared_result_cache_size', RESULT_CACHE_SIZE))
+        # raw transactions shared by all wallets, on disk
+        self.tx_store = None
+        if self.config.get('tx_store', False):
+            self.tx_store = TxStore(os.path.join(self.config.path, 'tx_store'),
+                                    self.config.get('tx_store_max_size', TX_STORE_MAX_SIZE))
         self.socket_queue = queue.Queue()
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
@@ -277,6 +323,28 @@ class Network(PrintError):
         except:
             return []
 
+    def read_broadcast_queue(self):
+        if not self.config.path:
+            return {}
+        path = os.path.join(self.config.path, "broadcast_queue")
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                return json.loads(f.read())
+        except:
+            return {}
+
+    def save_broadcast_queue(self):
+        if not self.config.path:
+            return
+        path = os.path.join(self.config.path, "broadcast_queue")
+        with self.broadcast_queue_lock:
+            s = json.dumps(self.broadcast_queue, indent=4, sort_keys=True)
+        try:
+            with open(path, "w", encoding='utf-8') as f:
+                f.write(s)
+        except:
+            pass
+
     @with_recent_servers_lock
     def save_recent_servers(self):
         if not self.config.path:
@@ -404,11 +472,13 @@ class Network(PrintError):
                 self.set_status('connecting')
             self.connecting.add(server)
             self.socket_queue.put(server)
+            self.wakeup()
 
     def start_random_interface(self):
         with self.interface_lock:
             exclude_set = self.disconnected_servers.union(set(self.interfaces))
-        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        eligible = set(filter_protocol(self.get_servers(), self.protocol)) - exclude_set
+        server = self.server_scores.pick(eligible)
         if server:
             self.start_interface(server)
         return server
@@ -514,14 +584,15 @@ class Network(PrintError):
         else:
             self.switch_lagging_interface()
             self.notify('updated')
+        self.wakeup()
 
     def switch_to_random_interface(self):
-        '''Switch to a random connected server other than the current one'''
+        '''Switch to the best scored connected server other than the current one'''
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            self.switch_to_interface(random.choice(servers))
+            self.switch_to_interface(self.server_scores.best(servers))
 
     @with_interface_lock
     def switch_lagging_interface(self):
@@ -536,9 +607,30 @@ class Network(PrintError):
                 return a == b
             filtered = list(map(lambda x: x[0], filter(filt, self.interfaces.items())))
             if filtered:
-                choice = random.choice(filtered)
+                choice = self.server_scores.best(filtered)
                 self.switch_to_interface(choice)
 
+    @with_interface_lock
+    def switch_slow_interface(self):
+        '''If auto_connect, switch to a connected server that scores much
+        better than the current one, follows the same chain and is not
+        behind it'''
+        if not self.auto_connect or not self.is_connected():
+            return
+        chain = self.blockchain()
+        tip = self.interface.tip
+        servers = [s for s, i in self.interfaces.items()
+                   if s != self.default_server and i.blockchain is chain and i.tip >= tip]
+        best = self.server_scores.best(servers)
+        if best is None:
+            return
+        current_score = self.server_scores.get_score(self.default_server)
+        best_score = self.server_scores.get_score(best)
+        if best_score * SERVER_SWITCH_RATIO < current_score:
+            self.print_error('%s scores %d, switching to %s (%d)'
+                             % (self.default_server, current_score, best, best_score))
+            self.switch_to_interface(best)
+
     @with_interface_lock
     def switch_to_interface(self, server):
         '''Switch to server as our interface.  If no connection exists nor
@@ -598,6 +690,7 @@ class Network(PrintError):
         if server == self.default_server:
             self.set_status('disconnected')
         if server in self.interfaces:
+            self.server_scores.record_disconnect(server)
             self.close_interface(self.interfaces[server])
             self.notify('interfaces')
 
@@ -607,6 +700,8 @@ class Network(PrintError):
         self.add_recent_server(server)
 
         interface = Interface(self, server, self.config.path, self.proxy)
+        # the interface died: maintain_sessions will remove it
+        interface.fut.add_done_callback(lambda fut: self.wakeup())
         timeout = 10 if not self.proxy else 20
         try:
             await asyncio.wait_for(interface.ready, timeout)
@@ -614,12 +709,15 @@ class Network(PrintError):
             #import traceback
             #traceback.print_exc()
             self.print_error(interface.server, "couldn't launch because", str(e), str(type(e)))
+            self.server_scores.record_connection(server, False)
             self.connection_down(interface.server)
             return
         finally:
             try: self.connecting.remove(server)
             except KeyError: pass
+            self.wakeup()
 
+        self.server_scores.record_connection(server, True)
         with self.interface_lock:
             self.interfaces[server] = interface
 
@@ -632,7 +730,11 @@ class Network(PrintError):
         b = blockchain.blockchains[0]
         filename = b.path()
         length = 80 * len(constants.net.CHECKPOINTS) * 2016
-        if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        if blockchain.chunk_store is not None:
+            # sparse mode: checkpointed chunks are only fetched when needed
+            if not os.path.exists(filename):
+                open(filename, 'wb').close()
+        elif not os.path.exists(filename) or os.path.getsize(filename) < length:
             with open(filename, 'wb') as f:
                 if length>0:
                     f.seek(length-1)
@@ -641,7 +743,119 @@ class Network(PrintError):
             b.update_size()
 
     async def get_merkle_for_transaction(self, tx_hash, tx_height):
-        return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
+        return await self.multiplexer.send_request(self.interface.session, 'blockchain.transaction.get_merkle',
+                                                   [tx_hash, tx_height])
+
+    def get_transaction(self, tx_hash, timeout=10):
+        """Raw transaction from the tx store, or else from the server.
+        None if it is unknown, or if the server sent another transaction.
+        note: calling this from the network thread will deadlock it"""
+        if self.tx_store:
+            raw = self.tx_store.get(tx_hash)
+            if raw:
+                return raw
+        if self.interface is None:
+            return None
+        coro = self.multiplexer.send_request(self.interface.session, 'blockchain.transaction.get', [tx_hash])
+        fut = asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout), self.asyncio_loop)
+        try:
+            raw = fut.result()
+        except asyncio.TimeoutError as e:
+            raise TimeoutException('getting transaction {} timed out'.format(tx_hash)) from e
+        try:
+            tx = Transaction(raw)
+            txid = tx.txid()
+        except Exception as e:
+            self.print_error("cannot deserialize received transaction", tx_hash, repr(e))
+            return None
+        if txid != tx_hash:
+            self.print_error("received tx does not match expected txid", tx_hash)
+            return None
+        self.store_transaction(tx)
+        return raw
+
+    def get_transactions(self, tx_hashes, timeout=10):
+        """Raw transactions by txid, fetched concurrently. Those that could
+        not be fetched within timeout are left out.
+        note: calling this from the network thread will deadlock it"""
+        results = {}
+        missing = []
+        for tx_hash in set(tx_hashes):
+            raw = self.tx_store.get(tx_hash) if self.tx_store else None
+            if raw:
+                results[tx_hash] = raw
+            else:
+                missing.append(tx_hash)
+        if missing and self.interface is not None:
+            coro = self._get_transactions(self.interface.session, missing, timeout)
+            results.update(asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result())
+        return results
+
+    async def _get_transactions(self, session, tx_hashes, timeout):
+        # the requests are batched by the session
+        semaphore = asyncio.Semaphore(self.config.get('tx_prefetch_concurrency', TX_PREFETCH_CONCURRENCY))
+        results = {}
+        async def fetch(tx_hash):
+            async with semaphore:
+                raw = await self.multiplexer.send_request(session, 'blockchain.transaction.get', [tx_hash])
+            tx = Transaction(raw)
+            if tx.txid() != tx_hash:
+                self.print_error("received tx does not match expected txid", tx_hash)
+                return
+            self.store_transaction(tx)
+            results[tx_hash] = raw
+        tasks = [asyncio.ensure_future(fetch(tx_hash)) for tx_hash in tx_hashes]
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() is not None:
+                self.print_error("could not fetch transaction:", repr(task.exception()))
+        if pending:
+            self.print_error("fetching {} transactions timed out".format(len(pending)))
+        return results
+
+    def store_transaction(self, tx):
+        """Add a transaction whose txid has been checked to the tx store."""
+        if self.tx_store:
+            self.tx_store.put(tx.txid(), tx.raw)
+
+    def listunspent_for_scripthash(self, scripthash, timeout=10):
+        # note: calling this from the network thread will deadlock it
+        return self.listunspent_for_scripthashes([scripthash], timeout)[scripthash]
+
+    def listunspent_for_scripthashes(self, scripthashes, timeout=10, callback=None):
+        """Unspent outputs by scripthash, requested concurrently.
+        callback(scripthash, utxos) is called from the network thread as
+        each result arrives. Raises if any request fails or takes longer
+        than timeout.
+        note: calling this from the network thread will deadlock it"""
+        if self.interface is None:
+            raise Exception('not connected')
+        coro = self._listunspent_for_scripthashes(self.interface.session, scripthashes, timeout, callback)
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result()
+
+    async def _listunspent_for_scripthashes(self, session, scripthashes, timeout, callback=None):
+        # the requests are batched by the session
+        semaphore = asyncio.Semaphore(self.config.get('listunspent_concurrency', LISTUNSPENT_CONCURRENCY))
+        results = {}
+        async def fetch(scripthash):
+            async with semaphore:
+                coro = session.send_request('blockchain.scripthash.listunspent', [scripthash])
+                try:
+                    utxos = await asyncio.wait_for(coro, timeout)
+                except asyncio.TimeoutError as e:
+                    raise TimeoutException('listunspent for {} timed out'.format(scripthash)) from e
+            results[scripthash] = utxos
+            if callback:
+                callback(scripthash, utxos)
+        tasks = [asyncio.ensure_future(fetch(scripthash)) for scripthash in set(scripthashes)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return results
 
     def broadcast_transaction_from_non_network_thread(self, tx, timeout=10):
         # note: calling this from the network thread will deadlock it
@@ -649,16 +863,120 @@ class Network(PrintError):
         return fut.result()
 
     async def broadcast_transaction(self, tx, timeout=10):
+        result = await self.broadcast_transaction_to_servers(tx, timeout=timeout)
+        return result.success, result.msg
+
+    def get_broadcast_interfaces(self):
+        """The main interface, and the best scored other ready ones."""
+        with self.interface_lock:
+            main = self.interface
+            others = [i for i in self.interfaces.values()
+                      if i is not main and i.ready.done() and i.session is not None]
+        others.sort(key=lambda i: self.server_scores.get_score(i.server))
+        num_extra = self.config.get('broadcast_servers', BROADCAST_EXTRA_SERVERS)
+        interfaces = others[:num_extra]
+        if main is not None and main.session is not None:
+            interfaces.insert(0, main)
+        return interfaces
+
+    async def _broadcast_to_session(self, session, tx, timeout):
+        """Returns (success, msg, whether the server responded)."""
         try:
-            out = await self.interface.session.send_request('blockchain.transaction.broadcast', [str(tx)], timeout=timeout)
+            out = await session.send_request('blockchain.transaction.broadcast', [str(tx)], timeout=timeout)
         except asyncio.TimeoutError as e:
-            return False, "error: operation timed out"
+            return False, "error: operation timed out", False
+        except aiorpcx.jsonrpc.RPCError as e:
+            return False, "error: " + str(e), True
         except Exception as e:
-            return False, "error: " + str(e)
-
+            return False, "error: " + str(e), False
         if out != tx.txid():
-            return False, "error: " + out
-        return True, out
+            return False, "error: " + out, True
+        return True, out, True
+
+    async def broadcast_transaction_to_servers(self, tx, timeout=10, queue_if_offline=False):
+        """Sends tx concurrently to the interfaces of get_broadcast_interfaces,
+        and returns on the first success. Outcomes of the servers that had
+        not responded yet are added as they arrive.
+
+        If no server responded and queue_if_offline is set, tx is queued,
+        and broadcast again once we are connected.
+        """
+        interfaces = self.get_broadcast_interfaces()
+        outcomes = {}
+        responded = False
+        if len(interfaces) == 1:
+            # the default, see BROADCAST_EXTRA_SERVERS
+            success, msg, responded = await self._broadcast_to_session(interfaces[0].session, tx, timeout)
+            outcomes[interfaces[0].server] = msg
+            if success:
+                return BroadcastResult(True, msg, outcomes, False)
+        else:
+            tasks = {}
+            for interface in interfaces:
+                task = asyncio.ensure_future(self._broadcast_to_session(interface.session, tx, timeout))
+                tasks[task] = interface.server
+            def add_outcome(task):
+                if not task.cancelled():
+                    outcomes[tasks[task]] = task.result()[1]
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    success, msg, server_responded = task.result()
+                    outcomes[tasks[task]] = msg
+                    responded |= server_responded
+                    if success:
+                        for t in pending:
+                            t.add_done_callback(add_outcome)
+                        return BroadcastResult(True, msg, outcomes, False)
+        if not interfaces:
+            msg = "error: not connected"
+        else:
+            # prefer the answer of the main server
+            msg = outcomes[interfaces[0].server]
+        queued = queue_if_offline and not responded
+        if queued:
+            self.queue_broadcast(tx)
+        return BroadcastResult(False, msg, outcomes, queued)
+
+    async def broadcast_transactions(self, txs, timeout=10, queue_if_offline=True):
+        """Broadcast several transactions, e.g. a payout run.
+        Their requests are sent together, see NotificationSession."""
+        return await asyncio.gather(*[self.broadcast_transaction_to_servers(tx, timeout, queue_if_offline)
+                                      for tx in txs])
+
+    def broadcast_transactions_from_non_network_thread(self, txs, timeout=10, queue_if_offline=True):
+        # note: calling this from the network thread will deadlock it
+        coro = self.broadcast_transactions(txs, timeout=timeout, queue_if_offline=queue_if_offline)
+        fut = asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop)
+        return fut.result()
+
+    def queue_broadcast(self, tx):
+        with self.broadcast_queue_lock:
+            if tx.txid() in self.broadcast_queue:
+                return
+            self.print_error("queueing broadcast of", tx.txid())
+            self.broadcast_queue[tx.txid()] = str(tx)
+        self.save_broadcast_queue()
+        self.wakeup()
+
+    async def retry_queued_broadcasts(self):
+        with self.broadcast_queue_lock:
+            items = list(self.broadcast_queue.items())
+        txs = [Transaction(raw) for txid, raw in items]
+        # still offline: they are queued again
+        results = await self.broadcast_transactions(txs, queue_if_offline=True)
+        removed = False
+        for (txid, raw), result in zip(items, results):
+            if result.queued:
+                continue
+            # sent, or rejected by the servers: retrying will not help
+            self.print_error("queued broadcast of", txid, ":", result.msg)
+            with self.broadcast_queue_lock:
+                self.broadcast_queue.pop(txid, None)
+            removed = True
+        if removed:
+            self.save_broadcast_queue()
 
     async def request_chunk(self, height, tip, session=None, can_return_early=False):
         if session is None: session = self.interface.session
@@ -724,27 +1042,52 @@ class Network(PrintError):
     def export_checkpoints(self, path):
         # run manually from the console to generate checkpoints
         cp = self.blockchain().get_checkpoints()
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(cp, indent=4))
+        write_checkpoints(path, cp)
 
     def start(self, fx=None):
         self.main_taskgroup = TaskGroup()
         async def main():
             self.init_headers_file()
-            async with self.main_taskgroup as group:
-                await group.spawn(self.maintain_sessions())
-                if fx: await group.spawn(fx)
+            try:
+                async with self.main_taskgroup as group:
+                    await group.spawn(self.maintain_sessions())
+                    if fx: await group.spawn(fx)
+            finally:
+                blockchain.flush_all()
         self._wrapper_thread = threading.Thread(target=self.asyncio_loop.run_until_complete, args=(main(),))
         self._wrapper_thread.start()
 
     def stop(self):
         asyncio.run_coroutine_threadsafe(self.main_taskgroup.cancel_remaining(), self.asyncio_loop)
+        blockchain.shutdown_pow_executor()
 
     def join(self):
         self._wrapper_thread.join(1)
 
+    def wakeup(self):
+        """Run maintain_sessions again, e.g. because a server was queued
+        or an interface died. Can be called from any thread."""
+        if self._maintain_event is not None:
+            self.asyncio_loop.call_soon_threadsafe(self._maintain_event.set)
+
+    def _next_maintenance(self, now):
+        """Seconds until timed work of maintain_sessions is due."""
+        due = [self.nodes_retry_time + NODES_RETRY_INTERVAL]
+        if not self.is_connected():
+            if not self.auto_connect and self.default_server in self.disconnected_servers:
+                due.append(self.server_retry_time + SERVER_RETRY_INTERVAL)
+        else:
+            due.append(self.config.last_time_fee_estimates_requested + 60)
+            due.append(self.server_switch_time + SERVER_SWITCH_INTERVAL)
+            if self.broadcast_queue:
+                due.append(self.broadcast_retry_time + BROADCAST_RETRY_INTERVAL)
+        return min(max(min(due) - now, 0.1), MAINTAIN_INTERVAL)
+
     async def maintain_sessions(self):
+        self._maintain_event = asyncio.Event()
         while True:
+            self._maintain_event.clear()
+            self.maintain_wakeups += 1
             while self.socket_queue.qsize() > 0:
                 server = self.socket_queue.get()
                 asyncio.get_event_loop().create_task(self.new_interface(server))
@@ -788,5 +1131,21 @@ class Network(PrintError):
             else:
                 if self.config.is_fee_estimates_update_required():
                     await self.interface.group.spawn(self.request_fee_estimates(self.interface))
-
-            await asyncio.sleep(0.1)
+                if self.broadcast_queue and now - self.broadcast_retry_time > BROADCAST_RETRY_INTERVAL:
+                    self.broadcast_retry_time = now
+                    await self.interface.group.spawn(self.retry_queued_broadcasts())
+                if now - self.server_switch_time > SERVER_SWITCH_INTERVAL:
+                    self.server_switch_time = now
+                    self.switch_slow_interface()
+                    self.server_scores.save()
+
+            # headers buffered under the 'interval' durability policy
+            blockchain.flush_all(only_due=True)
+
+            # not asyncio.wait_for: it can swallow a cancellation that comes
+            # as the event is set, and then stop() would never return
+            waiter = asyncio.ensure_future(self._maintain_event.wait())
+            try:
+                await asyncio.wait([waiter], timeout=self._next_maintenance(time.time()))
+            finally:
+                waiter.cancel()
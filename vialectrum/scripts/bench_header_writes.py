@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+# Compares the durability policies for header appends.
+# usage: python3 -m vialectrum.scripts.bench_header_writes [num_headers] [directory]
+# Run it with a directory on the disk you want to measure.
+
+import sys
+import time
+import tempfile
+
+from vialectrum import blockchain
+from vialectrum.simple_config import SimpleConfig
+from vialectrum.util import set_verbosity
+
+set_verbosity('')
+
+num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 2016
+base_dir = sys.argv[2] if len(sys.argv) > 2 else None
+
+
+def make_headers(n):
+    headers = []
+    prev_hash = '00' * 32
+    for height in range(n):
+        header = {'version': 2, 'prev_block_hash': prev_hash, 'merkle_root': '%064x' % height,
+                  'timestamp': 1500000000 + height, 'bits': 0x1e0fffff, 'nonce': height,
+                  'block_height': height}
+        headers.append(header)
+        prev_hash = blockchain.hash_header(header)
+    return headers
+
+
+headers = make_headers(num_headers)
+policies = [
+    ('always', {}),
+    ('chunk', {}),
+    ('count', {'headers_sync_count': 100}),
+    ('interval', {'headers_sync_interval': 1}),
+]
+print("%d headers" % num_headers)
+for policy, options in policies:
+    options = dict(options, headers_sync_policy=policy,
+                   electrum_path=tempfile.mkdtemp(prefix="bench_headers", dir=base_dir))
+    chain = blockchain.Blockchain(SimpleConfig(options), 0, None)
+    open(chain.path(), 'wb').close()
+    t0 = time.time()
+    for header in headers:
+        chain.save_header(header)
+    chain.flush()
+    dt = time.time() - t0
+    print("%-10s %8.3f s %10.1f headers/s" % (policy, dt, num_headers / dt))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Compares request batch sizes against a local stand-in Electrum server,
+# which answers every frame after a fixed delay to emulate a round-trip.
+# usage: python3 -m vialectrum.scripts.bench_rpc_batching [num_requests] [latency_ms]
+
+import sys
+import time
+import asyncio
+
+import aiorpcx
+
+from vialectrum.interface import NotificationSession
+
+num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+
+
+class StandInSession(aiorpcx.ServerSession):
+
+    frames = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_concurrent = 1000
+
+    def data_received(self, data):
+        StandInSession.frames += data.count(b'\n')
+        self.loop.call_later(latency, super().data_received, data)
+
+    async def handle_request(self, request):
+        if request.method == 'blockchain.scripthash.get_history':
+            return [{'tx_hash': '%064x' % i, 'height': 100000 + i} for i in range(3)]
+        elif request.method == 'blockchain.transaction.get':
+            return '00' * 250
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+async def run(port, max_batch_size):
+    session = NotificationSession('localhost', port, max_batch_size=max_batch_size)
+    await session.create_connection()
+    StandInSession.frames = 0
+    t0 = time.time()
+    # like the synchronizer after a restore: many concurrent requests
+    await asyncio.gather(*[session.send_request('blockchain.scripthash.get_history', ['%064x' % i])
+                           for i in range(num_requests // 2)])
+    await asyncio.gather(*[session.send_request('blockchain.transaction.get', ['%064x' % i])
+                           for i in range(num_requests // 2)])
+    elapsed = time.time() - t0
+    session.transport.close()
+    return elapsed, session.frames_sent, StandInSession.frames
+
+
+async def main():
+    server = aiorpcx.Server(StandInSession, 'localhost', 0)
+    await server.listen()
+    port = server.server.sockets[0].getsockname()[1]
+    print("%d requests, %d ms latency" % (num_requests, latency * 1000))
+    for max_batch_size in [1, 10, 50, 100]:
+        elapsed, frames_sent, frames_received = await run(port, max_batch_size)
+        print("batch size %3d: %6d frames sent, %6d received by server, %.2fs"
+              % (max_batch_size, frames_sent, frames_received, elapsed))
+    await server.close()
+
+
+asyncio.get_event_loop().run_until_complete(main())
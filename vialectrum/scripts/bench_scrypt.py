@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+# Compares the scrypt backends that are available here, one header at a
+# time and in batches, against the pure python implementation.
+# usage: python3 -m vialectrum.scripts.bench_scrypt
+
+from binascii import unhexlify
+from timeit import default_timer
+
+from vialectrum import scrypt
+
+vectors = [
+    ("00"*80, "161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69"),
+    ("ff"*80, "5253069c14ecedf978745486375ee37415e977f55cdbedac31ebee8bf33dd127"),
+    ("010000000000000000000000000000000000000000000000000000000000000000000000d9ced4ed1130f7b7faad9be25323ffafa33232a17c3edf6cfd97bee6bafbdd97b9aa8e4ef0ff0f1ecd513f7c", "001e67b013726fd7382e9acb69165b4b6316227fb3156b5b414ba6340c050000"),
+    ("01000000ae178934851bfa0e83ccb6a3fc4bfddff3641e104b6c4680c31509074e699be2bd672d8d2199ef37a59678f92443083e3b85edef8b45c71759371f823bab59a97126614f44d5001d45920180", "01796dae1f78a72dfb09356db6f027cd884ba0201e6365b72aa54b3b00000000"),
+    ("020000008f49e5fd7ef50db9a2a1bff5d3e93717a096329a8ac802a248463ef366ceea1099b1fd0db4ce8f4728251711f759081d0b5b4da015fb78421d8ffbfda1105a2abda1db521b64101b00e60cd0", "461ae94540dc88c9bffbf42bb47e46a2416280adbeeb1d883c18090000000000"),
+]
+
+
+def bench(name, batch_func, n):
+    headers = [unhexlify(h) for h, _ in vectors] * (n // len(vectors))
+    t0 = default_timer()
+    hashes = batch_func(headers)
+    dt = (default_timer() - t0) / len(headers)
+    assert hashes == [unhexlify(h) for _, h in vectors] * (n // len(vectors))
+    print("%-8s %3d headers: %8.2f ms/hash %10.2f hash/s" % (name, len(headers), dt*1000, 1.0 / dt))
+    return dt
+
+
+reference = bench('python', lambda headers: list(map(scrypt.scrypt_1024_1_1_80, headers)), len(vectors))
+for name, f, batch_func in scrypt.get_backends():
+    if name == 'python':
+        continue
+    dt = bench(name, lambda headers: list(map(f, headers)), len(vectors))
+    print("%-8s single: %.1fx speedup over python" % (name, reference / dt))
+    dt = bench(name, batch_func, scrypt.NUMPY_MAX_BATCH // len(vectors) * len(vectors))
+    print("%-8s batch: %.1fx speedup over python" % (name, reference / dt))
+print("selected backend:", scrypt.BACKEND_NAME)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Compares the memory used by txi, txo and the address histories of a
+# synthetic wallet, as nested dicts and as the compact indexes of txindex.
+# Each transaction spends one wallet coin, and pays one wallet address
+# and one other address.
+# usage: python3 -m vialectrum.scripts.bench_txindex_memory [num_txs ...]
+
+import sys
+import hashlib
+import tracemalloc
+from collections import defaultdict
+
+from vialectrum.txindex import Interner, TxInputIndex, TxOutputIndex, HistoryIndex
+
+sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000]
+
+
+def make_wallet(num_txs):
+    txids = [hashlib.sha256(b'%d' % i).hexdigest() for i in range(num_txs)]
+    addresses = ['V%033d' % (i % max(num_txs // 4, 1)) for i in range(num_txs)]
+    txi, txo, history = {}, {}, defaultdict(list)
+    for i, (txid, addr) in enumerate(zip(txids, addresses)):
+        txo[txid] = {addr: [(0, 100000 + i, False)]}
+        txi[txid] = {addresses[i - 1]: {(txids[i - 1] + ':0', 100000 + i - 1)}} if i else {}
+        history[addr].append([txid, 1000 + i])
+    return txi, txo, dict(history)
+
+
+def measure(f, *args):
+    tracemalloc.start()
+    r = f(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return r, size
+
+
+def fresh(s):
+    return s.encode().decode()
+
+
+def dicts(txi, txo, history):
+    # as loaded from storage: the strings and containers are not shared
+    return ({fresh(txid): {addr: set((fresh(ser), v) for ser, v in l) for addr, l in d.items()}
+             for txid, d in txi.items()},
+            {fresh(txid): {addr: [list(x) for x in l] for addr, l in d.items()} for txid, d in txo.items()},
+            {addr: [[fresh(txid), height] for txid, height in h] for addr, h in history.items()})
+
+
+def compact(txi, txo, history):
+    txids, address_ids = Interner(), Interner()
+    i, o, h = TxInputIndex(txids, address_ids), TxOutputIndex(txids, address_ids), HistoryIndex(txids)
+    i.update(txi)
+    o.update(txo)
+    h.update(history)
+    return i, o, h
+
+
+for num_txs in sizes:
+    wallet = make_wallet(num_txs)
+    _, dict_size = measure(dicts, *wallet)
+    _, compact_size = measure(compact, *wallet)
+    print("%7d txs: dicts %8.1f MB %6d B/tx, compact %8.1f MB %6d B/tx"
+          % (num_txs, dict_size / 1e6, dict_size // num_txs, compact_size / 1e6, compact_size // num_txs))
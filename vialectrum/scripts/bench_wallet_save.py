@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Measures how long a wallet takes to put its transactions into storage,
+# and to read them back, on a synthetic wallet of imported addresses with
+# one transaction each.
+# usage: python3 -m vialectrum.scripts.bench_wallet_save [num_txs] [--journal]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from vialectrum import constants
+from vialectrum.bitcoin import address_to_script
+from vialectrum.storage import WalletStorage
+from vialectrum.transaction import Transaction
+from vialectrum.wallet import Wallet
+from vialectrum.util import set_verbosity
+from vialectrum.scripts.standin_server import make_addresses, make_tx
+
+set_verbosity('')
+constants.set_regtest()
+
+args = [a for a in sys.argv[1:] if not a.startswith('--')]
+num_txs = int(args[0]) if args else 50000
+journal = '--journal' in sys.argv
+
+
+def timed(name, f, *args, **kwargs):
+    t0 = time.time()
+    r = f(*args, **kwargs)
+    print("%-40s %8.3f s" % (name, time.time() - t0))
+    return r
+
+
+path = tempfile.mkdtemp(prefix='bench_wallet_save')
+try:
+    addresses = make_addresses(num_txs)
+    storage = WalletStorage(os.path.join(path, 'wallet'), journal=journal)
+    storage.put('wallet_type', 'imported')
+    storage.put('addresses', {addr: {} for addr in addresses})
+    wallet = Wallet(storage)
+    txs = [Transaction(make_tx(b'%d' % i, address_to_script(addr), 1000))
+           for i, addr in enumerate(addresses)]
+    print("%d transactions" % num_txs)
+    for tx in txs[:-1]:
+        wallet.add_transaction(tx.txid(), tx)
+    timed("save_transactions, all", wallet.save_transactions)
+    timed("write, all", storage.write)
+    tx = txs[-1]
+    wallet.add_transaction(tx.txid(), tx)
+    timed("save_transactions, one changed tx", wallet.save_transactions)
+    timed("write, one changed tx", storage.write)
+    timed("save_transactions, nothing changed", wallet.save_transactions)
+    timed("get('transactions')", storage.get, 'transactions')
+    timed("get('transactions', frozen=True)", storage.get, 'transactions', frozen=True)
+    timed("load wallet", Wallet, WalletStorage(storage.path))
+finally:
+    shutil.rmtree(path)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Measures how long a wallet takes to synchronize and verify its history
+# from scratch, against a local stand-in server (see standin_server).
+# The wallet watches num_addresses imported addresses, each with
+# txs_per_address confirmed transactions. Every size runs in its own process.
+# usage: python3 -m vialectrum.scripts.bench_wallet_sync [num_addresses ...]
+#            [--txs-per-address N] [--latency MS] [--error-rate R] [--timeout-rate R]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+from vialectrum import constants
+from vialectrum.util import set_verbosity
+
+parser = argparse.ArgumentParser()
+parser.add_argument('sizes', nargs='*', type=int, default=[100, 1000, 10000, 100000])
+parser.add_argument('--txs-per-address', type=int, default=1)
+parser.add_argument('--latency', type=float, default=0, help='milliseconds per frame')
+parser.add_argument('--error-rate', type=float, default=0)
+parser.add_argument('--timeout-rate', type=float, default=0)
+parser.add_argument('--timeout', type=float, default=3600, help='seconds, per size')
+parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+
+def run_single(num_addresses):
+    from vialectrum.network import Network
+    from vialectrum.simple_config import SimpleConfig
+    from vialectrum.storage import WalletStorage
+    from vialectrum.wallet import Wallet
+    from vialectrum.scripts.standin_server import Fixtures, StandInServer, make_addresses
+
+    set_verbosity('')
+    constants.set_regtest()
+    t0 = time.time()
+    addresses = make_addresses(num_addresses)
+    fixtures = Fixtures(addresses, txs_per_address=args.txs_per_address)
+    constants.net = fixtures.make_net()
+    server = StandInServer(fixtures, latency=args.latency / 1000,
+                           error_rate=args.error_rate, timeout_rate=args.timeout_rate)
+    server.start_in_thread()
+    setup_time = time.time() - t0
+
+    path = tempfile.mkdtemp(prefix='bench_wallet_sync')
+    config = SimpleConfig({'electrum_path': path, 'server': server.server_string,
+                           'oneserver': True, 'auto_connect': False}, read_user_config_function=lambda x: {})
+    storage = WalletStorage(os.path.join(path, 'wallet'))
+    storage.put('wallet_type', 'imported')
+    storage.put('addresses', {addr: {} for addr in addresses})
+    wallet = Wallet(storage)
+    network = Network(config)
+    network.start()
+    t0 = time.time()
+    wallet.start_network(network)
+    synced_time = None
+    while time.time() - t0 < args.timeout:
+        if synced_time is None and wallet.is_up_to_date():
+            synced_time = time.time() - t0
+        if synced_time is not None and wallet.verifier and wallet.verifier.is_up_to_date() \
+                and len(wallet.verified_tx) == len(fixtures.txs):
+            break
+        time.sleep(0.01)
+    else:
+        print("%7d addresses: timed out, %d of %d transactions verified"
+              % (num_addresses, len(wallet.verified_tx), len(fixtures.txs)))
+        os._exit(1)
+    verified_time = time.time() - t0
+    requests = sum(v for k, v in server.stats.items() if '.' in k)
+    print("%7d addresses: synchronized in %7.2fs, verified in %7.2fs, %7d requests (setup %.1fs)"
+          % (num_addresses, synced_time, verified_time, requests, setup_time))
+    sys.stdout.flush()
+    # threads of the network and server are not joined
+    os._exit(0)
+
+
+if args.single:
+    run_single(args.sizes[0])
+else:
+    print("%d tx per address, latency %g ms, error rate %g, timeout rate %g"
+          % (args.txs_per_address, args.latency, args.error_rate, args.timeout_rate))
+    for size in args.sizes:
+        subprocess.call([sys.executable, '-m', 'vialectrum.scripts.bench_wallet_sync', '--single', str(size),
+                         '--txs-per-address', str(args.txs_per_address), '--latency', str(args.latency),
+                         '--error-rate', str(args.error_rate), '--timeout-rate', str(args.timeout_rate),
+                         '--timeout', str(args.timeout)])
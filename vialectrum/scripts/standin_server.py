@@ -0,0 +1,402 @@
+# A local stand-in for an Electrum server, for end-to-end and performance
+# tests that must not depend on the network.
+#
+# Fixtures generates a synthetic chain: headers linked from their own
+# genesis block, one transaction per (address, index) paying to a wallet
+# address, mined into blocks so that merkle proofs are valid. The chain
+# is only valid on StandInNet (see Fixtures.make_net), a regtest variant
+# with that genesis: regtest does not check proof of work.
+#
+# StandInServer serves it over the Electrum protocol, with aiorpcx like
+# NotificationSession, and can emulate a slow or faulty server.
+#
+# usage: python3 -m vialectrum.scripts.standin_server [num_addresses] [port]
+
+import asyncio
+import hashlib
+import random
+import threading
+
+import aiorpcx
+
+from vialectrum import constants
+from vialectrum import blockchain
+from vialectrum.bitcoin import (hash160_to_p2pkh, address_to_script, script_to_scripthash,
+                                int_to_hex, var_int, hash_encode, hash_decode, COIN, TYPE_ADDRESS)
+from vialectrum.crypto import Hash
+from vialectrum.synchronizer import history_status
+from vialectrum.transaction import Transaction
+from vialectrum.util import bh2u, bfh
+
+
+PROTOCOL_VERSION = '1.4'
+# first block with transactions, so that the wallet sees confirmed and
+# deep transactions
+FIRST_TX_HEIGHT = 1
+
+
+def make_addresses(num_addresses, seed=0):
+    """Addresses of the current net, from deterministic hash160s.
+    Use regtest, whose address types StandInNet shares."""
+    return [hash160_to_p2pkh(hashlib.sha256(b'address %d %d' % (seed, i)).digest()[:20])
+            for i in range(num_addresses)]
+
+
+def make_tx(seed, script, value):
+    """Raw transaction spending a made up outpoint, paying value to script."""
+    prevout = hashlib.sha256(seed).hexdigest()
+    return (int_to_hex(1, 4)
+            + var_int(1) + prevout + int_to_hex(0, 4) + var_int(0) + 'ffffffff'
+            + var_int(1) + int_to_hex(value, 8) + var_int(len(script) // 2) + script
+            + int_to_hex(0, 4))
+
+
+def merkle_branch(tx_hashes, pos):
+    """Branch of the tx at pos, as expected by SPV.hash_merkle_root."""
+    branch = []
+    level = [hash_decode(h) for h in tx_hashes]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        branch.append(hash_encode(level[pos ^ 1]))
+        level = [Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        pos //= 2
+    return branch, hash_encode(level[0])
+
+
+class Fixtures:
+    """A chain of num_blocks headers, with txs_per_address transactions
+    paying to each of addresses, txs_per_block per block."""
+
+    def __init__(self, addresses, txs_per_address=1, txs_per_block=100, num_blocks=1000, seed=0):
+        self.addresses = list(addresses)
+        self.txs = {}  # txid -> raw tx
+        self.tx_positions = {}  # txid -> (height, pos)
+        self.block_txs = {}  # height -> [txid]
+        self.histories = {}  # scripthash -> [(txid, height)]
+        self.utxos = {}  # scripthash -> [listunspent item]
+        self.address_scripthash = {}
+        n = 0
+        for i, addr in enumerate(self.addresses):
+            script = address_to_script(addr)
+            scripthash = script_to_scripthash(script)
+            self.address_scripthash[addr] = scripthash
+            for j in range(txs_per_address):
+                value = (i % 100 + 1) * COIN // 100
+                raw = make_tx(b'tx %d %d %d' % (seed, i, j), script, value)
+                txid = hash_encode(Hash(bfh(raw)))
+                height = FIRST_TX_HEIGHT + n // txs_per_block
+                block = self.block_txs.setdefault(height, [])
+                self.tx_positions[txid] = (height, len(block))
+                block.append(txid)
+                self.txs[txid] = raw
+                self.histories.setdefault(scripthash, []).append((txid, height))
+                self.utxos.setdefault(scripthash, []).append(
+                    {'tx_hash': txid, 'tx_pos': 0, 'height': height, 'value': value})
+                n += 1
+        self.mempool = {}  # txid -> raw tx
+        self.headers = []  # raw headers
+        self.header_hashes = []
+        self.add_blocks(max(num_blocks, FIRST_TX_HEIGHT + n // max(txs_per_block, 1) + 7))
+
+    def add_blocks(self, num_blocks):
+        """Extend the chain, e.g. to emulate new blocks."""
+        for _ in range(num_blocks):
+            height = len(self.headers)
+            txids = self.block_txs.get(height) or [hash_encode(Hash(b'coinbase %d' % height))]
+            header = {'version': 2,
+                      'prev_block_hash': self.header_hashes[-1] if height else '00' * 32,
+                      'merkle_root': merkle_branch(txids, 0)[1],
+                      'timestamp': 1500000000 + 24 * height,
+                      'bits': 0x1e0fffff,
+                      'nonce': height,
+                      'block_height': height}
+            self.headers.append(bfh(blockchain.serialize_header(header)))
+            self.header_hashes.append(blockchain.hash_header(header))
+
+    def make_net(self):
+        """Network constants under which this chain is valid; install
+        with `constants.net = fixtures.make_net()`."""
+        class StandInNet(constants.BitcoinRegtest):
+            GENESIS = self.header_hashes[0]
+            DEFAULT_SERVERS = {}
+            CHECKPOINTS = []
+        return StandInNet
+
+    def height(self):
+        return len(self.headers) - 1
+
+    def header(self, height):
+        return bh2u(self.headers[height])
+
+    def tip(self):
+        return {'hex': self.header(self.height()), 'height': self.height()}
+
+    def get_headers(self, start_height, count):
+        headers = self.headers[start_height:start_height + min(count, 2016)]
+        return {'hex': bh2u(b''.join(headers)), 'count': len(headers), 'max': 2016}
+
+    def get_history(self, scripthash):
+        history = [{'tx_hash': txid, 'height': height}
+                   for txid, height in self.histories.get(scripthash, [])]
+        for item in history:
+            if item['height'] == 0:
+                item['fee'] = 0
+        return history
+
+    def get_status(self, scripthash):
+        return history_status(self.histories.get(scripthash))
+
+    def get_transaction(self, txid):
+        return self.txs.get(txid) or self.mempool.get(txid)
+
+    def get_merkle(self, txid, height):
+        if self.tx_positions.get(txid, (None,))[0] != height:
+            return None
+        txids = self.block_txs[height]
+        pos = txids.index(txid)
+        return {'block_height': height, 'merkle': merkle_branch(txids, pos)[0], 'pos': pos}
+
+    def add_to_mempool(self, raw_tx):
+        """Returns the txid, and the scripthashes whose status changed."""
+        tx = Transaction(raw_tx)
+        tx.deserialize()
+        txid = tx.txid()
+        self.mempool[txid] = raw_tx
+        changed = []
+        for o in tx.outputs():
+            if o.type != TYPE_ADDRESS:
+                continue
+            scripthash = script_to_scripthash(address_to_script(o.address))
+            history = self.histories.setdefault(scripthash, [])
+            if (txid, 0) not in history:
+                history.append((txid, 0))
+                changed.append(scripthash)
+        return txid, changed
+
+
+class StandInSession(aiorpcx.ServerSession):
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server = server
+        self.max_concurrent = 1000
+        self.scripthashes = set()
+        self.headers_subscribed = False
+        self.num_requests = 0
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.server.sessions.add(self)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.server.sessions.discard(self)
+
+    def data_received(self, data):
+        # one round-trip of latency for every frame
+        if self.server.latency:
+            self.loop.call_later(self.server.latency, super().data_received, data)
+        else:
+            super().data_received(data)
+
+    async def handle_request(self, request):
+        server = self.server
+        self.num_requests += 1
+        server.stats[request.method] = server.stats.get(request.method, 0) + 1
+        if server.disconnect_after and self.num_requests > server.disconnect_after:
+            server.stats['disconnects'] = server.stats.get('disconnects', 0) + 1
+            self.transport.abort()
+            return
+        if request.method not in ('server.version', 'blockchain.headers.subscribe'):
+            if server.random.random() < server.timeout_rate:
+                server.stats['timeouts'] = server.stats.get('timeouts', 0) + 1
+                await asyncio.sleep(3600)
+            if server.random.random() < server.error_rate:
+                server.stats['errors'] = server.stats.get('errors', 0) + 1
+                raise aiorpcx.RPCError(aiorpcx.JSONRPC.INTERNAL_ERROR, 'injected error')
+        handler = getattr(self, 'on_' + request.method.replace('.', '_'), None)
+        if handler is None:
+            raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+        if server.delay:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            try:
+                await asyncio.sleep(server.delay)
+            finally:
+                server.in_flight -= 1
+        return handler(*request.args)
+
+    def on_server_version(self, client_name=None, protocol_version=None):
+        return ['StandIn 1.0', PROTOCOL_VERSION]
+
+    def on_server_ping(self):
+        return None
+
+    def on_server_banner(self):
+        return 'stand-in server'
+
+    def on_server_donation_address(self):
+        return ''
+
+    def on_server_peers_subscribe(self):
+        return []
+
+    def on_blockchain_relayfee(self):
+        return 0.00001
+
+    def on_blockchain_estimatefee(self, number):
+        return 0.0001
+
+    def on_mempool_get_fee_histogram(self):
+        return []
+
+    def on_blockchain_headers_subscribe(self):
+        self.headers_subscribed = True
+        return self.server.fixtures.tip()
+
+    def on_blockchain_block_header(self, height, cp_height=0):
+        return self.server.fixtures.header(height)
+
+    def on_blockchain_block_headers(self, start_height, count, cp_height=0):
+        return self.server.fixtures.get_headers(start_height, count)
+
+    def on_blockchain_scripthash_subscribe(self, scripthash):
+        self.scripthashes.add(scripthash)
+        return self.server.fixtures.get_status(scripthash)
+
+    def on_blockchain_scripthash_get_history(self, scripthash):
+        return self.server.fixtures.get_history(scripthash)
+
+    def on_blockchain_scripthash_listunspent(self, scripthash):
+        return self.server.fixtures.utxos.get(scripthash, [])
+
+    def on_blockchain_scripthash_get_balance(self, scripthash):
+        confirmed = sum(item['value'] for item in self.server.fixtures.utxos.get(scripthash, []))
+        return {'confirmed': confirmed, 'unconfirmed': 0}
+
+    def on_blockchain_transaction_get(self, txid, verbose=False):
+        raw = self.server.fixtures.get_transaction(txid)
+        if raw is None:
+            raise aiorpcx.RPCError(1, 'unknown transaction')
+        return raw
+
+    def on_blockchain_transaction_get_merkle(self, txid, height):
+        result = self.server.fixtures.get_merkle(txid, height)
+        if result is None:
+            raise aiorpcx.RPCError(1, 'transaction not in block')
+        return result
+
+    def on_blockchain_transaction_broadcast(self, raw_tx):
+        try:
+            txid, changed = self.server.fixtures.add_to_mempool(raw_tx)
+        except Exception as e:
+            raise aiorpcx.RPCError(1, 'the transaction was rejected: %r' % e)
+        self.server.notify_scripthashes(changed)
+        return txid
+
+
+class StandInServer:
+    """Serves fixtures on localhost.
+
+    Faults can be injected, and changed while the server runs:
+    - latency: seconds added to every frame received
+    - delay: seconds before answering each request; the most requests
+      waiting at once is kept in max_in_flight
+    - error_rate: fraction of requests answered with an error
+    - timeout_rate: fraction of requests never answered
+    - disconnect_after: connections are dropped after this many requests
+    """
+
+    def __init__(self, fixtures, latency=0, delay=0, error_rate=0, timeout_rate=0,
+                 disconnect_after=None, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.disconnect_after = disconnect_after
+        self.random = random.Random(seed)
+        self.sessions = set()
+        self.stats = {}  # requests by method, and injected faults
+        self.port = None
+        self.loop = None
+        self._server = None
+
+    async def listen(self, port=0):
+        self.loop = asyncio.get_event_loop()
+        self._server = aiorpcx.Server(lambda: StandInSession(self), 'localhost', port)
+        await self._server.listen()
+        self.port = self._server.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self):
+        for session in list(self.sessions):
+            if session.transport:
+                session.transport.abort()
+        await self._server.close()
+
+    def start_in_thread(self, port=0):
+        """Run the server in its own thread and event loop, e.g. for a
+        Network running in another thread. Returns the port."""
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.listen(port))
+            started.set()
+            loop.run_forever()
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return self.port
+
+    def stop_thread(self):
+        fut = asyncio.run_coroutine_threadsafe(self.close(), self.loop)
+        fut.result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    @property
+    def server_string(self):
+        return 'localhost:%d:t' % self.port
+
+    def _in_loop(self, func, *args):
+        if self.loop is None:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def mine(self, num_blocks=1):
+        """Add blocks, and notify the sessions subscribed to headers."""
+        self._in_loop(self._mine, num_blocks)
+
+    def _mine(self, num_blocks):
+        self.fixtures.add_blocks(num_blocks)
+        tip = self.fixtures.tip()
+        for session in list(self.sessions):
+            if session.headers_subscribed:
+                asyncio.ensure_future(session.send_notification('blockchain.headers.subscribe', [tip]))
+
+    def notify_scripthashes(self, scripthashes):
+        for session in list(self.sessions):
+            for scripthash in scripthashes:
+                if scripthash in session.scripthashes:
+                    status = self.fixtures.get_status(scripthash)
+                    asyncio.ensure_future(session.send_notification('blockchain.scripthash.subscribe',
+                                                                    [scripthash, status]))
+
+
+if __name__ == '__main__':
+    import sys
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    constants.set_regtest()
+    fixtures = Fixtures(make_addresses(num_addresses))
+    constants.net = fixtures.make_net()
+    server = StandInServer(fixtures)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.listen(port))
+    print("serving %d blocks, %d transactions on %s" % (fixtures.height() + 1, len(fixtures.txs), server.server_string))
+    print("genesis", fixtures.header_hashes[0])
+    loop.run_forever()
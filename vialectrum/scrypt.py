@@ -19,6 +19,12 @@
 import hashlib
 import hmac
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, bytes) or len(header) != 80:
         raise ValueError('header must be 80 bytes')
@@ -244,24 +250,120 @@ def _xor_salsa8_2(X):
     ]
 
 
+def _check_header(header):
+    if not isinstance(header, bytes) or len(header) != 80:
+        raise ValueError('header must be 80 bytes')
+
 
-if __name__ == '__main__':
-    from binascii import unhexlify
+def _hashlib_scrypt_1024_1_1_80(header):
+    # OpenSSL's scrypt, available in python builds linked against OpenSSL >= 1.1
+    _check_header(header)
+    return hashlib.scrypt(header, salt=header, n=1024, r=1, p=1, dklen=32)
+
+
+# Vectorized scrypt. Each header is a lane of the numpy arrays, so one
+# salsa20/8 step advances every header of the batch at once. Within a
+# 16-word block the words are stored in "diagonal" order, so that the
+# column and row quarter-rounds are both plain lane-wise operations.
+_DIAGONAL_ORDER = [0, 5, 10, 15, 4, 9, 14, 3, 8, 13, 2, 7, 12, 1, 6, 11]
+_WORD_ORDER = _DIAGONAL_ORDER + [16 + i for i in _DIAGONAL_ORDER]
+NUMPY_MAX_BATCH = 256  # scratchpad is 128 KiB per lane
+
+
+def _salsa20_8_numpy(B):
+    a, b, c, d = B[0].copy(), B[1].copy(), B[2].copy(), B[3].copy()
+    for i in range(4):
+        # column round
+        t = a + d; b ^= (t << 7) | (t >> 25)
+        t = b + a; c ^= (t << 9) | (t >> 23)
+        t = c + b; d ^= (t << 13) | (t >> 19)
+        t = d + c; a ^= (t << 18) | (t >> 14)
+        # row round, on rotated rows
+        b = np.roll(b, 1, axis=0)
+        c = np.roll(c, 2, axis=0)
+        d = np.roll(d, -1, axis=0)
+        t = a + b; d ^= (t << 7) | (t >> 25)
+        t = d + a; c ^= (t << 9) | (t >> 23)
+        t = c + d; b ^= (t << 13) | (t >> 19)
+        t = b + c; a ^= (t << 18) | (t >> 14)
+        b = np.roll(b, -1, axis=0)
+        c = np.roll(c, -2, axis=0)
+        d = np.roll(d, 1, axis=0)
+    B[0] += a
+    B[1] += b
+    B[2] += c
+    B[3] += d
+
+
+def _xor_salsa8_2_numpy(X):
+    X[0] ^= X[1]
+    _salsa20_8_numpy(X[0])
+    X[1] ^= X[0]
+    _salsa20_8_numpy(X[1])
+
+
+def _scrypt_1024_1_1_80_numpy(headers):
+    n = len(headers)
+    B = b''.join(hashlib.pbkdf2_hmac('sha256', h, h, 1, 128) for h in headers)
+    words = np.frombuffer(B, dtype='<u4').reshape(n, 32).T
+    X = np.ascontiguousarray(words[_WORD_ORDER], dtype=np.uint32).reshape(2, 4, 4, n)
+    V = np.empty((1024,) + X.shape, dtype=np.uint32)
+    for i in range(1024):
+        V[i] = X
+        _xor_salsa8_2_numpy(X)
+    lanes = np.arange(n)
+    for i in range(1024):
+        # word 16 is the first word of the second block
+        k = X[1, 0, 0] & 1023
+        X ^= V[k, :, :, :, lanes].transpose(1, 2, 3, 0)
+        _xor_salsa8_2_numpy(X)
+    words = np.empty((32, n), dtype='<u4')
+    words[_WORD_ORDER] = X.reshape(32, n)
+    B = words.T.tobytes()
+    return [hashlib.pbkdf2_hmac('sha256', h, B[i*128:(i+1)*128], 1, 32)
+            for i, h in enumerate(headers)]
+
+
+def scrypt_1024_1_1_80_batch_numpy(headers):
+    for header in headers:
+        _check_header(header)
+    out = []
+    for i in range(0, len(headers), NUMPY_MAX_BATCH):
+        out.extend(_scrypt_1024_1_1_80_numpy(headers[i:i+NUMPY_MAX_BATCH]))
+    return out
+
+
+def _get_scrypt_package():
+    try:
+        import scrypt
+    except ImportError:
+        return None
+    # when running this file as a script, 'scrypt' may resolve to this very module
+    if not hasattr(scrypt, 'hash'):
+        return None
+    def f(header):
+        _check_header(header)
+        return scrypt.hash(header, header, N=1024, r=1, p=1, buflen=32)
+    return f
 
-    vectors = [
-        ("00"*80, "161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69"),
-        ("ff"*80, "5253069c14ecedf978745486375ee37415e977f55cdbedac31ebee8bf33dd127"),
-        ("010000000000000000000000000000000000000000000000000000000000000000000000d9ced4ed1130f7b7faad9be25323ffafa33232a17c3edf6cfd97bee6bafbdd97b9aa8e4ef0ff0f1ecd513f7c", "001e67b013726fd7382e9acb69165b4b6316227fb3156b5b414ba6340c050000"),
-        ("01000000ae178934851bfa0e83ccb6a3fc4bfddff3641e104b6c4680c31509074e699be2bd672d8d2199ef37a59678f92443083e3b85edef8b45c71759371f823bab59a97126614f44d5001d45920180", "01796dae1f78a72dfb09356db6f027cd884ba0201e6365b72aa54b3b00000000"),
-        ("020000008f49e5fd7ef50db9a2a1bff5d3e93717a096329a8ac802a248463ef366ceea1099b1fd0db4ce8f4728251711f759081d0b5b4da015fb78421d8ffbfda1105a2abda1db521b64101b00e60cd0", "461ae94540dc88c9bffbf42bb47e46a2416280adbeeb1d883c18090000000000"),
-    ]
 
-    from timeit import default_timer
-    t0 = default_timer()
+def get_backends():
+    """Return available (name, hash_func, batch_func) tuples, fastest first.
+    batch_func maps a list of 80 byte headers to a list of hashes.
+    """
+    backends = []
+    f = _get_scrypt_package()
+    if f:
+        backends.append(('scrypt', f, None))
+    if hasattr(hashlib, 'scrypt'):
+        backends.append(('hashlib', _hashlib_scrypt_1024_1_1_80, None))
+    if np is not None:
+        # a batch of one is slower than the pure python code
+        backends.append(('numpy', scrypt_1024_1_1_80, scrypt_1024_1_1_80_batch_numpy))
+    backends.append(('python', scrypt_1024_1_1_80, None))
+    return [(name, f, batch_f if batch_f else (lambda headers, f=f: list(map(f, headers))))
+            for name, f, batch_f in backends]
 
-    for header, hash in vectors:
-        assert scrypt_1024_1_1_80(unhexlify(header)) == unhexlify(hash)
 
-    dt = (default_timer() - t0) / len(vectors)
-    print("%.1f ms/hash" % (dt*1000))
-    print("%.2f hash/s" % (1.0 / dt))
+# selected once, at import time
+BACKEND_NAME, getPoWHash, getPoWHashes = get_backends()[0]
@@ -0,0 +1,137 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import random
+import threading
+import time
+from typing import Optional, Iterable
+
+from .util import PrintError
+
+
+# weight of a new sample in the moving averages
+EWMA_ALPHA = 0.2
+# latency assumed for servers we know nothing about, in seconds;
+# low enough for them to be tried, higher than that of good servers
+UNKNOWN_LATENCY = 0.3
+# penalties, see ServerScores.get_score
+ERROR_PENALTY = 4
+FAILURE_PENALTY = 4
+LAG_PENALTY = 100  # ms per block behind
+
+
+def _ewma(old: Optional[float], sample: float) -> float:
+    return sample if old is None else (1 - EWMA_ALPHA) * old + EWMA_ALPHA * sample
+
+
+class ServerScores(PrintError):
+    """Connection quality of servers, persisted next to 'recent_servers'.
+
+    For each server, moving averages are kept of the ping round-trip time,
+    of request response times, of the rate of failed requests (timeouts,
+    not RPC errors), of the rate of failed or dropped connections, and of
+    how many blocks its tip was behind ours.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.lock = threading.RLock()
+        self.stats = self._read()  # server -> dict
+
+    def _read(self) -> dict:
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                return json.loads(f.read())
+        except:
+            return {}
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            s = json.dumps(self.stats, indent=4, sort_keys=True)
+        try:
+            with open(self.path, "w", encoding='utf-8') as f:
+                f.write(s)
+        except:
+            pass
+
+    def _update(self, server: str, key: str, sample: float) -> None:
+        with self.lock:
+            stats = self.stats.setdefault(server, {})
+            stats[key] = _ewma(stats.get(key), sample)
+            stats['last_seen'] = int(time.time())
+
+    def record_rtt(self, server: str, seconds: float) -> None:
+        self._update(server, 'rtt', seconds)
+
+    def record_response(self, server: str, seconds: float, failed: bool=False) -> None:
+        if not failed:
+            self._update(server, 'response', seconds)
+        self._update(server, 'errors', 1 if failed else 0)
+
+    def record_connection(self, server: str, ok: bool) -> None:
+        """A connection attempt succeeded, or failed."""
+        self._update(server, 'failures', 0 if ok else 1)
+        self.save()
+
+    def record_disconnect(self, server: str) -> None:
+        """An established connection was lost."""
+        self._update(server, 'failures', 1)
+        self.save()
+
+    def record_lag(self, server: str, blocks: int) -> None:
+        self._update(server, 'lag', max(0, blocks))
+
+    def get_score(self, server: str) -> float:
+        """Expected cost of using server, in ms; lower is better."""
+        with self.lock:
+            stats = self.stats.get(server, {})
+            latency = stats.get('rtt')
+            if latency is None:
+                latency = stats.get('response', UNKNOWN_LATENCY)
+            errors = stats.get('errors', 0)
+            failures = stats.get('failures', 0)
+            lag = stats.get('lag', 0)
+        return (latency * 1000 * (1 + ERROR_PENALTY * errors) * (1 + FAILURE_PENALTY * failures)
+                + LAG_PENALTY * lag)
+
+    def best(self, servers: Iterable[str]) -> Optional[str]:
+        servers = list(servers)
+        return min(servers, key=self.get_score) if servers else None
+
+    def pick(self, servers: Iterable[str]) -> Optional[str]:
+        """Random server, better scores being more likely."""
+        servers = list(servers)
+        if not servers:
+            return None
+        weights = [1 / max(self.get_score(s), 1) for s in servers]
+        return random.choices(servers, weights=weights)[0]
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {server: dict(stats, score=self.get_score(server))
+                    for server, stats in self.stats.items()}
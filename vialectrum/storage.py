@@ -33,6 +33,7 @@ import hmac, hashlib
 import base64
 import zlib
 from collections import defaultdict
+from types import MappingProxyType
 
 from . import util, bitcoin, ecc
 from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh
@@ -68,19 +69,41 @@ def get_derivation_used_for_hw_device_encryption():
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
 
+# journal: changes are appended to <wallet>.journal, and the wallet file
+# is only rewritten when the journal grows larger than this fraction of it
+JOURNAL_COMPACT_RATIO = 0.5
+JOURNAL_MIN_COMPACT_SIZE = 1024 * 1024
+JOURNAL_VERSION = 1
+
+
 class JsonDB(PrintError):
 
-    def __init__(self, path):
+    def __init__(self, path, journal=False):
         self.db_lock = threading.RLock()
         self.data = {}
         self.path = path
         self.modified = False
-
-    def get(self, key, default=None):
+        # journaled writes: write() only appends the keys that changed,
+        # and the entries that changed in dict values, see put
+        self.journal = journal
+        self.journal_path = path + '.journal' if path else None
+        self._pending = {}  # key -> None for the whole value, or changed subkeys
+        self._snapshot_hash = None  # of the wallet file the journal applies to
+        self._journal_size = None  # None while there is no journal to append to
+        self._needs_compaction = False
+
+    def get(self, key, default=None, frozen=False):
+        """Return a copy of the value stored at key.
+        With frozen, the stored value itself is returned, as a read-only
+        view if it is a dict. Its nested values are shared with the db,
+        and must not be modified."""
         with self.db_lock:
             v = self.data.get(key)
             if v is None:
                 v = default
+            elif frozen:
+                if isinstance(v, dict):
+                    v = MappingProxyType(v)
             else:
                 v = copy.deepcopy(v)
         return v
@@ -94,24 +117,69 @@ class JsonDB(PrintError):
             return
         with self.db_lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old = self.data.get(key)
+                if old != value:
                     self.modified = True
+                    if self.journal:
+                        self._add_pending(key, old, value)
                     self.data[key] = copy.deepcopy(value)
             elif key in self.data:
                 self.modified = True
+                if self.journal:
+                    self._pending[key] = None
                 self.data.pop(key)
 
+    def put_entries(self, key, entries, removed=()):
+        """Update the dict stored at key in place: set the given entries,
+        and remove the keys in removed. Only the changed entries are
+        written to the journal.
+        Unlike put, the values are neither validated nor copied; the
+        caller passes JSON-serializable values it will not modify."""
+        if not entries and not removed:
+            return
+        with self.db_lock:
+            d = self.data.get(key)
+            if not isinstance(d, dict):
+                d = self.data[key] = {}
+                if self.journal:
+                    self._pending[key] = None
+            d.update(entries)
+            for k in removed:
+                d.pop(k, None)
+            self.modified = True
+            if self.journal and self._pending.get(key, ()) is not None:
+                changed = self._pending.setdefault(key, set())
+                changed.update(entries)
+                changed.update(removed)
+
+    def _add_pending(self, key, old, new):
+        if key in self._pending and self._pending[key] is None:
+            return
+        if not isinstance(old, dict) or not isinstance(new, dict):
+            self._pending[key] = None
+            return
+        changed = self._pending.setdefault(key, set())
+        changed.update(k for k in new if k not in old or old[k] != new[k])
+        changed.update(k for k in old if k not in new)
+        if len(changed) > len(new) // 2:
+            self._pending[key] = None
+
     @profiler
-    def write(self):
+    def write(self, compact=False):
         with self.db_lock:
-            self._write()
+            self._write(compact)
 
-    def _write(self):
+    def _write(self, compact=False):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write db')
             return
-        if not self.modified:
+        if not self.modified and not (compact and self._journal_size):
             return
+        if self.journal and not compact and not self._needs_compaction and os.path.exists(self.path):
+            self._append_journal()
+            if self._journal_size < max(JOURNAL_MIN_COMPACT_SIZE,
+                                        JOURNAL_COMPACT_RATIO * os.path.getsize(self.path)):
+                return
         s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
         s = self.encrypt_before_writing(s)
 
@@ -131,6 +199,98 @@ class JsonDB(PrintError):
         os.chmod(self.path, mode)
         self.print_error("saved", self.path)
         self.modified = False
+        # the journal is now part of the wallet file. If we crash before
+        # removing it, it is not replayed, as it names the previous file
+        self._set_snapshot(s)
+        self._pending = {}
+        self._needs_compaction = False
+        if self._journal_size is not None:
+            os.remove(self.journal_path)
+            self._journal_size = None
+
+    def _set_snapshot(self, s):
+        self._snapshot_hash = hashlib.sha256(s.encode('utf8')).hexdigest()
+
+    def _journal_record(self):
+        ops = []
+        for key, subkeys in self._pending.items():
+            value = self.data.get(key)
+            if value is None:
+                ops.append(['del', key])
+            elif subkeys is None:
+                ops.append(['put', key, value])
+            else:
+                # dicts keep the keys of the wallet file as JSON converts them
+                ops.append(['update', key, {k: value[k] for k in subkeys if k in value}])
+                ops.append(['remove', key, {k: None for k in subkeys if k not in value}])
+        return json.dumps(ops, cls=util.MyEncoder)
+
+    def _append_journal(self):
+        """Append the pending changes, as one record."""
+        record = self.encrypt_before_writing(self._journal_record())
+        line = (record + '\n').encode('utf8')
+        if self._journal_size is None:
+            header = json.dumps({'journal': JOURNAL_VERSION, 'snapshot': self._snapshot_hash})
+            line = (header + '\n').encode('utf8') + line
+            mode, self._journal_size = 'wb', 0
+        else:
+            mode = 'ab'
+        with open(self.journal_path, mode) as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(self.journal_path, stat.S_IREAD | stat.S_IWRITE)
+        self._journal_size += len(line)
+        self._pending = {}
+        self.modified = False
+
+    def replay_journal(self, decrypt=None):
+        """Apply the records of the journal to the data of the wallet file.
+        The journal of another file (e.g. written before a compaction was
+        interrupted), and a record that was not completely written, are
+        discarded."""
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            lines = f.read().split(b'\n')
+        try:
+            header = json.loads(lines[0].decode('utf8'))
+        except ValueError:
+            header = {}
+        if header.get('journal') != JOURNAL_VERSION or header.get('snapshot') != self._snapshot_hash:
+            self.print_error("discarding journal of another wallet file")
+            os.remove(self.journal_path)
+            return
+        # a wallet that has a journal keeps using one
+        self.journal = True
+        size = len(lines[0]) + 1
+        for line in lines[1:-1]:
+            try:
+                record = line.decode('utf8')
+                ops = json.loads(decrypt(record) if decrypt else record)
+            except Exception as e:
+                self.print_error("journal ends with an incomplete record", repr(e))
+                break
+            self._apply(ops)
+            size += len(line) + 1
+        with open(self.journal_path, 'r+b') as f:
+            f.truncate(size)
+        self._journal_size = size
+
+    def _apply(self, ops):
+        for op in ops:
+            name, key = op[0], op[1]
+            if name == 'put':
+                self.data[key] = op[2]
+            elif name == 'del':
+                self.data.pop(key, None)
+            elif name == 'update':
+                if not isinstance(self.data.get(key), dict):
+                    self.data[key] = {}
+                self.data[key].update(op[2])
+            elif name == 'remove':
+                for k in op[2]:
+                    self.data.get(key, {}).pop(k, None)
 
     def encrypt_before_writing(self, plaintext: str) -> str:
         return plaintext
@@ -141,14 +301,15 @@ class JsonDB(PrintError):
 
 class WalletStorage(JsonDB):
 
-    def __init__(self, path, manual_upgrades=False):
+    def __init__(self, path, manual_upgrades=False, journal=False):
         self.print_error("wallet path", path)
-        JsonDB.__init__(self, path)
+        JsonDB.__init__(self, path, journal)
         self.manual_upgrades = manual_upgrades
         self.pubkey = None
         if self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
+            self._set_snapshot(self.raw)
             self._encryption_version = self._init_encryption_version()
             if not self.is_encrypted():
                 self.load_data(self.raw)
@@ -157,7 +318,7 @@ class WalletStorage(JsonDB):
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
-    def load_data(self, s):
+    def load_data(self, s, decrypt=None):
         try:
             self.data = json.loads(s)
         except:
@@ -176,6 +337,9 @@ class WalletStorage(JsonDB):
                     continue
                 self.data[key] = value
 
+        # upgrades are applied to the data with the journal replayed
+        self.replay_journal(decrypt)
+
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -253,7 +417,10 @@ class WalletStorage(JsonDB):
             s = None
         self.pubkey = ec_key.get_public_key_hex()
         s = s.decode('utf8')
-        self.load_data(s)
+        def decrypt_record(record):
+            enc_magic = self._get_encryption_magic()
+            return zlib.decompress(ec_key.decrypt_message(record, enc_magic)).decode('utf8')
+        self.load_data(s, decrypt_record)
 
     def encrypt_before_writing(self, plaintext: str) -> str:
         s = plaintext
@@ -287,9 +454,11 @@ class WalletStorage(JsonDB):
         else:
             self.pubkey = None
             self._encryption_version = STO_EV_PLAINTEXT
-        # make sure next storage.write() saves changes
+        # make sure next storage.write() saves changes, and that the
+        # journal records encrypted with the old key are compacted
         with self.db_lock:
             self.modified = True
+            self._needs_compaction = True
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -359,7 +528,7 @@ class WalletStorage(JsonDB):
         self.convert_version_18()
 
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
-        self.write()
+        self.write(compact=True)
 
     def convert_wallet_type(self):
         if not self._is_upgrade_method_needed(0, 13):
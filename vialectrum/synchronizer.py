@@ -58,6 +58,9 @@ class Synchronizer(PrintError):
         # Queues
         self.add_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
+        self._loop = None
+        self._wakeup_event = None
+        self.wakeups = 0
 
     def is_up_to_date(self):
         return (not self.requested_addrs
@@ -67,10 +70,16 @@ class Synchronizer(PrintError):
     def add(self, addr):
         self.requested_addrs.add(addr)
         self.add_queue.put_nowait(addr)
+        self.wakeup()
+
+    def wakeup(self):
+        """Check again whether the wallet needs new addresses, or is up to date.
+        Can be called from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup_event.set)
 
     async def on_address_status(self, addr, status):
-        history = self.wallet.history.get(addr, [])
-        if history_status(history) == status:
+        if self.wallet.get_history_status(addr) == status:
             return
         # note that at this point 'result' can be None;
         # if we had a history for addr but now the server is telling us
@@ -80,7 +89,8 @@ class Synchronizer(PrintError):
         # request address history
         self.requested_histories[addr] = status
         h = address_to_scripthash(addr)
-        result = await self.session.send_request("blockchain.scripthash.get_history", [h])
+        result = await self.network.multiplexer.send_request(self.session, "blockchain.scripthash.get_history",
+                                                             [h], tag=status)
         self.print_error("receiving history", addr, len(result))
         hashes = set(map(lambda item: item['tx_hash'], result))
         hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
@@ -95,12 +105,13 @@ class Synchronizer(PrintError):
             self.print_error("error: status mismatch: %s" % addr)
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, status)
             # Request transactions we don't have
             await self.request_missing_txs(hist)
 
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
+        self.wakeup()
 
         if self.wallet.network: self.wallet.network.notify('updated')
 
@@ -120,29 +131,42 @@ class Synchronizer(PrintError):
                 await group.spawn(self.get_transaction, tx_hash)
 
     async def get_transaction(self, tx_hash):
-        result = await self.session.send_request('blockchain.transaction.get', [tx_hash])
+        result = self.network.tx_store.get(tx_hash) if self.network.tx_store else None
+        if result is None:
+            result = await self.network.multiplexer.send_request(self.session, 'blockchain.transaction.get', [tx_hash])
         tx = Transaction(result)
         try:
             tx.deserialize()
         except Exception:
             self.print_msg("cannot deserialize transaction, skipping", tx_hash)
+            self._forget_tx(tx_hash)
             return
         if tx_hash != tx.txid():
             self.print_error("received tx does not match expected txid ({} != {})"
                              .format(tx_hash, tx.txid()))
+            self._forget_tx(tx_hash)
             return
+        self.network.store_transaction(tx)
         tx_height = self.requested_tx.pop(tx_hash)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        self.wakeup()
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
         # callbacks
         self.wallet.network.trigger_callback('new_transaction', tx)
 
+    def _forget_tx(self, tx_hash):
+        # not requested anymore, so that up_to_date can be True. The tx is
+        # requested again with the next history of one of its addresses
+        self.requested_tx.pop(tx_hash, None)
+        self.wakeup()
+
     async def subscribe_to_address(self, addr):
         h = address_to_scripthash(addr)
         self.scripthash_to_address[h] = addr
         await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
         self.requested_addrs.remove(addr)
+        self.wakeup()
 
     async def send_subscriptions(self, group: TaskGroup):
         while True:
@@ -155,6 +179,10 @@ class Synchronizer(PrintError):
             addr = self.scripthash_to_address[h]
             await group.spawn(self.on_address_status, addr, status)
 
+    @property
+    def network(self):
+        return self.wallet.network
+
     @property
     def session(self):
         s = self.wallet.network.interface.session
@@ -162,6 +190,8 @@ class Synchronizer(PrintError):
         return s
 
     async def main(self):
+        self._loop = asyncio.get_event_loop()
+        self._wakeup_event = asyncio.Event()
         # request missing txns, if any
         async with TaskGroup() as group:
             for history in self.wallet.history.values():
@@ -172,11 +202,21 @@ class Synchronizer(PrintError):
         # add addresses to bootstrap
         for addr in self.wallet.get_addresses():
             self.add(addr)
-        # main loop
-        while True:
-            await asyncio.sleep(0.1)
-            self.wallet.synchronize()
-            up_to_date = self.is_up_to_date()
-            if up_to_date != self.wallet.is_up_to_date():
-                self.wallet.set_up_to_date(up_to_date)
-                self.wallet.network.trigger_callback('updated')
+        # main loop, woken up when requests complete, addresses are added,
+        # or on new headers (the age of addresses changes)
+        self.network.register_callback(self._on_network_updated, ['updated'])
+        try:
+            while True:
+                self._wakeup_event.clear()
+                self.wakeups += 1
+                self.wallet.synchronize()
+                up_to_date = self.is_up_to_date()
+                if up_to_date != self.wallet.is_up_to_date():
+                    self.wallet.set_up_to_date(up_to_date)
+                    self.wallet.network.trigger_callback('updated')
+                await self._wakeup_event.wait()
+        finally:
+            self.network.unregister_callback(self._on_network_updated)
+
+    def _on_network_updated(self, event):
+        self.wakeup()
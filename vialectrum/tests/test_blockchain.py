@@ -0,0 +1,284 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from vialectrum import blockchain, constants
+from vialectrum.checkpoints import Checkpoints, CheckpointFileError, write_checkpoints
+from vialectrum.simple_config import SimpleConfig
+from vialectrum.util import bfh, bh2u
+
+from . import SequentialTestCase
+from .test_scrypt import VECTORS
+
+
+class TestBlockchain(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_blockchain")})
+
+    def test_pow_hash_chunks(self):
+        # the 'ff' header has the auxpow version bit set
+        chunks = [bfh(''.join(h for h, _ in VECTORS[2:])), bfh(''.join(h for h, _ in VECTORS[:2]))]
+        expected = [[blockchain.hash_encode(bfh(h)) for _, h in VECTORS[2:]],
+                    [blockchain.hash_encode(bfh(VECTORS[0][1])), None]]
+        self.assertEqual(expected, blockchain.pow_hash_chunks(chunks))
+        slice_size = blockchain.POW_HASH_SLICE
+        blockchain.POW_HASH_SLICE = 1
+        try:
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                self.assertEqual(expected, blockchain.pow_hash_chunks(chunks, executor))
+        finally:
+            blockchain.POW_HASH_SLICE = slice_size
+
+    def test_no_executor_unless_enabled(self):
+        self.assertIsNone(blockchain.get_pow_executor(self.config))
+
+    def _make_headers(self, n, nonce=0):
+        headers = []
+        prev_hash = '00' * 32
+        for height in range(n):
+            header = {'version': 2, 'prev_block_hash': prev_hash, 'merkle_root': '%064x' % height,
+                      'timestamp': 1500000000 + height, 'bits': 0x1e0fffff, 'nonce': nonce,
+                      'block_height': height}
+            headers.append(header)
+            prev_hash = blockchain.hash_header(header)
+        return headers
+
+    def _make_chain(self):
+        chain = blockchain.Blockchain(self.config, 0, None)
+        open(chain.path(), 'wb').close()
+        return chain
+
+    def test_read_header_from_mmap(self):
+        chain = self._make_chain()
+        self.assertIsNone(chain.read_header(0))
+        headers = self._make_headers(3)
+        for header in headers:
+            chain.save_header(header)
+            # appending remaps the file
+            self.assertEqual(header, chain.read_header(header['block_height']))
+        self.assertEqual(2, chain.height())
+        raw = chain.read_raw_header(1)
+        self.assertIsInstance(raw, memoryview)
+        self.assertEqual(blockchain.serialize_header(headers[1]), bh2u(raw))
+        del raw
+        self.assertIsNone(chain.read_header(3))
+
+    def test_read_header_after_truncation(self):
+        chain = self._make_chain()
+        for header in self._make_headers(3):
+            chain.save_header(header)
+        self.assertIsNotNone(chain.read_header(2))
+        chain.write(b'', 80)
+        self.assertEqual(0, chain.height())
+        self.assertIsNone(chain.read_header(1))
+        other = self._make_headers(2, nonce=1)[1]
+        chain.save_header(other)
+        self.assertEqual(other, chain.read_header(1))
+        self.assertEqual(2 * 80, os.path.getsize(chain.path()))
+
+    def test_header_cache(self):
+        chain = self._make_chain()
+        headers = self._make_headers(3)
+        for header in headers:
+            chain.save_header(header)
+        cache = chain.header_cache
+        self.assertEqual(blockchain.hash_header(headers[2]), chain.get_hash(2))
+        misses = cache.misses
+        self.assertEqual(blockchain.hash_header(headers[2]), chain.get_hash(2))
+        self.assertEqual(headers[2], chain.read_header(2))
+        self.assertEqual(misses, cache.misses)
+        self.assertEqual(2, cache.hits)
+        # returned headers are copies
+        chain.read_header(2)['nonce'] = 42
+        self.assertEqual(headers[2], chain.read_header(2))
+        # writes invalidate the cache
+        chain.write(b'', 80)
+        self.assertEqual(0, cache.get_stats()['size'])
+        with self.assertRaises(blockchain.MissingHeader):
+            chain.get_hash(2)
+
+    def test_header_cache_is_bounded(self):
+        self.config.set_key('header_cache_size', 2)
+        chain = self._make_chain()
+        for header in self._make_headers(5):
+            chain.save_header(header)
+        for height in range(1, 5):
+            chain.get_hash(height)
+        self.assertEqual({'hits': 0, 'misses': 4, 'size': 2, 'max_size': 2}, chain.header_cache.get_stats())
+        chain.get_hash(4)
+        chain.get_hash(1)
+        self.assertEqual(1, chain.header_cache.hits)
+
+    def test_buffered_header_appends(self):
+        self.config.set_key('headers_sync_policy', blockchain.HEADERS_SYNC_COUNT)
+        self.config.set_key('headers_sync_count', 3)
+        chain = self._make_chain()
+        headers = self._make_headers(5)
+        for header in headers[:2]:
+            chain.save_header(header)
+        # buffered headers are readable, but not yet on disk
+        self.assertEqual(1, chain.height())
+        self.assertEqual(headers[1], chain.read_header(1))
+        self.assertEqual(0, os.path.getsize(chain.path()))
+        chain.save_header(headers[2])
+        self.assertEqual(3 * 80, os.path.getsize(chain.path()))
+        chain.save_header(headers[3])
+        self.assertEqual(3 * 80, os.path.getsize(chain.path()))
+        self.assertEqual(blockchain.hash_header(headers[3]), chain.get_hash(3))
+        # other writes flush the buffer first
+        chain.write(b'', 3 * 80)
+        self.assertEqual(2, chain.height())
+        self.assertIsNone(chain.read_header(3))
+        chain.save_header(headers[3])
+        chain.flush()
+        self.assertEqual(4 * 80, os.path.getsize(chain.path()))
+        self.assertEqual(headers[3], chain.read_header(3))
+
+    def test_chunk_sync_policy(self):
+        self.config.set_key('headers_sync_policy', blockchain.HEADERS_SYNC_CHUNK)
+        chain = self._make_chain()
+        chain.write(bytes(2014 * 80), 0)
+        prev_hash = '00' * 32
+        for height in (2014, 2015, 2016):
+            header = {'version': 2, 'prev_block_hash': prev_hash, 'merkle_root': '00' * 32,
+                      'timestamp': 0, 'bits': 0, 'nonce': 0, 'block_height': height}
+            chain.save_header(header)
+            prev_hash = blockchain.hash_header(header)
+            on_disk = os.path.getsize(chain.path()) // 80
+            self.assertEqual(2016 if height >= 2015 else 2014, on_disk)
+
+    def test_target_cache(self):
+        checkpoints = constants.net.CHECKPOINTS
+        constants.net.CHECKPOINTS = []
+        try:
+            chain = self._make_chain()
+            chain.write(b''.join(bfh(blockchain.serialize_header(h)) for h in self._make_headers(2016)), 0)
+            target = chain.compute_target(0)
+            self.assertEqual(target, chain.get_target(0))
+            self.assertIn(0, chain._targets)
+            # persisted when flushed, and checked against the chain before use
+            self.assertEqual({}, blockchain._load_targets(self.config, 'blockchain_headers'))
+            chain.flush_targets()
+            chain = blockchain.Blockchain(self.config, 0, None)
+            self.assertIn(0, chain._unverified_targets)
+            self.assertEqual(target, chain.get_target(0))
+            self.assertIn(0, chain._targets)
+            blockchain._save_targets(self.config, 'blockchain_headers', {0: ('00' * 32, 1)})
+            chain = blockchain.Blockchain(self.config, 0, None)
+            self.assertEqual(target, chain.get_target(0))
+            # truncating the chunk invalidates its target
+            chain.write(b'', 2000 * 80)
+            self.assertEqual({}, chain._targets)
+            self.assertEqual({}, blockchain._load_targets(self.config, 'blockchain_headers'))
+        finally:
+            constants.net.CHECKPOINTS = checkpoints
+
+
+class TestSparseHeaders(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_blockchain")})
+        self.checkpoints = constants.net.CHECKPOINTS
+        constants.net.CHECKPOINTS = [('00' * 32, blockchain.MAX_TARGET, 0)] * 2
+        self.headers_path = os.path.join(self.config.path, 'blockchain_headers')
+        self.store_path = os.path.join(self.config.path, 'checkpoint_chunks')
+
+    def tearDown(self):
+        if blockchain.chunk_store is not None:
+            blockchain.chunk_store.close_mmap()
+        blockchain.chunk_store = None
+        constants.net.CHECKPOINTS = self.checkpoints
+        super().tearDown()
+
+    def _chunk(self, index):
+        return b''.join(bfh(blockchain.serialize_header(
+            {'version': 2, 'prev_block_hash': '00' * 32, 'merkle_root': '%064x' % (index * 2016 + i),
+             'timestamp': 0, 'bits': 0, 'nonce': 0})) for i in range(2016))
+
+    def _tail_header(self):
+        return {'version': 2, 'prev_block_hash': '11' * 32, 'merkle_root': '22' * 32,
+                'timestamp': 0, 'bits': 0, 'nonce': 0, 'block_height': 2 * 2016}
+
+    def test_chunks_are_stored_on_demand(self):
+        self.config.set_key('sparse_headers', True)
+        store = blockchain.init_chunk_store(self.config)
+        chain = blockchain.Blockchain(self.config, 0, None)
+        open(chain.path(), 'wb').close()
+        self.assertEqual(2 * 2016 - 1, chain.height())
+        self.assertIsNone(chain.read_header(2016 + 5))
+        chain.save_chunk(1, self._chunk(1))
+        self.assertEqual([1], store.get_chunks())
+        self.assertFalse(store.has_chunk(0))
+        self.assertEqual(bh2u(self._chunk(1)[5*80:6*80]), bh2u(chain.read_raw_header(2016 + 5)))
+        self.assertEqual('%064x' % (2016 + 5), chain.read_header(2016 + 5)['merkle_root'])
+        self.assertIsNone(chain.read_header(5))
+        # headers after the checkpoints go to the headers file
+        chain.save_header(self._tail_header())
+        self.assertEqual(2 * 2016, chain.height())
+        self.assertEqual(80, os.path.getsize(self.headers_path))
+        self.assertEqual(self._tail_header(), chain.read_header(2 * 2016))
+        # the index is rebuilt on load
+        self.assertEqual([1], blockchain.ChunkStore(self.store_path, 0).get_chunks())
+
+    def test_convert_headers_file(self):
+        with open(self.headers_path, 'wb') as f:
+            f.write(bytes(blockchain.ChunkStore.CHUNK_SIZE))
+            f.write(self._chunk(1))
+            f.write(bfh(blockchain.serialize_header(self._tail_header())))
+        self.config.set_key('sparse_headers', True)
+        store = blockchain.init_chunk_store(self.config)
+        self.assertEqual([1], store.get_chunks())
+        self.assertEqual(80, os.path.getsize(self.headers_path))
+        chain = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(2 * 2016, chain.height())
+        self.assertEqual(self._tail_header(), chain.read_header(2 * 2016))
+        self.assertEqual('%064x' % 2016, chain.read_header(2016)['merkle_root'])
+        del chain
+        # and back
+        self.config.set_key('sparse_headers', False)
+        self.assertIsNone(blockchain.init_chunk_store(self.config))
+        self.assertFalse(os.path.exists(self.store_path))
+        self.assertEqual(2 * blockchain.ChunkStore.CHUNK_SIZE + 80, os.path.getsize(self.headers_path))
+        chain = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(2 * 2016, chain.height())
+        self.assertIsNone(chain.read_header(5))
+        self.assertEqual('%064x' % 2016, chain.read_header(2016)['merkle_root'])
+        self.assertEqual(self._tail_header(), chain.read_header(2 * 2016))
+
+
+class TestCheckpoints(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(tempfile.mkdtemp(prefix="test_checkpoints"), 'checkpoints.bin')
+
+    def test_roundtrip(self):
+        cps = [('%064x' % i, blockchain.MAX_TARGET >> i, 1400000000 + i) for i in range(10)]
+        write_checkpoints(self.path, cps)
+        loaded = Checkpoints(self.path)
+        self.assertEqual(10, len(loaded))
+        self.assertEqual(cps, list(loaded))
+        self.assertEqual(cps[-1], loaded[-1])
+        self.assertEqual(cps[2:4], loaded[2:4])
+        with self.assertRaises(IndexError):
+            loaded[10]
+
+    def test_missing_file_is_empty(self):
+        self.assertEqual(0, len(Checkpoints(self.path)))
+
+    def test_bad_magic(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00' * 100)
+        with self.assertRaises(CheckpointFileError):
+            len(Checkpoints(self.path))
+
+    def test_shipped_checkpoints(self):
+        cps = constants.BitcoinMainnet.CHECKPOINTS
+        self.assertTrue(len(cps) > 0)
+        block_hash, target, timestamp = cps[0]
+        self.assertEqual("30d1ca220148d6215862e012194f0187a86ea33333fc6ca1e93a05adc39d71e4", block_hash)
+        self.assertEqual(13803387381289459017682813806526367234469899049245372561213794136621056, target)
+        self.assertEqual(1405610669, timestamp)
@@ -1,11 +1,23 @@
 import asyncio
 import tempfile
+import threading
+import time
 import unittest
 
+import aiorpcx
+
 from vialectrum import constants
 from vialectrum.simple_config import SimpleConfig
 from vialectrum import blockchain
-from vialectrum.interface import Interface
+from vialectrum.bitcoin import address_to_script
+from vialectrum.interface import Interface, NotificationSession
+from vialectrum.multiplexer import RequestMultiplexer
+from vialectrum.network import Network
+from vialectrum.transaction import Transaction
+from vialectrum.util import TimeoutException
+
+from . import SequentialTestCase
+from vialectrum.scripts.standin_server import Fixtures, StandInServer, make_addresses, make_tx
 
 class MockInterface(Interface):
     def __init__(self, config):
@@ -22,6 +34,47 @@ class MockInterface(Interface):
         assert assert_mode in item['mock'], (assert_mode, item)
         return item
 
+class MockSession:
+    def __init__(self, fill, requested_chunks=()):
+        self.fill = fill
+        self.requests = []
+        self.requested_chunks = requested_chunks
+        self.in_flight = set()
+    def is_closing(self):
+        return False
+    async def send_request(self, method, params):
+        assert method == 'blockchain.block.headers', method
+        self.requests.append(params[0] // 2016)
+        self.in_flight.update(self.requested_chunks)
+        await asyncio.sleep(0)
+        if self.fill == 'error':
+            raise OSError('connection lost')
+        if self.fill == 'cancel':
+            raise asyncio.CancelledError()
+        return {'hex': self.fill * 80 * params[1], 'count': params[1]}
+
+class MockChain:
+    def __init__(self):
+        self.connected = []
+    def connect_chunk(self, index, hexdata, pow_hashes):
+        assert len(pow_hashes) == len(hexdata) // 160
+        if hexdata.startswith('ff'):
+            return False
+        self.connected.append(index)
+        return True
+
+class MockNetwork:
+    def __init__(self, config):
+        self.config = config
+        self.interface_lock = threading.RLock()
+        self.interfaces = {}
+        self.requested_chunks = set()
+        self.chain = MockChain()
+    def blockchain(self):
+        return self.chain
+    def notify(self, key):
+        pass
+
 class TestNetwork(unittest.TestCase):
 
     @classmethod
@@ -114,6 +167,412 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
         self.assertEqual(times, 2)
 
+    def _pipelined_interfaces(self, other_fill):
+        network = MockNetwork(self.config)
+        ifa = self.interface
+        ifa.network = network
+        ifa.session = MockSession('00', network.requested_chunks)
+        other = MockInterface(self.config)
+        other.session = MockSession(other_fill)
+        other.tip = ifa.tip = 4 * 2016
+        other.ready.set_result(True)
+        network.interfaces = {ifa.server: ifa, 'other': other}
+        # do not let them connect for real
+        ifa.fut.cancel()
+        other.fut.cancel()
+        return ifa, other
+
+    def test_request_chunks(self):
+        ifa, other = self._pipelined_interfaces('00')
+        res = asyncio.get_event_loop().run_until_complete(ifa.request_chunks(2016 + 5, 4 * 2016 - 10))
+        self.assertEqual((True, 3 * 2016 - 10), res)
+        self.assertEqual([1, 2, 3], ifa.network.chain.connected)
+        self.assertEqual([1, 3], ifa.session.requests)
+        self.assertEqual([2], other.session.requests)
+        # pipelined chunks are not requested again by request_chunk
+        self.assertEqual({1, 2, 3}, ifa.session.in_flight)
+        self.assertEqual(set(), ifa.network.requested_chunks)
+
+    def test_request_chunks_from_other_branch(self):
+        ifa, other = self._pipelined_interfaces('ff')
+        res = asyncio.get_event_loop().run_until_complete(ifa.request_chunks(2016, 4 * 2016))
+        self.assertEqual((True, 3 * 2016), res)
+        self.assertEqual([1, 2, 3], ifa.network.chain.connected)
+        # the chunk served by the other interface was requested again
+        self.assertEqual([1, 3, 2], ifa.session.requests)
+
+    def test_request_chunks_other_server_fails(self):
+        for fill in ('error', 'cancel'):
+            ifa, other = self._pipelined_interfaces(fill)
+            res = asyncio.get_event_loop().run_until_complete(ifa.request_chunks(2016, 4 * 2016))
+            self.assertEqual((True, 3 * 2016), res)
+            self.assertEqual([1, 2, 3], ifa.network.chain.connected)
+            self.assertEqual([1, 3, 2], ifa.session.requests)
+
+class EchoServerSession(aiorpcx.ServerSession):
+    frames = 0
+    def data_received(self, data):
+        EchoServerSession.frames += data.count(b'\n')
+        super().data_received(data)
+    async def handle_request(self, request):
+        if request.method == 'fail':
+            raise aiorpcx.RPCError(1, 'failed')
+        return request.args
+
+
+class TestRequestBatching(unittest.TestCase):
+
+    def _run(self, max_batch_size, num_requests):
+        async def run():
+            server = aiorpcx.Server(EchoServerSession, 'localhost', 0)
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+            try:
+                session = NotificationSession('localhost', port, max_batch_size=max_batch_size)
+                await session.create_connection()
+                methods = ['fail' if i == 3 else 'echo' for i in range(num_requests)]
+                results = await asyncio.gather(*[session.send_request(method, [i])
+                                                 for i, method in enumerate(methods)],
+                                               return_exceptions=True)
+                session.transport.close()
+                return results, session.frames_sent
+            finally:
+                await server.close()
+        EchoServerSession.frames = 0
+        return asyncio.get_event_loop().run_until_complete(run())
+
+    def test_requests_are_batched(self):
+        results, frames_sent = self._run(10, 25)
+        self.assertEqual(3, frames_sent)
+        self.assertEqual(3, EchoServerSession.frames)
+        self.assertIsInstance(results[3], aiorpcx.RPCError)
+        self.assertEqual([[i] for i in range(25) if i != 3], [r for r in results if r is not results[3]])
+
+    def test_batching_disabled(self):
+        results, frames_sent = self._run(1, 5)
+        self.assertEqual(5, frames_sent)
+        self.assertEqual([[0], [1], [2], [4]], [r for r in results if r is not results[3]])
+
+
+class StandInNetworkTestCase(SequentialTestCase):
+    """Runs a Network against stand-in servers (scripts/standin_server),
+    the first one being the main server."""
+
+    def setUp(self):
+        super().setUp()
+        constants.set_regtest()
+        self.addresses = make_addresses(10)
+        self.fixtures = self._make_fixtures()
+        constants.net = self.fixtures.make_net()
+        self.servers = []
+        self.sessions = []
+        self.network = None
+        self.loop = asyncio.get_event_loop()
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.transport.close()
+        if self.network is not None:
+            self.network.stop()
+            self.network.join()
+            self._close_loop(self.network.asyncio_loop)
+            asyncio.set_event_loop(self.loop)
+        for server in self.servers:
+            server.stop_thread()
+        constants.set_mainnet()
+        blockchain.blockchains = {}
+        super().tearDown()
+
+    def _close_loop(self, loop):
+        # tasks left in the loop, e.g. of interfaces, are cancelled now
+        # rather than when it is garbage collected, during another test
+        self._wait_for(lambda: not loop.is_running())
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks, timeout=5))
+        loop.close()
+
+    def _make_fixtures(self):
+        return Fixtures(self.addresses, txs_per_block=5, num_blocks=20)
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def _wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.02)
+
+    def start_servers(self, num_servers, fixtures=None):
+        """Servers with the same chain, unless fixtures are given."""
+        for i in range(num_servers):
+            server = StandInServer(fixtures[i] if fixtures else
+                                   self.fixtures if not self.servers else self._make_fixtures())
+            server.start_in_thread()
+            self.servers.append(server)
+        return self.servers
+
+    def start_network(self, **config):
+        """Network connected to all servers, in its own event loop.
+        The other servers are connected once the main one is synced."""
+        config.update({'electrum_path': tempfile.mkdtemp(prefix="test_network"),
+                       'server': self.servers[0].server_string,
+                       'oneserver': True, 'auto_connect': False})
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.network = network = Network(SimpleConfig(config))
+        network.start()
+        self._wait_for(lambda: network.is_connected() and self._is_synced(self.servers[0]))
+        for server in self.servers[1:]:
+            self._in_network(network.start_interface, server.server_string)
+        self._wait_for(lambda: all(self._is_synced(server) for server in self.servers))
+        return network
+
+    def _is_synced(self, server):
+        interface = self.network.interfaces.get(server.server_string)
+        return (interface is not None and interface.tip == server.fixtures.height()
+                and interface.blockchain.check_header(interface.tip_header))
+
+    def set_rtts(self, rtts):
+        """Scores of the servers in rtts, whatever was measured."""
+        for server, rtt in rtts.items():
+            for i in range(50):
+                self.network.server_scores.record_rtt(server.server_string, rtt)
+
+    def _in_network(self, func, *args):
+        async def call():
+            return func(*args)
+        return self._run_in_network(call())
+
+    def _run_in_network(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.network.asyncio_loop).result()
+
+    def open_session(self, server):
+        """Session of the test's own event loop, e.g. for a multiplexer."""
+        session = NotificationSession('localhost', server.port)
+        self._run(session.create_connection())
+        self.sessions.append(session)
+        return session
+
+
+class TestRequestMultiplexer(StandInNetworkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server, = self.start_servers(1)
+        self.session = self.open_session(self.server)
+        self.multiplexer = RequestMultiplexer(cache_size=10)
+        self.txid, self.raw_tx = next(iter(self.fixtures.txs.items()))
+
+    def _gather(self, *requests, session=None):
+        return self._run(asyncio.gather(
+            *[self.multiplexer.send_request(session or self.session, *r) for r in requests],
+            return_exceptions=True))
+
+    def _sent(self, method):
+        return self.server.stats.get(method, 0)
+
+    def test_identical_requests_are_shared(self):
+        scripthash = self.fixtures.address_scripthash[self.addresses[0]]
+        history = ('blockchain.scripthash.get_history', [scripthash])
+        results = self._gather(history + ('s1',), history + ('s1',), history + ('s2',))
+        self.assertEqual([self.fixtures.get_history(scripthash)] * 3, results)
+        # different expected status
+        self.assertEqual(2, self._sent('blockchain.scripthash.get_history'))
+        self.assertEqual({'requests': 3, 'sent': 2, 'in_flight': 0, 'cached': 0}, self.multiplexer.get_stats())
+        # histories are not cached
+        self._gather(history + ('s1',))
+        self.assertEqual(3, self._sent('blockchain.scripthash.get_history'))
+
+    def test_transactions_are_cached(self):
+        tx = ('blockchain.transaction.get', [self.txid])
+        self.assertEqual([self.raw_tx] * 2, self._gather(tx, tx))
+        self._gather(tx)
+        self.assertEqual(1, self._sent('blockchain.transaction.get'))
+        self.assertEqual(1, self.multiplexer.get_stats()['cached'])
+
+    def test_wrong_transactions_are_not_cached(self):
+        self.fixtures.txs['cd' * 32] = self.raw_tx
+        tx = ('blockchain.transaction.get', ['cd' * 32])
+        self.assertEqual([self.raw_tx], self._gather(tx))
+        self._gather(tx)
+        self.assertEqual(2, self._sent('blockchain.transaction.get'))
+        self.assertEqual(0, self.multiplexer.get_stats()['cached'])
+
+    def test_requests_are_not_shared_between_sessions(self):
+        other = self.open_session(self.server)
+        history = ('blockchain.scripthash.get_history', [self.fixtures.address_scripthash[self.addresses[0]]])
+        async def run():
+            return await asyncio.gather(self.multiplexer.send_request(self.session, *history),
+                                        self.multiplexer.send_request(other, *history))
+        self._run(run())
+        self.assertEqual(2, self._sent('blockchain.scripthash.get_history'))
+        # cached transactions are, as they are checked
+        tx = ('blockchain.transaction.get', [self.txid])
+        self._gather(tx)
+        self.assertEqual([self.raw_tx], self._gather(tx, session=other))
+        self.assertEqual(1, self._sent('blockchain.transaction.get'))
+
+    def test_errors_are_shared_and_not_cached(self):
+        self.server.error_rate = 1
+        tx = ('blockchain.transaction.get', [self.txid])
+        results = self._gather(tx, tx)
+        self.assertTrue(all(isinstance(r, aiorpcx.RPCError) for r in results))
+        self._gather(tx)
+        self.assertEqual(2, self._sent('blockchain.transaction.get'))
+        self.assertEqual(2, self.server.stats['errors'])
+
+    def test_cancelled_caller(self):
+        self.server.delay = 0.05
+        tx = ('blockchain.transaction.get', [self.txid])
+        async def run():
+            first = asyncio.ensure_future(self.multiplexer.send_request(self.session, *tx))
+            second = asyncio.ensure_future(self.multiplexer.send_request(self.session, *tx))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+        self.assertEqual(self.raw_tx, self._run(run()))
+
+
+class TestSwitchSlowInterface(StandInNetworkTestCase):
+
+    def _switch_slow_interface(self, rtts):
+        self.set_rtts(rtts)
+        self.network.auto_connect = True
+        self._in_network(self.network.switch_slow_interface)
+        return self.network.default_server
+
+    def test_switch_to_much_better_server(self):
+        main, better, fast = self.start_servers(3)
+        self.start_network()
+        self.assertEqual(main.server_string,
+                         self._switch_slow_interface({main: 1.0, better: 0.5, fast: 0.5}))
+        self.assertEqual(fast.server_string, self._switch_slow_interface({fast: 0.05}))
+
+    def test_lagging_servers_and_forks_are_ignored(self):
+        main_chain, lagging_chain, fork_chain = [self._make_fixtures() for i in range(3)]
+        main_chain.add_blocks(2)
+        fork_chain.block_txs[fork_chain.height() + 1] = ['ab' * 32]
+        fork_chain.add_blocks(5)
+        main, lagging, fork = self.start_servers(3, fixtures=[main_chain, lagging_chain, fork_chain])
+        network = self.start_network()
+        self.assertIsNot(network.blockchain(), network.interfaces[fork.server_string].blockchain)
+        self.assertEqual(main.server_string,
+                         self._switch_slow_interface({main: 1.0, lagging: 0.05, fork: 0.05}))
+
+
+class TestBroadcast(StandInNetworkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tx = Transaction(make_tx(b'payment', address_to_script(self.addresses[0]), 1000))
+
+    def _broadcasts(self):
+        return [server.stats.get('blockchain.transaction.broadcast', 0) for server in self.servers]
+
+    def test_only_main_server_by_default(self):
+        main, other = self.start_servers(2)
+        self.start_network()
+        result = self._run_in_network(self.network.broadcast_transaction_to_servers(self.tx, timeout=1))
+        self.assertTrue(result.success)
+        self.assertEqual({main.server_string: self.tx.txid()}, result.outcomes)
+        self.assertEqual([1, 0], self._broadcasts())
+        self.assertIn(self.tx.txid(), main.fixtures.mempool)
+
+    def test_first_success_is_returned(self):
+        slow, reject, ok, unused = self.start_servers(4)
+        self.start_network(broadcast_servers=2)
+        self.set_rtts({reject: 0.01, ok: 0.02, unused: 1.0})
+        slow.delay = 2
+        reject.error_rate = 1
+        result = self._run_in_network(self.network.broadcast_transaction_to_servers(self.tx, timeout=1))
+        self.assertTrue(result.success)
+        self.assertEqual(self.tx.txid(), result.msg)
+        self.assertNotIn(slow.server_string, result.outcomes)
+        # main server, and the two best others
+        self._wait_for(lambda: self._broadcasts() == [1, 1, 1, 0])
+
+    def test_rejection(self):
+        self.start_servers(2)
+        self.start_network(broadcast_servers=1)
+        success, msg = self._run_in_network(self.network.broadcast_transaction(Transaction('00'), timeout=1))
+        self.assertFalse(success)
+        self.assertIn('rejected', msg)
+        self.assertEqual([1, 1], self._broadcasts())
+
+    def test_offline_broadcasts_are_queued(self):
+        server, = self.start_servers(1)
+        self.start_network()
+        server.timeout_rate = 1
+        results = self._run_in_network(self.network.broadcast_transactions([self.tx], timeout=0.2))
+        self.assertEqual((False, "error: operation timed out", {server.server_string: "error: operation timed out"}, True),
+                         results[0])
+        # queue is persisted
+        self.assertEqual({self.tx.txid(): str(self.tx)}, self.network.read_broadcast_queue())
+        server.timeout_rate = 0
+        self._run_in_network(self.network.retry_queued_broadcasts())
+        self.assertEqual({}, self.network.read_broadcast_queue())
+        self.assertIn(self.tx.txid(), server.fixtures.mempool)
+
+
+class TestGetTransactions(StandInNetworkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server, = self.start_servers(1)
+        self.txid, self.raw_tx = next(iter(self.fixtures.txs.items()))
+        self.fixtures.txs['00' * 32] = self.raw_tx
+        self.fixtures.txs['11' * 32] = 'not a transaction'
+
+    def test_concurrent_fetch(self):
+        self.start_network(tx_prefetch_concurrency=3)
+        self.server.delay = 0.01
+        tx_hashes = [self.txid, '00' * 32] + ['%064x' % i for i in range(1, 9)]
+        results = self.network.get_transactions(tx_hashes, timeout=5)
+        # mismatching and unknown transactions are left out
+        self.assertEqual({self.txid: self.raw_tx}, results)
+        self.assertEqual(10, self.server.stats['blockchain.transaction.get'])
+        self.assertEqual(3, self.server.max_in_flight)
+
+    def test_reply_is_checked(self):
+        self.start_network()
+        self.assertEqual(self.raw_tx, self.network.get_transaction(self.txid))
+        # mismatching and undeserializable transactions
+        self.assertIsNone(self.network.get_transaction('00' * 32))
+        self.assertIsNone(self.network.get_transaction('11' * 32))
+
+
+class TestListunspent(StandInNetworkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server, = self.start_servers(1)
+
+    def test_concurrent_lookup(self):
+        self.start_network(listunspent_concurrency=4)
+        self.server.delay = 0.01
+        # those of the fixtures, and unused ones
+        scripthashes = list(self.fixtures.address_scripthash.values()) + ['%064x' % i for i in range(10)]
+        streamed = []
+        results = self.network.listunspent_for_scripthashes(scripthashes + scripthashes[:1], 5,
+                                                            lambda sh, utxos: streamed.append((sh, utxos)))
+        self.assertEqual(20, len(results))
+        self.assertEqual(self.fixtures.utxos[scripthashes[0]], results[scripthashes[0]])
+        self.assertEqual([], results['%064x' % 0])
+        self.assertEqual(sorted(results.items()), sorted(streamed))
+        # duplicates are requested once
+        self.assertEqual(20, self.server.stats['blockchain.scripthash.listunspent'])
+        self.assertEqual(4, self.server.max_in_flight)
+
+    def test_timeout(self):
+        self.start_network()
+        self.server.timeout_rate = 1
+        with self.assertRaises(TimeoutException):
+            self.network.listunspent_for_scripthashes(list(self.fixtures.address_scripthash.values()), 0.1)
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
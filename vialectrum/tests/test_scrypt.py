@@ -0,0 +1,55 @@
+from unittest import mock
+
+from vialectrum import blockchain
+from vialectrum import scrypt
+from vialectrum.bitcoin import hash_encode
+from vialectrum.util import bfh
+
+from . import SequentialTestCase
+
+
+VECTORS = [
+    ("00"*80, "161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69"),
+    ("ff"*80, "5253069c14ecedf978745486375ee37415e977f55cdbedac31ebee8bf33dd127"),
+    ("010000000000000000000000000000000000000000000000000000000000000000000000d9ced4ed1130f7b7faad9be25323ffafa33232a17c3edf6cfd97bee6bafbdd97b9aa8e4ef0ff0f1ecd513f7c", "001e67b013726fd7382e9acb69165b4b6316227fb3156b5b414ba6340c050000"),
+    ("01000000ae178934851bfa0e83ccb6a3fc4bfddff3641e104b6c4680c31509074e699be2bd672d8d2199ef37a59678f92443083e3b85edef8b45c71759371f823bab59a97126614f44d5001d45920180", "01796dae1f78a72dfb09356db6f027cd884ba0201e6365b72aa54b3b00000000"),
+]
+
+
+class Test_scrypt(SequentialTestCase):
+
+    def test_reference(self):
+        header, expected = VECTORS[0]
+        self.assertEqual(bfh(expected), scrypt.scrypt_1024_1_1_80(bfh(header)))
+
+    def test_all_backends(self):
+        headers = [bfh(header) for header, _ in VECTORS]
+        expected = [bfh(h) for _, h in VECTORS]
+        for name, hash_func, batch_func in scrypt.get_backends():
+            if name == 'python':
+                continue  # slow; covered by test_reference
+            with self.subTest(backend=name):
+                self.assertEqual(expected, list(map(hash_func, headers)))
+                self.assertEqual(expected, batch_func(headers))
+
+    def test_pow_hashes_with_each_backend(self):
+        # the headers of the vectors that are real block headers
+        raw_headers = [bfh(header) for header, _ in VECTORS[2:]]
+        expected = [hash_encode(bfh(h)) for _, h in VECTORS[2:]]
+        for name, hash_func, batch_func in scrypt.get_backends():
+            if name == 'python':
+                raw_headers, expected = raw_headers[:1], expected[:1]  # slow
+            with self.subTest(backend=name), \
+                    mock.patch.object(blockchain, 'getPoWHash', hash_func), \
+                    mock.patch.object(blockchain, 'getPoWHashes', batch_func):
+                headers = [blockchain.deserialize_header(raw, 0) for raw in raw_headers]
+                self.assertEqual(expected, [blockchain.pow_hash_header(h) for h in headers])
+                self.assertEqual(expected, blockchain._pow_hashes_worker(raw_headers))
+
+    def test_invalid_header_length(self):
+        for name, hash_func, batch_func in scrypt.get_backends():
+            with self.subTest(backend=name):
+                with self.assertRaises(ValueError):
+                    hash_func(b'\x00' * 79)
+                with self.assertRaises(ValueError):
+                    batch_func([b'\x00' * 79])
@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+from vialectrum.server_scores import ServerScores
+
+from . import SequentialTestCase
+
+
+FAST = 'fast.example.org:50002:s'
+SLOW = 'slow.example.org:50002:s'
+FLAKY = 'flaky.example.org:50002:s'
+NEW = 'new.example.org:50002:s'
+
+
+class TestServerScores(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(tempfile.mkdtemp(prefix="test_server_scores"), 'server_scores')
+
+    def test_scores(self):
+        scores = ServerScores(self.path)
+        scores.record_rtt(FAST, 0.05)
+        scores.record_rtt(SLOW, 1.0)
+        scores.record_rtt(FLAKY, 0.05)
+        for i in range(5):
+            scores.record_response(FLAKY, 0.05, failed=True)
+        self.assertLess(scores.get_score(FAST), scores.get_score(NEW))
+        self.assertLess(scores.get_score(NEW), scores.get_score(SLOW))
+        self.assertLess(scores.get_score(FAST), scores.get_score(FLAKY))
+        self.assertEqual(FAST, scores.best([SLOW, FLAKY, FAST, NEW]))
+        self.assertIsNone(scores.best([]))
+        # the moving average recovers
+        for i in range(30):
+            scores.record_rtt(SLOW, 0.02)
+        self.assertEqual(SLOW, scores.best([SLOW, FAST]))
+
+    def test_lag_and_failures(self):
+        scores = ServerScores(self.path)
+        scores.record_rtt(FAST, 0.05)
+        scores.record_rtt(SLOW, 0.05)
+        scores.record_lag(SLOW, 3)
+        self.assertEqual(FAST, scores.best([SLOW, FAST]))
+        for i in range(5):
+            scores.record_lag(SLOW, 0)
+        scores.record_lag(FAST, -1)
+        scores.record_connection(FAST, False)
+        self.assertEqual(SLOW, scores.best([SLOW, FAST]))
+
+    def test_pick_prefers_better_scores(self):
+        scores = ServerScores(self.path)
+        scores.record_rtt(FAST, 0.01)
+        scores.record_rtt(SLOW, 1.0)
+        picks = [scores.pick([FAST, SLOW]) for i in range(200)]
+        self.assertGreater(picks.count(FAST), picks.count(SLOW))
+        self.assertIn(SLOW, picks + [scores.pick([SLOW])])
+        self.assertIsNone(scores.pick([]))
+
+    def test_persistence(self):
+        scores = ServerScores(self.path)
+        scores.record_rtt(FAST, 0.05)
+        scores.record_connection(FAST, True)
+        scores = ServerScores(self.path)
+        self.assertAlmostEqual(50, scores.get_score(FAST))
+        self.assertEqual({FAST}, set(scores.get_stats()))
+        # unreadable file
+        with open(self.path, 'w') as f:
+            f.write('{')
+        self.assertEqual({}, ServerScores(self.path).stats)
+        self.assertEqual({}, ServerScores(None).stats)
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import aiorpcx
+
+from vialectrum import constants
+from vialectrum import blockchain
+from vialectrum.interface import NotificationSession
+from vialectrum.network import Network
+from vialectrum.simple_config import SimpleConfig
+from vialectrum.storage import WalletStorage
+from vialectrum.synchronizer import history_status
+from vialectrum.verifier import verify_tx_is_in_block
+from vialectrum.wallet import Wallet
+
+from . import SequentialTestCase
+from vialectrum.scripts.standin_server import Fixtures, StandInServer, make_addresses
+
+
+class TestStandInServer(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        constants.set_regtest()
+        self.addresses = make_addresses(20)
+        self.fixtures = Fixtures(self.addresses, txs_per_address=2, txs_per_block=7, num_blocks=50)
+        constants.net = self.fixtures.make_net()
+        self.loop = asyncio.get_event_loop()
+
+    def tearDown(self):
+        constants.set_mainnet()
+        blockchain.blockchains = {}
+        super().tearDown()
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def _connect(self, server):
+        await server.listen()
+        session = NotificationSession('localhost', server.port)
+        await session.create_connection()
+        return session
+
+    def test_fixtures_are_valid(self):
+        config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_standin")})
+        blockchain.blockchains = blockchain.read_blockchains(config)
+        chain = blockchain.blockchains[0]
+        open(chain.path(), 'wb').close()
+        data = self.fixtures.get_headers(0, 2016)
+        self.assertEqual(self.fixtures.height() + 1, data['count'])
+        self.assertTrue(chain.connect_chunk(0, data['hex']))
+        self.assertEqual(self.fixtures.height(), chain.height())
+        for txid, (height, pos) in self.fixtures.tx_positions.items():
+            proof = self.fixtures.get_merkle(txid, height)
+            verify_tx_is_in_block(txid, proof['merkle'], proof['pos'], chain.read_header(height), height)
+        scripthash = self.fixtures.address_scripthash[self.addresses[3]]
+        history = self.fixtures.get_history(scripthash)
+        self.assertEqual(2, len(history))
+        self.assertEqual(history_status([(h['tx_hash'], h['height']) for h in history]),
+                         self.fixtures.get_status(scripthash))
+
+    def test_protocol(self):
+        server = StandInServer(self.fixtures)
+        async def run():
+            session = await self._connect(server)
+            try:
+                self.assertEqual(['StandIn 1.0', '1.4'], await session.send_request('server.version', ['test', '1.4']))
+                scripthash = self.fixtures.address_scripthash[self.addresses[0]]
+                queue = asyncio.Queue()
+                await session.subscribe('blockchain.scripthash.subscribe', [scripthash], queue)
+                self.assertEqual([scripthash, self.fixtures.get_status(scripthash)], await queue.get())
+                history = await session.send_request('blockchain.scripthash.get_history', [scripthash])
+                txid = history[0]['tx_hash']
+                raw = await session.send_request('blockchain.transaction.get', [txid])
+                self.assertEqual(self.fixtures.txs[txid], raw)
+                proof = await session.send_request('blockchain.transaction.get_merkle', [txid, history[0]['height']])
+                self.assertEqual(self.fixtures.tx_positions[txid][1], proof['pos'])
+                # a payment to the address is notified
+                payment = raw[:-8] + '01000000'  # another locktime
+                txid = await session.send_request('blockchain.transaction.broadcast', [payment])
+                _, status = await asyncio.wait_for(queue.get(), 1)
+                self.assertEqual(self.fixtures.get_status(scripthash), status)
+                self.assertIn({'tx_hash': txid, 'height': 0, 'fee': 0},
+                              await session.send_request('blockchain.scripthash.get_history', [scripthash]))
+                # new blocks are notified
+                header_queue = asyncio.Queue()
+                await session.subscribe('blockchain.headers.subscribe', [], header_queue)
+                self.assertEqual(self.fixtures.height(), (await header_queue.get())[0]['height'])
+                server.mine(2)
+                tip = (await asyncio.wait_for(header_queue.get(), 1))[0]
+                self.assertEqual(51, tip['height'])
+                self.assertEqual(self.fixtures.header(51), tip['hex'])
+            finally:
+                session.transport.close()
+                await server.close()
+        self._run(run())
+
+    def test_fault_injection(self):
+        server = StandInServer(self.fixtures, latency=0.05, error_rate=1)
+        async def run():
+            session = await self._connect(server)
+            try:
+                t0 = time.time()
+                await session.send_request('server.version', ['test', '1.4'])
+                self.assertGreaterEqual(time.time() - t0, 0.05)
+                with self.assertRaises(aiorpcx.RPCError):
+                    await session.send_request('server.ping')
+                server.error_rate, server.timeout_rate = 0, 1
+                with self.assertRaises(asyncio.TimeoutError):
+                    await session.send_request('server.ping', timeout=0.2)
+                server.timeout_rate, server.disconnect_after = 0, 1
+                try:
+                    await session.send_request('server.ping', timeout=1)
+                except Exception:
+                    pass
+                self.assertTrue(session.is_closing())
+                self.assertEqual({'server.version': 1, 'server.ping': 3, 'errors': 1, 'timeouts': 1,
+                                  'disconnects': 1}, server.stats)
+            finally:
+                if session.transport:
+                    session.transport.close()
+                await server.close()
+        self._run(run())
+
+    def test_wallet_sync(self):
+        # Network, Interface, Synchronizer and SPV, end to end
+        server = StandInServer(self.fixtures)
+        server.start_in_thread()
+        path = tempfile.mkdtemp(prefix="test_standin")
+        config = SimpleConfig({'electrum_path': path, 'server': server.server_string,
+                               'oneserver': True, 'auto_connect': False})
+        storage = WalletStorage(os.path.join(path, 'wallet'))
+        storage.put('wallet_type', 'imported')
+        storage.put('addresses', {addr: {} for addr in self.addresses})
+        wallet = Wallet(storage)
+        network = Network(config)
+        network.start()
+        try:
+            wallet.start_network(network)
+            deadline = time.time() + 30
+            while not (wallet.is_up_to_date() and len(wallet.verified_tx) == len(self.fixtures.txs)):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+            self.assertEqual(self.fixtures.height(), network.get_local_height())
+            c, u, x = wallet.get_balance()
+            self.assertEqual(sum(item['value'] for utxos in self.fixtures.utxos.values() for item in utxos), c)
+        finally:
+            wallet.stop_threads()
+            network.stop()
+            network.join()
+            server.stop_thread()
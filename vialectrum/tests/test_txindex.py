@@ -0,0 +1,71 @@
+from vialectrum.txindex import Interner, TxInputIndex, TxOutputIndex, HistoryIndex
+
+from . import SequentialTestCase
+
+
+def txid(i):
+    return '%064x' % i
+
+
+class TestTxIndex(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.txids = Interner()
+        self.addresses = Interner()
+
+    def test_txo(self):
+        txo = TxOutputIndex(self.txids, self.addresses)
+        d = {'addr1': [(0, 1000, False), (2, 3000, False)], 'addr2': [[1, 2000, True]]}
+        txo[txid(1)] = d
+        txo[txid(2)] = {}
+        self.assertEqual(2, len(txo))
+        self.assertIn(txid(1), txo)
+        self.assertNotIn(txid(3), txo)
+        self.assertNotIn('not a txid', txo)
+        self.assertEqual({'addr1': [(0, 1000, False), (2, 3000, False)], 'addr2': [(1, 2000, True)]},
+                         dict(txo[txid(1)]))
+        self.assertEqual([(1, 2000, True)], txo.get(txid(1), {}).get('addr2', []))
+        self.assertEqual([], txo.get(txid(1), {}).get('addr3', []))
+        self.assertEqual(['addr1', 'addr2'], list(txo[txid(1)]))
+        # an empty entry is not a missing one
+        self.assertEqual({}, txo.get(txid(2)))
+        self.assertIsNone(txo.get(txid(3)))
+        self.assertEqual({txid(1), txid(2)}, set(txo))
+        del txo[txid(2)]
+        self.assertNotIn(txid(2), txo)
+        with self.assertRaises(KeyError):
+            del txo[txid(2)]
+
+    def test_txi(self):
+        txi = TxInputIndex(self.txids, self.addresses)
+        ser1, ser2 = txid(1) + ':0', txid(2) + ':5'
+        txi[txid(3)] = {'addr1': {(ser1, 1000)}}
+        self.assertEqual({'addr1': [(ser1, 1000)]}, txi[txid(3)])
+        self.assertTrue(txi.add(txid(3), 'addr2', ser2, 2000))
+        self.assertFalse(txi.add(txid(3), 'addr2', ser2, 2000))
+        self.assertFalse(txi.add(txid(4), 'addr2', ser2, 2000))
+        self.assertNotIn(txid(4), txi)
+        self.assertEqual({'addr1': [(ser1, 1000)], 'addr2': [(ser2, 2000)]}, txi[txid(3)])
+        # an entry that cannot be packed is not partly added
+        with self.assertRaises(ValueError):
+            txi.add(txid(3), 'addr1', 'not an outpoint', 3000)
+        self.assertEqual({'addr1': [(ser1, 1000)], 'addr2': [(ser2, 2000)]}, txi[txid(3)])
+        # txids are shared by the indexes
+        self.assertEqual(3, len(self.txids))
+
+    def test_history(self):
+        history = HistoryIndex(self.txids)
+        history['addr1'] = [[txid(1), 10], (txid(2), -1)]
+        history['addr2'] = []
+        history['addr3'] = ['*']
+        self.assertEqual([(txid(1), 10), (txid(2), -1)], history['addr1'])
+        self.assertEqual([], history['addr2'])
+        self.assertEqual(['*'], history['addr3'])
+        self.assertEqual(['addr1', 'addr2', 'addr3'], sorted(history))
+        history['addr3'] = [(txid(3), 1)]
+        self.assertEqual([(txid(3), 1)], history['addr3'])
+        self.assertEqual(3, len(history))
+        self.assertEqual([], history.pop('addr2'))
+        self.assertNotIn('addr2', history)
+        self.assertIsNone(history.get('addr2'))
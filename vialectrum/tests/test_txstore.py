@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+
+from vialectrum.txstore import TxStore
+
+from . import SequentialTestCase
+
+
+def raw_tx(i, size=100):
+    return ('%02x' % i) * size
+
+
+def txid(i):
+    return '%064x' % i
+
+
+class TestTxStore(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(tempfile.mkdtemp(prefix="test_txstore"), 'tx_store')
+
+    def test_put_and_get(self):
+        store = TxStore(self.path)
+        self.assertIsNone(store.get(txid(1)))
+        store.put(txid(1), raw_tx(1))
+        store.put(txid(2), raw_tx(2))
+        store.put(txid(1), raw_tx(1))
+        self.assertEqual(raw_tx(1), store.get(txid(1)))
+        self.assertEqual(2, len(store))
+        self.assertEqual({'transactions': 2, 'size': 200, 'max_size': store.max_size, 'hits': 1, 'misses': 1},
+                         store.get_stats())
+        # the index is rebuilt from the file
+        store = TxStore(self.path)
+        self.assertEqual(raw_tx(2), store.get(txid(2)))
+        self.assertIn(txid(1), store)
+
+    def test_lru_eviction(self):
+        store = TxStore(self.path, max_size=400)
+        for i in range(4):
+            store.put(txid(i), raw_tx(i))
+        store.get(txid(0))
+        store.put(txid(4), raw_tx(4))
+        self._wait_eviction(store)
+        # down to 3/4 of the size limit, least recently used first
+        self.assertEqual([txid(0), txid(3), txid(4)], [t for t in map(txid, range(5)) if t in store])
+        self.assertEqual(raw_tx(4), store.get(txid(4)))
+        self.assertEqual(3 * (36 + 100), os.path.getsize(self.path))
+        store = TxStore(self.path, max_size=400)
+        self.assertEqual(raw_tx(0), store.get(txid(0)))
+
+    def test_put_during_eviction(self):
+        store = TxStore(self.path, max_size=400)
+        for i in range(4):
+            store.put(txid(i), raw_tx(i))
+        # as if the file was being rewritten by another thread
+        store.eviction = threading.current_thread()
+        store.put(txid(4), raw_tx(4))
+        store.put(txid(5), raw_tx(5))
+        self.assertEqual(6, len(store))
+        store.evict()
+        self.assertIsNone(store.eviction)
+        self.assertEqual([txid(3), txid(4), txid(5)], [t for t in map(txid, range(6)) if t in store])
+        self.assertEqual(raw_tx(5), store.get(txid(5)))
+        self.assertEqual(3, len(TxStore(self.path, max_size=400)))
+
+    def _wait_eviction(self, store):
+        eviction = store.eviction
+        if eviction is not None:
+            eviction.join()
+
+    def test_partial_record_is_dropped(self):
+        store = TxStore(self.path)
+        store.put(txid(1), raw_tx(1))
+        store.put(txid(2), raw_tx(2))
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+        store = TxStore(self.path)
+        self.assertEqual(1, len(store))
+        self.assertEqual(36 + 100, os.path.getsize(self.path))
+        store.put(txid(2), raw_tx(2))
+        self.assertEqual(raw_tx(2), TxStore(self.path).get(txid(2)))
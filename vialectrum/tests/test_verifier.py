@@ -0,0 +1,119 @@
+import asyncio
+import tempfile
+
+from aiorpcx import TaskGroup
+
+from vialectrum.bitcoin import Hash, hash_decode, hash_encode
+from vialectrum.simple_config import SimpleConfig
+from vialectrum.verifier import SPV
+
+from . import SequentialTestCase
+
+
+def txid(i):
+    return hash_encode(Hash(bytes([i])))
+
+
+class MockBlockchain:
+    checkpoints = []
+    def __init__(self, blocks):
+        self.blocks = blocks  # height -> list of txids
+    def read_header(self, height):
+        txids = self.blocks[height]
+        if len(txids) == 1:
+            root = txids[0]
+        else:
+            root = hash_encode(Hash(hash_decode(txids[0]) + hash_decode(txids[1])))
+        return {'merkle_root': root, 'timestamp': height, 'block_height': height}
+    def get_hash(self, height):
+        return '%064x' % height
+
+
+class MockNetwork:
+    def __init__(self, config, blocks):
+        self.config = config
+        self.chain = MockBlockchain(blocks)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+    def blockchain(self):
+        return self.chain
+    def get_local_height(self):
+        return max(self.chain.blocks)
+    async def get_merkle_for_transaction(self, tx_hash, tx_height):
+        self.requests.append(tx_hash)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        txids = self.chain.blocks[tx_height]
+        pos = txids.index(tx_hash)
+        branch = [txids[1 - pos]] if len(txids) > 1 else []
+        return {'block_height': tx_height, 'pos': pos, 'merkle': branch}
+
+
+class MockWallet:
+    def __init__(self, unverified):
+        self.unverified = unverified
+        self.verified = {}
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+    def add_verified_tx(self, tx_hash, info):
+        self.unverified.pop(tx_hash)
+        self.verified[tx_hash] = info
+    def is_up_to_date(self):
+        return False
+
+
+class TestSPV(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_verifier")})
+        config.set_key('spv_max_concurrent_proofs', 3)
+        blocks = {50: [txid(1)], 100: [txid(2), txid(3)], 200: [txid(4)]}
+        self.network = MockNetwork(config, blocks)
+        self.wallet = MockWallet({tx: h for h, txids in blocks.items() for tx in txids})
+        self.spv = SPV(self.network, self.wallet)
+
+    def _request_proofs(self):
+        async def run():
+            async with TaskGroup() as group:
+                await self.spv._request_proofs(group)
+        asyncio.get_event_loop().run_until_complete(run())
+
+    def test_proofs_are_batched_by_height(self):
+        self._request_proofs()
+        # lowest height first, at most 3 in flight, same block together
+        self.assertEqual(txid(1), self.network.requests[0])
+        self.assertEqual({txid(2), txid(3)}, set(self.network.requests[1:]))
+        self.assertLessEqual(self.network.max_in_flight, 3)
+        self.assertEqual({txid(1), txid(2), txid(3)}, set(self.wallet.verified))
+        self.assertFalse(self.spv.is_up_to_date())
+        self._request_proofs()
+        self.assertEqual(txid(4), self.network.requests[-1])
+        self.assertEqual(4, len(self.wallet.verified))
+        self.assertEqual(1, self.wallet.verified[txid(3)].txpos)
+        self.assertTrue(self.spv.is_up_to_date())
+
+    def test_unconfirmed_tx_is_not_requested(self):
+        self._request_proofs()
+        self.wallet.unverified[txid(4)] = 0
+        self.spv.remove_spv_proof_for_tx(txid(4))
+        self._request_proofs()
+        self.assertNotIn(txid(4), self.network.requests)
+        self.assertTrue(self.spv.is_up_to_date())
+
+    def test_tx_whose_height_changed_is_queued_again(self):
+        self._request_proofs()
+        # mined in another block while it was queued
+        self.network.chain.blocks[150] = [txid(4)]
+        self.wallet.unverified[txid(4)] = 150
+        woken = []
+        self.spv.wakeup = lambda: woken.append(True)
+        self._request_proofs()
+        self.assertNotIn(txid(4), self.network.requests)
+        self.assertTrue(woken)
+        self._request_proofs()
+        self.assertEqual(150, self.wallet.verified[txid(4)].height)
+        self.assertTrue(self.spv.is_up_to_date())
@@ -3,9 +3,17 @@ import tempfile
 import sys
 import os
 import json
+import threading
+from unittest import mock
 
 from io import StringIO
-from vialectrum.storage import WalletStorage, FINAL_SEED_VERSION
+from vialectrum import address_synchronizer, bitcoin
+from vialectrum.address_synchronizer import LazyTransactions
+from vialectrum.bitcoin import address_to_script, int_to_hex, var_int
+from vialectrum.scripts.standin_server import make_addresses, make_tx
+from vialectrum.storage import WalletStorage, FINAL_SEED_VERSION, STO_EV_USER_PW
+from vialectrum.transaction import Transaction
+from vialectrum.wallet import Wallet, sweep_scripts, sweep_preparations
 
 from . import SequentialTestCase
 
@@ -37,6 +45,17 @@ class WalletTestCase(SequentialTestCase):
         # Restore the "real" stdout
         sys.stdout = self._saved_stdout
 
+    def make_wallet(self, addresses):
+        """Wallet of imported addresses, stored at wallet_path."""
+        storage = WalletStorage(self.wallet_path)
+        storage.put('wallet_type', 'imported')
+        storage.put('addresses', {addr: {} for addr in addresses})
+        return Wallet(storage)
+
+    def make_tx(self, i, address, value):
+        """Transaction paying value to address, different for each i."""
+        return Transaction(make_tx(b'%d' % i, address_to_script(address), value))
+
 
 class TestWalletStorage(WalletTestCase):
 
@@ -68,3 +87,265 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_frozen_get(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'a': 'b'})
+        labels = storage.get('labels', frozen=True)
+        self.assertEqual({'a': 'b'}, labels)
+        with self.assertRaises(TypeError):
+            labels['a'] = 'c'
+        storage.put_entries('labels', {'c': 'd'}, ['a'])
+        self.assertEqual({'c': 'd'}, labels)
+        self.assertEqual({}, storage.get('other', {}, frozen=True))
+
+    def test_journal_is_replayed(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put('labels', {'a': 'b', 'c': 'd'})
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+
+        storage.put('labels', {'a': 'b', 'c': 'e', 'f': 'g'})
+        storage.put('x', 1)
+        storage.write()
+        storage.put('labels', {'c': 'e', 'f': 'g'})
+        storage.put('x', None)
+        storage.write()
+        # only the journal was written
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(contents, f.read())
+        self.assertTrue(os.path.exists(self.wallet_path + '.journal'))
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual({'c': 'e', 'f': 'g'}, storage2.get('labels'))
+        self.assertEqual(None, storage2.get('x'))
+        # a wallet that has a journal keeps using it
+        self.assertTrue(storage2.journal)
+
+        storage2.write(compact=True)
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal'))
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual({'c': 'e', 'f': 'g'}, json.loads(f.read())['labels'])
+
+    def test_journal_of_another_file_is_discarded(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put('a', 'b')
+        storage.write()
+        storage.put('a', 'c')
+        storage.write()
+        # the wallet file was replaced, but the journal was not removed
+        with open(self.wallet_path, "r") as f:
+            d = json.loads(f.read())
+        d['a'] = 'd'
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps(d))
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual('d', storage2.get('a'))
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal'))
+
+    def test_incomplete_journal_record_is_discarded(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put('a', 'b')
+        storage.write()
+        storage.put('a', 'c')
+        storage.write()
+        with open(self.wallet_path + '.journal', "ab") as f:
+            f.write(b'[["put", "a", "d"')
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual('c', storage2.get('a'))
+        storage2.put('a', 'e')
+        storage2.write()
+        storage3 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual('e', storage3.get('a'))
+
+    def test_encrypted_journal(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.set_password('secret', STO_EV_USER_PW)
+        storage.put('a', 'b')
+        storage.write()
+        storage.put('a', 'c')
+        storage.write()
+        with open(self.wallet_path + '.journal', "r") as f:
+            self.assertNotIn('"c"', f.read())
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage2.is_encrypted())
+        storage2.decrypt('secret')
+        self.assertEqual('c', storage2.get('a'))
+        # the journal is compacted when the key changes
+        storage2.set_password('other', STO_EV_USER_PW)
+        storage2.write()
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal'))
+        storage3 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        storage3.decrypt('other')
+        self.assertEqual('c', storage3.get('a'))
+
+
+class TestSaveTransactions(WalletTestCase):
+
+    def test_only_changed_entries_are_saved(self):
+        addresses = make_addresses(3)
+        wallet = self.make_wallet(addresses)
+        txs = [self.make_tx(i, addr, 1000 + i) for i, addr in enumerate(addresses)]
+        for tx in txs[:2]:
+            wallet.add_transaction(tx.txid(), tx)
+        wallet.receive_history_callback(addresses[0], [(txs[0].txid(), 1)], {txs[0].txid(): 100})
+        wallet.save_transactions(write=True)
+
+        saved = []
+        put_entries = wallet.storage.put_entries
+        def put_entries_mock(key, entries, removed=()):
+            saved.append((key, set(entries), set(removed)))
+            put_entries(key, entries, removed)
+        wallet.storage.put_entries = put_entries_mock
+        wallet.save_transactions()
+        self.assertEqual([], saved)
+        wallet.add_transaction(txs[2].txid(), txs[2])
+        wallet.remove_transaction(txs[1].txid())
+        wallet.save_transactions(write=True)
+        self.assertEqual({('transactions', frozenset({txs[2].txid()}), frozenset({txs[1].txid()})),
+                          ('txi', frozenset({txs[2].txid()}), frozenset({txs[1].txid()})),
+                          ('txo', frozenset({txs[2].txid()}), frozenset({txs[1].txid()}))},
+                         {(key, frozenset(entries), frozenset(removed))
+                          for key, entries, removed in saved if key != 'spent_outpoints'})
+
+        wallet2 = Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual({txs[0].txid(), txs[2].txid()}, set(wallet2.transactions))
+        self.assertEqual(wallet.txo, wallet2.txo)
+        self.assertEqual(wallet.txi, wallet2.txi)
+        self.assertEqual({k: v for k, v in wallet.spent_outpoints.items() if v},
+                         {k: v for k, v in wallet2.spent_outpoints.items() if v})
+        self.assertEqual({txs[0].txid(): 100}, wallet2.tx_fees)
+        self.assertEqual([(txs[0].txid(), 1)], wallet2.history[addresses[0]])
+        self.assertEqual(wallet.get_balance(), wallet2.get_balance())
+
+
+class TestLazyTransactions(WalletTestCase):
+
+    def test_parsed_on_access(self):
+        raws = [make_tx(b'%d' % i, '51', 1000) for i in range(3)]
+        txs = LazyTransactions({Transaction(raw).txid(): raw for raw in raws[:2]}, max_size=1)
+        txids = list(txs)
+        self.assertEqual(2, len(txs))
+        self.assertIn(txids[0], txs)
+        self.assertEqual({}, dict(txs._parsed))
+        tx = txs[txids[0]]
+        self.assertEqual(txids[0], tx.txid())
+        self.assertIs(tx, txs.get(txids[0]))
+        # the least recently used is dropped, but stays available
+        self.assertEqual(txids[1], txs[txids[1]].txid())
+        self.assertEqual([txids[1]], list(txs._parsed))
+        self.assertEqual(txids[0], txs[txids[0]].txid())
+        tx = Transaction(raws[2])
+        txs[tx.txid()] = tx
+        self.assertIs(tx, txs[tx.txid()])
+        self.assertEqual(raws[2], txs.raw[tx.txid()])
+        self.assertIs(tx, txs.pop(tx.txid()))
+        self.assertNotIn(tx.txid(), txs)
+        self.assertIsNone(txs.get(tx.txid()))
+
+    def test_concurrent_access(self):
+        raws = [make_tx(b'%d' % i, '51', 1000) for i in range(3)]
+        txs = LazyTransactions({Transaction(raw).txid(): raw for raw in raws}, max_size=1)
+        errors = []
+        def read():
+            try:
+                for i in range(300):
+                    for txid in txs.raw:
+                        assert txs[txid].txid() == txid
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+
+    def test_wallet_loads_without_parsing(self):
+        addresses = make_addresses(3)
+        wallet = self.make_wallet(addresses)
+        for i, addr in enumerate(addresses):
+            tx = self.make_tx(i, addr, 1000)
+            wallet.add_transaction(tx.txid(), tx)
+            wallet.receive_history_callback(addr, [(tx.txid(), i + 1)], {})
+        wallet.save_transactions(write=True)
+
+        with mock.patch.object(address_synchronizer, 'Transaction') as transaction_mock:
+            wallet2 = Wallet(WalletStorage(self.wallet_path))
+        self.assertFalse(transaction_mock.called)
+        self.assertEqual(set(wallet.transactions), set(wallet2.transactions))
+        self.assertEqual(wallet.get_balance(), wallet2.get_balance())
+
+
+class TestAddrCoins(WalletTestCase):
+
+    def test_coins_follow_transactions_and_heights(self):
+        addresses = make_addresses(2)
+        wallet = self.make_wallet(addresses)
+
+        def check(balance0, balance1):
+            for addr, balance in zip(addresses, (balance0, balance1)):
+                self.assertEqual(balance, wallet.get_addr_balance(addr))
+                self.assertEqual(wallet._compute_addr_coins(addr, 0).utxos, wallet.get_addr_utxo(addr))
+            self.assertEqual(tuple(map(sum, zip(balance0, balance1))), wallet.get_balance())
+
+        tx1 = self.make_tx(1, addresses[0], 1000)
+        wallet.add_unverified_tx(tx1.txid(), 0)
+        wallet.add_transaction(tx1.txid(), tx1)
+        check((0, 1000, 0), (0, 0, 0))
+        wallet.add_unverified_tx(tx1.txid(), 10)
+        check((1000, 0, 0), (0, 0, 0))
+        coins = wallet.get_utxos()
+        self.assertEqual([(tx1.txid(), 0, 1000, 10)],
+                         [(c['prevout_hash'], c['prevout_n'], c['value'], c['height']) for c in coins])
+        # coins are copies
+        coins[0]['value'] = 0
+        self.assertEqual(1000, wallet.get_utxos()[0]['value'])
+
+        # tx2 spends the coin of tx1, paying addresses[1]
+        script = address_to_script(addresses[1])
+        tx2 = Transaction(int_to_hex(1, 4)
+                          + var_int(1) + bytes.fromhex(tx1.txid())[::-1].hex() + int_to_hex(0, 4) + var_int(0) + 'ffffffff'
+                          + var_int(1) + int_to_hex(900, 8) + var_int(len(script) // 2) + script
+                          + int_to_hex(0, 4))
+        wallet.add_unverified_tx(tx2.txid(), 0)
+        wallet.add_transaction(tx2.txid(), tx2)
+        check((1000, -1000, 0), (0, 900, 0))
+        self.assertEqual([tx2.txid()], [c['prevout_hash'] for c in wallet.get_utxos()])
+        wallet.add_unverified_tx(tx2.txid(), 11)
+        check((0, 0, 0), (900, 0, 0))
+        wallet.remove_transaction(tx2.txid())
+        check((1000, 0, 0), (0, 0, 0))
+
+
+class TestSweepPreparations(SequentialTestCase):
+
+    def test_lookups(self):
+        secs = [bitcoin.serialize_privkey(bytes([i]) * 32, True, 'p2pkh') for i in range(1, 6)]
+        secs.append(secs[0])
+        scripts, keypairs = sweep_scripts(secs)
+        # p2pkh and p2pk for each key, once
+        self.assertEqual(10, len(scripts))
+        self.assertEqual(5, len(keypairs))
+        found = {scripts[i][0]: [{'tx_hash': '%064x' % i, 'tx_pos': 0, 'height': 1, 'value': 1000}]
+                 for i in (7, 1, 4)}
+        class NetworkMock:
+            def listunspent_for_scripthashes(self, scripthashes, timeout=10, callback=None):
+                for sh in scripthashes:
+                    if callback:
+                        callback(sh, found.get(sh, []))
+                return {sh: found.get(sh, []) for sh in scripthashes}
+        streamed = []
+        inputs, keypairs = sweep_preparations(secs, NetworkMock(), imax=2, callback=streamed.extend)
+        self.assertEqual(3, len(streamed))
+        # the inputs of the first keys are kept
+        self.assertEqual(['%064x' % 1, '%064x' % 4], [i['prevout_hash'] for i in inputs])
+        self.assertEqual('p2pk', inputs[0]['type'])
+        self.assertEqual('(pubkey)', inputs[0]['address'])
+        self.assertEqual([scripts[4][2]], inputs[1]['pubkeys'])
+        inputs, keypairs = sweep_preparations(secs, NetworkMock())
+        self.assertEqual(3, len(inputs))
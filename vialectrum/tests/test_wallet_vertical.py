@@ -7,6 +7,7 @@ from vialectrum import storage, bitcoin, keystore
 from vialectrum import Transaction
 from vialectrum import SimpleConfig
 from vialectrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
+from vialectrum.synchronizer import history_status
 from vialectrum.wallet import sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet
 from vialectrum.util import bfh, bh2u
 from vialectrum.transaction import TxOutput
@@ -966,6 +967,8 @@ class TestWalletSending(TestCaseForTestnet):
                     return [{'tx_hash': 'ac24de8b58e826f60bd7b9ba31670bdfc3e8aedb2f28d0e91599d741569e3429', 'tx_pos': 1, 'height': 1325785, 'value': 1000000}]
                 else:
                     return []
+            def listunspent_for_scripthashes(self, scripthashes, timeout=10, callback=None):
+                return {sh: self.listunspent_for_scripthash(sh) for sh in scripthashes}
 
         privkeys = ['93NQ7CFbwTPyKDJLXe97jczw33fiLijam2SCZL3Uinz1NSbHrTu', ]
         network = NetworkMock()
@@ -1609,3 +1612,18 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_status_is_cached(self, mock_write):
+        w = self.create_wallet()
+        addr = 'tltc1qr0qjp99ygawul0eylxfqmt7alygye22mtenjfm'
+        hist = [('fde0b68938709c4979827caa576e9455ded148537fdb798fd05680da64dc1b4f', 1316917),
+                ('268fce617aaaa4847835c2212b984d7b7741fdab65de22813288341819bc5656', 1316917)]
+        self.assertIsNone(w.get_history_status(addr))
+        w.receive_history_callback(addr, hist, {})
+        status = history_status(hist)
+        self.assertEqual(status, w.get_history_status(addr))
+        w.save_transactions()
+        self.assertEqual(status, w.storage.get('addr_history_status')[addr])
+        w.receive_history_callback(addr, hist[:1], {}, 'status from synchronizer')
+        self.assertEqual('status from synchronizer', w.get_history_status(addr))
@@ -0,0 +1,264 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Compact in-memory indexes of the transactions of a wallet.
+#
+# As nested dicts of hex strings, tuples and sets, txi, txo and the
+# address histories take several KB per transaction. Here, txids are
+# interned as 32-byte strings and numbered, addresses are numbered, and
+# the entries of a transaction (or of an address history) are packed
+# into a single array of 64-bit integers.
+#
+# The indexes are mappings with the shape of the dicts they replace:
+#   txi[txid][address] -> [(prevout_hash:n, value)]
+#   txo[txid][address] -> [(n, value, is_coinbase)]
+#   history[address] -> [(txid, height)]
+# Their values are built from the arrays when they are accessed, so they
+# are modified by assigning or deleting whole entries, and with
+# TxInputIndex.add.
+
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+
+class Interner:
+    """Numbers hashable values. Ids are never reused, nor freed: the
+    values of removed entries stay until the interner is replaced (see
+    AddressSynchronizer.clear_history), which costs little next to the
+    entries themselves."""
+
+    __slots__ = ('_ids', '_values')
+
+    def __init__(self):
+        self._ids = {}  # value -> id
+        self._values = []  # id -> value
+
+    def add(self, value) -> int:
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self._values)
+            self._values.append(value)
+        return i
+
+    def find(self, value):
+        """Id of value, or None if it was never added."""
+        return self._ids.get(value)
+
+    def get(self, i):
+        return self._values[i]
+
+    def __len__(self):
+        return len(self._values)
+
+
+def txid_to_bytes(txid):
+    try:
+        return bytes.fromhex(txid)
+    except (ValueError, TypeError):
+        return None
+
+
+class _TxEntries(Mapping):
+    """Read-only view of the entries of one transaction, by address."""
+
+    __slots__ = ('_index', '_record')
+
+    def __init__(self, index, record):
+        self._index = index
+        self._record = record
+
+    def _address_ids(self):
+        return list(dict.fromkeys(self._record[::self._index.FIELDS + 1]))
+
+    def __getitem__(self, address):
+        a = self._index.addresses.find(address)
+        entries = [] if a is None else self._index._unpack_address(self._record, a)
+        if not entries:
+            raise KeyError(address)
+        return entries
+
+    def __iter__(self):
+        return map(self._index.addresses.get, self._address_ids())
+
+    def __len__(self):
+        return len(self._address_ids())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _TxIndex(MutableMapping):
+    """txid -> {address: entries}, one array per transaction.
+    Each entry is stored as an address id and FIELDS integers."""
+
+    FIELDS = 0
+
+    def __init__(self, txids: Interner, addresses: Interner):
+        self.txids = txids
+        self.addresses = addresses
+        self._records = {}  # txid id -> array
+
+    def _pack(self, entry):
+        raise NotImplementedError()
+
+    def _unpack(self, fields):
+        raise NotImplementedError()
+
+    def _unpack_address(self, record, a):
+        step = self.FIELDS + 1
+        return [self._unpack(record[k+1:k+step])
+                for k in range(0, len(record), step) if record[k] == a]
+
+    def _find(self, txid):
+        try:
+            return self.txids.find(bytes.fromhex(txid))
+        except (ValueError, TypeError):
+            return None
+
+    def get(self, txid, default=None):
+        record = self._records.get(self._find(txid))
+        return default if record is None else _TxEntries(self, record)
+
+    def __getitem__(self, txid):
+        entries = self.get(txid)
+        if entries is None:
+            raise KeyError(txid)
+        return entries
+
+    def __setitem__(self, txid, d):
+        record = array('q')
+        for address, entries in d.items():
+            a = self.addresses.add(address)
+            for entry in dict.fromkeys(tuple(x) for x in entries):
+                record.extend((a,) + self._pack(entry))
+        self._records[self.txids.add(bytes.fromhex(txid))] = record
+
+    def __delitem__(self, txid):
+        i = self._find(txid)
+        if i not in self._records:
+            raise KeyError(txid)
+        del self._records[i]
+
+    def __contains__(self, txid):
+        return self._find(txid) in self._records
+
+    def __iter__(self):
+        return (self.txids.get(i).hex() for i in list(self._records))
+
+    def iter_addresses(self):
+        """(txid, addresses of its entries), for all transactions."""
+        step = self.FIELDS + 1
+        for i, record in list(self._records.items()):
+            yield self.txids.get(i).hex(), map(self.addresses.get, dict.fromkeys(record[::step]))
+
+    def __len__(self):
+        return len(self._records)
+
+
+class TxInputIndex(_TxIndex):
+    """txid -> {address: [(prevout_hash:n, value)]}, the coins of wallet
+    addresses spent by each transaction."""
+
+    FIELDS = 3  # prevout txid id, n, value
+
+    def _pack(self, entry):
+        ser, v = entry
+        prevout_hash, n = ser.split(':')
+        return self.txids.add(bytes.fromhex(prevout_hash)), int(n), v
+
+    def _unpack(self, fields):
+        prevout, n, v = fields
+        return self.txids.get(prevout).hex() + ':%d' % n, v
+
+    def add(self, txid, address, ser, v) -> bool:
+        """Add an entry to a transaction that is in the index.
+        Return whether the index changed."""
+        record = self._records.get(self._find(txid))
+        if record is None:
+            return False
+        a = self.addresses.add(address)
+        if (ser, v) in self._unpack_address(record, a):
+            return False
+        record.extend((a,) + self._pack((ser, v)))
+        return True
+
+
+class TxOutputIndex(_TxIndex):
+    """txid -> {address: [(n, value, is_coinbase)]}, the coins each
+    transaction pays to wallet addresses."""
+
+    FIELDS = 3  # n, value, is_coinbase
+
+    def _pack(self, entry):
+        n, v, is_cb = entry
+        return n, v, int(is_cb)
+
+    def _unpack(self, fields):
+        n, v, is_cb = fields
+        return n, v, bool(is_cb)
+
+
+class HistoryIndex(MutableMapping):
+    """address -> [(txid, height)], one array of (txid id, height) per
+    address. Histories that are not such lists, like the ['*'] of pruned
+    histories in old wallets, are kept as they are."""
+
+    def __init__(self, txids: Interner):
+        self.txids = txids
+        self._records = {}  # address -> array
+        self._other = {}  # address -> history
+
+    def __getitem__(self, address):
+        record = self._records.get(address)
+        if record is None:
+            return self._other[address]
+        return [(self.txids.get(record[k]).hex(), record[k+1]) for k in range(0, len(record), 2)]
+
+    def __setitem__(self, address, hist):
+        record = array('q')
+        for item in hist:
+            txid = txid_to_bytes(item[0]) if isinstance(item, (list, tuple)) and len(item) == 2 else None
+            if txid is None:
+                self._records.pop(address, None)
+                self._other[address] = hist
+                return
+            record.append(self.txids.add(txid))
+            record.append(item[1])
+        self._other.pop(address, None)
+        self._records[address] = record
+
+    def __delitem__(self, address):
+        if address in self._records:
+            del self._records[address]
+        else:
+            del self._other[address]
+
+    def __contains__(self, address):
+        return address in self._records or address in self._other
+
+    def __iter__(self):
+        yield from list(self._records)
+        yield from list(self._other)
+
+    def __len__(self):
+        return len(self._records) + len(self._other)
@@ -0,0 +1,168 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Raw transactions shared by all wallets, keyed by txid.
+#
+# Transactions are appended to a single file as records of
+#   txid (32 bytes), length (uint32, little-endian), raw transaction
+# and the index (txid -> offset) is rebuilt by reading the record
+# headers when the store is opened. When the store grows beyond its
+# size limit, the least recently used transactions are dropped and the
+# file is rewritten, oldest first, which also persists the LRU order.
+# This is done by a thread, as put is called from the network thread.
+
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from .util import PrintError, bfh, bh2u
+
+
+TX_STORE_MAX_SIZE = 100 * 1000 * 1000  # bytes
+
+_RECORD = struct.Struct('<32sI')
+
+
+class TxStore(PrintError):
+
+    def __init__(self, path: str, max_size: int=TX_STORE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self._index = OrderedDict()  # txid -> (offset, length), least recently used first
+        self._size = 0  # total length of the transactions
+        self.hits = 0
+        self.misses = 0
+        self.eviction = None  # thread running evict
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self._load()
+
+    def _load(self) -> None:
+        with open(self.path, 'rb+') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos + _RECORD.size <= file_size:
+                f.seek(pos)
+                txid, length = _RECORD.unpack(f.read(_RECORD.size))
+                if pos + _RECORD.size + length > file_size:
+                    break
+                self._add_to_index(bh2u(txid), pos + _RECORD.size, length)
+                pos += _RECORD.size + length
+            if pos != file_size:
+                # partial record from an interrupted append
+                self.print_error("truncating tx store at", pos)
+                f.truncate(pos)
+
+    def _add_to_index(self, txid: str, offset: int, length: int) -> None:
+        old = self._index.pop(txid, None)
+        if old is not None:
+            self._size -= old[1]
+        self._index[txid] = (offset, length)
+        self._size += length
+
+    def __contains__(self, txid: str) -> bool:
+        return txid in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, txid: str) -> Optional[str]:
+        """Raw transaction in hex, or None."""
+        with self.lock:
+            item = self._index.get(txid)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._index.move_to_end(txid)
+            offset, length = item
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                return bh2u(f.read(length))
+
+    def put(self, txid: str, raw_tx: str) -> None:
+        """Add a transaction. The caller must have checked that raw_tx hashes to txid."""
+        data = bfh(raw_tx)
+        with self.lock:
+            if txid in self._index:
+                self._index.move_to_end(txid)
+                return
+            if len(data) > self.max_size:
+                return
+            with open(self.path, 'ab') as f:
+                pos = f.tell()
+                f.write(_RECORD.pack(bfh(txid), len(data)))
+                f.write(data)
+            self._add_to_index(txid, pos + _RECORD.size, len(data))
+            if self._size > self.max_size and self.eviction is None:
+                self.eviction = threading.Thread(target=self.evict, name='TxStore.evict', daemon=True)
+                self.eviction.start()
+
+    def evict(self) -> None:
+        """Drop the least recently used transactions, and rewrite the file.
+        The transactions kept are copied without holding the lock; those
+        added meanwhile are appended to the old file, and copied last."""
+        try:
+            while True:
+                with self.lock:
+                    if self._size <= self.max_size:
+                        self.eviction = None
+                        return
+                    # leave some room, so that the file is not rewritten on every put
+                    target = self.max_size * 3 // 4
+                    while self._size > target:
+                        txid, (offset, length) = self._index.popitem(last=False)
+                        self._size -= length
+                    kept = list(self._index.items())
+                temp_path = self.path + '.tmp'
+                offsets = {}
+                with open(self.path, 'rb') as src, open(temp_path, 'wb') as dst:
+                    self._copy(src, dst, kept, offsets)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                with self.lock:
+                    with open(self.path, 'rb') as src, open(temp_path, 'ab') as dst:
+                        self._copy(src, dst, [(txid, item) for txid, item in self._index.items()
+                                              if txid not in offsets], offsets)
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                    os.replace(temp_path, self.path)
+                    self._index = OrderedDict((txid, offsets[txid]) for txid in self._index)
+        except BaseException:
+            self.eviction = None
+            raise
+
+    @staticmethod
+    def _copy(src, dst, items, offsets) -> None:
+        for txid, (offset, length) in items:
+            src.seek(offset)
+            dst.write(_RECORD.pack(bfh(txid), length))
+            offsets[txid] = (dst.tell(), length)
+            dst.write(src.read(length))
+
+    def get_stats(self) -> dict:
+        return {'transactions': len(self._index), 'size': self._size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
@@ -22,14 +22,14 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional
+import heapq
+from typing import Sequence, Optional, List
 
 from aiorpcx import TaskGroup
 
 from .util import ThreadJob, bh2u, VerifiedTxInfo
 from .bitcoin import Hash, hash_decode, hash_encode
 from .transaction import Transaction
-from .blockchain import hash_header
 from .interface import GracefulDisconnect
 
 
@@ -39,6 +39,10 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+# maximum number of merkle proof requests in flight, per wallet
+MAX_CONCURRENT_PROOFS = 20
+
+
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
@@ -48,11 +52,35 @@ class SPV(ThreadJob):
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        # txs waiting for a proof request, as a heap of (height, txid)
+        self.proof_queue = []
+        self.queued_merkle = {}  # txid -> height of its valid entry in proof_queue
+        self.max_concurrent_proofs = network.config.get('spv_max_concurrent_proofs', MAX_CONCURRENT_PROOFS)
+        self._loop = None
+        self._wakeup_event = None
+        self.wakeups = 0
 
     async def main(self, group: TaskGroup):
-        while True:
-            await self._request_proofs(group)
-            await asyncio.sleep(0.1)
+        self._loop = asyncio.get_event_loop()
+        self._wakeup_event = asyncio.Event()
+        self.network.register_callback(self._on_network_updated, ['updated'])
+        try:
+            while True:
+                self._wakeup_event.clear()
+                self.wakeups += 1
+                await self._request_proofs(group)
+                await self._wakeup_event.wait()
+        finally:
+            self.network.unregister_callback(self._on_network_updated)
+
+    def wakeup(self):
+        """Look for work again: new unverified txs, headers, or free request slots.
+        Can be called from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup_event.set)
+
+    def _on_network_updated(self, event):
+        self.wakeup()
 
     async def _request_proofs(self, group: TaskGroup):
         blockchain = self.network.blockchain()
@@ -67,46 +95,90 @@ class SPV(ThreadJob):
             # do not request merkle branch before headers are available
             if tx_height <= 0 or tx_height > local_height:
                 continue
+            if (tx_hash in self.requested_merkle or tx_hash in self.merkle_roots
+                    or tx_hash in self.queued_merkle):
+                continue
 
             header = blockchain.read_header(tx_height)
             if header is None:
                 index = tx_height // 2016
                 if index < len(blockchain.checkpoints):
-                    await group.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
-            elif (tx_hash not in self.requested_merkle
-                    and tx_hash not in self.merkle_roots):
-                self.print_error('requested merkle', tx_hash)
-                self.requested_merkle.add(tx_hash)
-                await group.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+                    await group.spawn(self._request_chunk(tx_height))
+            else:
+                heapq.heappush(self.proof_queue, (tx_height, tx_hash))
+                self.queued_merkle[tx_hash] = tx_height
+
+        await self._send_queued_requests(group, unverified)
 
         if self.network.blockchain() != self.blockchain:
             self.blockchain = self.network.blockchain()
             self._undo_verifications()
+            self.wakeup()
+
+    async def _request_chunk(self, tx_height):
+        await self.network.request_chunk(tx_height, None, can_return_early=True)
+        self.wakeup()
+
+    async def _send_queued_requests(self, group: TaskGroup, unverified: dict):
+        """Request proofs in height order, within the concurrency window.
+        Txs of the same block are requested and verified together."""
+        queue = self.proof_queue
+        while queue and len(self.requested_merkle) < self.max_concurrent_proofs:
+            tx_height = queue[0][0]
+            batch = []
+            while (queue and queue[0][0] == tx_height
+                   and len(self.requested_merkle) + len(batch) < self.max_concurrent_proofs):
+                _, tx_hash = heapq.heappop(queue)
+                if self.queued_merkle.get(tx_hash) != tx_height:
+                    continue  # superseded entry
+                del self.queued_merkle[tx_hash]
+                # the tx might have been verified, or its height changed, since it was queued
+                if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
+                    continue
+                if unverified.get(tx_hash) != tx_height:
+                    if tx_hash in unverified:
+                        # queued again, at its new height, by the next pass
+                        self.wakeup()
+                    continue
+                batch.append(tx_hash)
+            if not batch:
+                continue
+            for tx_hash in batch:
+                self.print_error('requested merkle', tx_hash)
+                self.requested_merkle.add(tx_hash)
+            await group.spawn(self._request_and_verify_proofs, tx_height, batch)
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
-        header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            self.print_error(str(e))
-            raise GracefulDisconnect(e)
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = header.get('merkle_root')
-        try:
-            self.requested_merkle.remove(tx_hash)
-        except KeyError: pass
-        self.print_error("verified %s" % tx_hash)
-        header_hash = hash_header(header)
-        vtx_info = VerifiedTxInfo(tx_height, header.get('timestamp'), pos, header_hash)
-        self.wallet.add_verified_tx(tx_hash, vtx_info)
+    async def _request_and_verify_proofs(self, tx_height: int, tx_hashes: List[str]):
+        merkles = await asyncio.gather(*[self.network.get_merkle_for_transaction(tx_hash, tx_height)
+                                         for tx_hash in tx_hashes])
+        blockchain = self.network.blockchain()
+        headers = {}  # height -> header; all txs are expected in the same block
+        for tx_hash, merkle in zip(tx_hashes, merkles):
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            height = merkle.get('block_height')
+            pos = merkle.get('pos')
+            merkle_branch = merkle.get('merkle')
+            if height not in headers:
+                headers[height] = blockchain.read_header(height)
+            header = headers[height]
+            try:
+                verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, height)
+            except MerkleVerificationFailure as e:
+                self.print_error(str(e))
+                raise GracefulDisconnect(e)
+            # we passed all the tests
+            self.merkle_roots[tx_hash] = header.get('merkle_root')
+            try:
+                self.requested_merkle.remove(tx_hash)
+            except KeyError: pass
+            self.print_error("verified %s" % tx_hash)
+            header_hash = blockchain.get_hash(height)
+            vtx_info = VerifiedTxInfo(height, header.get('timestamp'), pos, header_hash)
+            self.wallet.add_verified_tx(tx_hash, vtx_info)
         if self.is_up_to_date() and self.wallet.is_up_to_date():
             self.wallet.save_verified_tx(write=True)
+        self.wakeup()
 
     @classmethod
     def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
@@ -150,9 +222,12 @@ class SPV(ThreadJob):
             self.requested_merkle.remove(tx_hash)
         except KeyError:
             pass
+        # its entry in proof_queue is skipped when popped
+        self.queued_merkle.pop(tx_hash, None)
+        self.wakeup()
 
     def is_up_to_date(self):
-        return not self.requested_merkle
+        return not self.requested_merkle and not self.queued_merkle
 
 
 def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
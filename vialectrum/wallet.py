@@ -80,57 +80,83 @@ def dust_threshold(network):
     return 182 * 3 * relayfee(network) / 1000
 
 
-def append_utxos_to_inputs(inputs, network, pubkey, txin_type, imax):
-    if txin_type != 'p2pk':
-        address = bitcoin.pubkey_to_address(txin_type, pubkey)
-        scripthash = bitcoin.address_to_scripthash(address)
-    else:
-        script = bitcoin.public_key_to_p2pk_script(pubkey)
-        scripthash = bitcoin.script_to_scripthash(script)
-        address = '(pubkey)'
-
-    u = network.listunspent_for_scripthash(scripthash)
-    for item in u:
-        if len(inputs) >= imax:
-            break
-        item['address'] = address
-        item['type'] = txin_type
-        item['prevout_hash'] = item['tx_hash']
-        item['prevout_n'] = int(item['tx_pos'])
-        item['pubkeys'] = [pubkey]
-        item['x_pubkeys'] = [pubkey]
-        item['signatures'] = [None]
-        item['num_sig'] = 1
-        inputs.append(item)
-
-def sweep_preparations(privkeys, network, imax=100):
-
-    def find_utxos_for_privkey(txin_type, privkey, compressed):
+def sweep_scripts(privkeys):
+    """The scripts a list of private keys may have received coins on, as
+    (scripthash, address, pubkey, txin_type), and the keypairs to sign
+    with. Duplicates are left out."""
+    scripts = []
+    keypairs = {}
+    seen = set()
+    def add(txin_type, privkey, compressed):
         pubkey = ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed)
-        append_utxos_to_inputs(inputs, network, pubkey, txin_type, imax)
+        if txin_type != 'p2pk':
+            address = bitcoin.pubkey_to_address(txin_type, pubkey)
+            scripthash = bitcoin.address_to_scripthash(address)
+        else:
+            script = bitcoin.public_key_to_p2pk_script(pubkey)
+            scripthash = bitcoin.script_to_scripthash(script)
+            address = '(pubkey)'
         keypairs[pubkey] = privkey, compressed
-    inputs = []
-    keypairs = {}
+        if scripthash not in seen:
+            seen.add(scripthash)
+            scripts.append((scripthash, address, pubkey, txin_type))
     for sec in privkeys:
         txin_type, privkey, compressed = bitcoin.deserialize_privkey(sec)
-        find_utxos_for_privkey(txin_type, privkey, compressed)
+        add(txin_type, privkey, compressed)
         # do other lookups to increase support coverage
         if is_minikey(sec):
             # minikeys don't have a compressed byte
             # we lookup both compressed and uncompressed pubkeys
-            find_utxos_for_privkey(txin_type, privkey, not compressed)
+            add(txin_type, privkey, not compressed)
         elif txin_type == 'p2pkh':
             # WIF serialization does not distinguish p2pkh and p2pk
             # we also search for pay-to-pubkey outputs
-            find_utxos_for_privkey('p2pk', privkey, compressed)
+            add('p2pk', privkey, compressed)
+    return scripts, keypairs
+
+
+def utxos_to_inputs(utxos, address, pubkey, txin_type):
+    inputs = []
+    for item in utxos:
+        item = dict(item)
+        item['address'] = address
+        item['type'] = txin_type
+        item['prevout_hash'] = item['tx_hash']
+        item['prevout_n'] = int(item['tx_pos'])
+        item['pubkeys'] = [pubkey]
+        item['x_pubkeys'] = [pubkey]
+        item['signatures'] = [None]
+        item['num_sig'] = 1
+        inputs.append(item)
+    return inputs
+
+
+def sweep_preparations(privkeys, network, imax=100, callback=None):
+    """Inputs spending the coins of privkeys, at most imax, and the
+    keypairs to sign them. All the scripts are looked up concurrently;
+    callback(inputs) is called from the network thread with the inputs
+    found on each script, as they arrive."""
+    scripts, keypairs = sweep_scripts(privkeys)
+    on_result = None
+    if callback:
+        by_scripthash = {s[0]: s for s in scripts}
+        def on_result(scripthash, utxos):
+            if utxos:
+                callback(utxos_to_inputs(utxos, *by_scripthash[scripthash][1:]))
+    utxos = network.listunspent_for_scripthashes([s[0] for s in scripts], callback=on_result)
+    # in the order of the keys, so that the same inputs are kept when there are more than imax
+    inputs = []
+    for scripthash, address, pubkey, txin_type in scripts:
+        inputs += utxos_to_inputs(utxos.get(scripthash, []), address, pubkey, txin_type)
+    inputs = inputs[:imax]
     if not inputs:
         raise Exception(_('No inputs found. (Note that inputs need to be confirmed)'))
         # FIXME actually inputs need not be confirmed now, see https://github.com/kyuupichan/electrumx/issues/365
     return inputs, keypairs
 
 
-def sweep(privkeys, network, config, recipient, fee=None, imax=100):
-    inputs, keypairs = sweep_preparations(privkeys, network, imax)
+def sweep(privkeys, network, config, recipient, fee=None, imax=100, callback=None):
+    inputs, keypairs = sweep_preparations(privkeys, network, imax, callback)
     total = sum(i.get('value') for i in inputs)
     if fee is None:
         outputs = [TxOutput(TYPE_ADDRESS, recipient, total)]
@@ -773,24 +799,45 @@ class Abstract_Wallet(AddressSynchronizer):
     def get_input_tx(self, tx_hash, ignore_timeout=False):
         # First look up an input transaction in the wallet where it
         # will likely be.  If co-signing a transaction it may not have
-        # all the input txs, in which case we ask the network.
+        # all the input txs, in which case we ask the network, which
+        # first looks in the tx store shared by all wallets.
         tx = self.transactions.get(tx_hash, None)
         if not tx and self.network:
             try:
-                tx = Transaction(self.network.get_transaction(tx_hash))
+                raw = self.network.get_transaction(tx_hash)
+                tx = Transaction(raw) if raw else None
             except TimeoutException as e:
                 self.print_error('getting input txn from network timed out for {}'.format(tx_hash))
                 if not ignore_timeout:
                     raise e
         return tx
 
+    def get_input_txs(self, tx):
+        """Input transactions of tx that are in the wallet, or that could be
+        fetched from the network. Missing ones are fetched concurrently,
+        instead of one round-trip per input in get_input_tx."""
+        tx_hashes = set(txin['prevout_hash'] for txin in tx.inputs())
+        input_txs = {}
+        for tx_hash in tx_hashes:
+            prev_tx = self.transactions.get(tx_hash)
+            if prev_tx:
+                input_txs[tx_hash] = prev_tx
+        missing = tx_hashes - set(input_txs)
+        if missing and self.network:
+            for tx_hash, raw in self.network.get_transactions(missing).items():
+                input_txs[tx_hash] = Transaction(raw)
+        return input_txs
+
     def add_hw_info(self, tx):
         # add previous tx for hw wallets
+        input_txs = self.get_input_txs(tx)
         for txin in tx.inputs():
             tx_hash = txin['prevout_hash']
             # segwit inputs might not be needed for some hw wallets
             ignore_timeout = Transaction.is_segwit_input(txin)
-            txin['prev_tx'] = self.get_input_tx(tx_hash, ignore_timeout)
+            prev_tx = input_txs.get(tx_hash)
+            # not fetched: try again, and report a timeout
+            txin['prev_tx'] = prev_tx if prev_tx else self.get_input_tx(tx_hash, ignore_timeout)
         # add output info for hw wallets
         info = {}
         xpubs = self.get_master_public_keys()
@@ -1260,10 +1307,14 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.history.pop(address, None)
+            self.history_status.pop(address, None)
+            self._set_unsaved('addr_history', address)
+            self._set_unsaved('addr_history_status', address)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
                 self.tx_fees.pop(tx_hash, None)
+                self._set_unsaved('tx_fees', tx_hash)
                 self.verified_tx.pop(tx_hash, None)
                 self.unverified_tx.pop(tx_hash, None)
                 self.transactions.pop(tx_hash, None)